@@ -0,0 +1,419 @@
+# Benchmarks the mux hot path against local stand-in downstreams.
+#
+#   pipenv run bench --fanout 1,3,10 --keywords 10,1000 --output bench.json
+#   pipenv run bench --baseline bench.json  # compare against an earlier run
+#   pipenv run bench --cold-start 10  # time fresh imports of the Lambda handler
+#
+# Each stand-in downstream is a local HTTP server with configurable latency,
+# error rate and response size. For every combination of fan-out width and
+# keyword-table size, we send signed webhooks through TwilioMuxer.mux_request
+# (and/or the Lambda handler) from a pool of concurrent clients and report
+# latency percentiles, throughput and peak RSS.
+#
+# With --cold-start, we instead start fresh interpreters that import the
+# Lambda handler module (as Lambda does during its init phase) and handle one
+# request, and report how long each step took and which imports dominate.
+import argparse
+import base64
+import concurrent.futures
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+from .config import Config
+from .signing import Signer, canonicalize_params
+
+AUTH_TOKEN = "bench-auth-token"
+MUXER_URL = "https://bench-muxer.example.com/muxer"
+
+# Run in a fresh interpreter for each cold start. The last line of output is
+# a JSON object with the timings.
+COLD_START_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app.muxer
+imported = time.perf_counter()
+app.muxer.handler(json.loads(sys.argv[1]), None)
+done = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_request_ms": (done - imported) * 1000,
+}))
+"""
+
+
+class StandInServer:
+    def __init__(self, latency: float, error_rate: float, body_size: int):
+        rng = random.Random()
+        body = (
+            "<Response><Message>"
+            + "x" * max(body_size - 40, 0)
+            + "</Message></Response>"
+        ).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            # Headers and body are written separately, so without this we'd
+            # be measuring Nagle/delayed-ACK stalls
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if latency:
+                    time.sleep(latency)
+
+                status = 500 if rng.random() < error_rate else 200
+                self.send_response(status)
+                self.send_header("Content-Type", "application/xml")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # The default backlog of 5 drops connections under load, which
+            # shows up as 1s SYN retransmits
+            request_queue_size = 1024
+            daemon_threads = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def bench_config(base_url: str, fanout: int, keyword_count: int, engine: str) -> Config:
+    downstreams = [f"{base_url}/downstream{i}" for i in range(fanout)]
+    keywords = {
+        f"keyword{i}": {
+            "downstreams": downstreams,
+            "responder": 0,
+            "alternates": [f"alternate{i}a", f"alternate{i}b"],
+        }
+        for i in range(keyword_count)
+    }
+    # Parsed like a deployed config, so every optional setting has its default
+    return Config.parse_obj(
+        {
+            "default": {"downstreams": downstreams, "responder": 0},
+            "keywords": keywords,
+            "engine": engine,
+        }
+    )
+
+
+def signed_request(body: str) -> Dict[str, Any]:
+    params = {
+        "Body": body,
+        "From": "+15555550100",
+        "To": "+15555550199",
+        "MessageSid": "SM" + "0" * 32,
+        "AccountSid": "AC" + "0" * 32,
+    }
+    return {
+        "body": urllib.parse.urlencode(params),
+        "headers": {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "X-Twilio-Signature": Signer(AUTH_TOKEN).sign(
+                MUXER_URL, canonicalize_params(params)
+            ),
+            "User-Agent": "TwilioProxy/1.1",
+        },
+    }
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+
+    index = min(int(round(p / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_case(
+    mode: str,
+    base_url: str,
+    fanout: int,
+    keyword_count: int,
+    engine: str,
+    requests_count: int,
+    concurrency: int,
+) -> Dict[str, Any]:
+    from . import muxer as muxer_module
+
+    muxer = muxer_module.TwilioMuxer(
+        twilio_auth_token=AUTH_TOKEN,
+        muxer_url=MUXER_URL,
+        config=bench_config(base_url, fanout, keyword_count, engine),
+    )
+
+    # Half the traffic hits a keyword (the last one, so a linear scan would
+    # be at its worst), half falls through to the default
+    requests = [
+        signed_request(
+            f"keyword{keyword_count - 1}" if i % 2 and keyword_count else "hi"
+        )
+        for i in range(requests_count)
+    ]
+
+    def send(request: Dict[str, Any]) -> float:
+        start = time.perf_counter()
+        if mode == "handler":
+            muxer_module.handler(request, None)
+        else:
+            muxer.mux_request(request["body"], request["headers"])
+        return time.perf_counter() - start
+
+    # Otherwise we'd mostly be measuring how fast we can write logs
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    previous_muxer = getattr(muxer_module, "muxer", None)
+    muxer_module.muxer = muxer  # type: ignore
+    try:
+        # Warm up the connection pools
+        for request in requests[:concurrency]:
+            send(request)
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as clients:
+            latencies = sorted(clients.map(send, requests))
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        muxer_module.muxer = previous_muxer  # type: ignore
+        muxer.engine.close()
+
+    return {
+        "mode": mode,
+        "engine": engine,
+        "fanout": fanout,
+        "keywords": keyword_count,
+        "requests": requests_count,
+        "concurrency": concurrency,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "requests_per_second": requests_count / elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def cold_start_environment(base_url: str, lazy: bool) -> Dict[str, str]:
+    config = bench_config(base_url, 1, 10, "threads")
+    environment = {
+        **os.environ,
+        "AWS_LAMBDA_FUNCTION_NAME": "bench-cold-start",
+        "SENTRY_DSN": "",
+        "SENTRY_ENVIRONMENT": "bench",
+        "TWILIO_AUTH_TOKEN": AUTH_TOKEN,
+        "TWILIO_CALLBACK_URL": MUXER_URL,
+        "DOWNSTREAM_CONFIG": base64.b64encode(config.json().encode()).decode(),
+        "METRICS_SINK": "none",
+    }
+    environment.pop("MUXER_LAZY_INIT", None)
+    if lazy:
+        environment["MUXER_LAZY_INIT"] = "1"
+
+    return environment
+
+
+def slowest_imports(environment: Dict[str, str], count: int = 10) -> List[Any]:
+    # Third-party (and standard library) packages by cumulative import time,
+    # wherever they're first imported from, per python -X importtime
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.muxer"],
+        env=environment,
+        stderr=subprocess.PIPE,
+        check=True,
+    ).stderr.decode()
+
+    imports: List[List[Any]] = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:") :].split("|")
+        name = name.strip()
+        if "." in name or name.startswith("_") or name == "app":
+            continue
+
+        imports.append([name, int(cumulative) / 1000])
+
+    return sorted(imports, key=lambda i: -i[1])[:count]
+
+
+def run_cold_start(base_url: str, runs: int, lazy: bool) -> Dict[str, Any]:
+    environment = cold_start_environment(base_url, lazy)
+    request = json.dumps(signed_request("hi"))
+
+    process_ms, import_ms, first_request_ms = [], [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", COLD_START_SCRIPT, request],
+            env=environment,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout.decode()
+        process_ms.append((time.perf_counter() - start) * 1000)
+
+        timings = json.loads(output.strip().splitlines()[-1])
+        import_ms.append(timings["import_ms"])
+        first_request_ms.append(timings["first_request_ms"])
+
+    return {
+        "lazy_init": lazy,
+        "runs": runs,
+        "process_p50_ms": percentile(sorted(process_ms), 50),
+        "import_p50_ms": percentile(sorted(import_ms), 50),
+        "first_request_p50_ms": percentile(sorted(first_request_ms), 50),
+        "slowest_imports_ms": slowest_imports(environment),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except Exception:
+        return None
+
+
+def case_key(case: Dict[str, Any]) -> tuple:
+    return (
+        case["mode"],
+        case["engine"],
+        case["fanout"],
+        case["keywords"],
+        case["concurrency"],
+    )
+
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Any]) -> None:
+    baseline_cases = {case_key(case): case for case in baseline["cases"]}
+    print(f"\nCompared to {baseline.get('commit')}:")
+    for case in results["cases"]:
+        old = baseline_cases.get(case_key(case))
+        if old is None:
+            continue
+
+        changes = ", ".join(
+            f"{metric} {(case[metric] - old[metric]) / old[metric] * 100:+.1f}%"
+            for metric in ("p50_ms", "p99_ms", "requests_per_second")
+            if old[metric]
+        )
+        print(f"  {case_key(case)}: {changes}")
+
+
+def int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",")]
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the muxer against local stand-in downstreams"
+    )
+    parser.add_argument("--fanout", type=int_list, default=[1, 3])
+    parser.add_argument("--keywords", type=int_list, default=[10, 1000])
+    parser.add_argument(
+        "--mode", choices=["mux", "handler"], nargs="+", default=["mux"]
+    )
+    parser.add_argument(
+        "--engine", choices=["threads", "asyncio"], nargs="+", default=["threads"]
+    )
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--body-size", type=int, default=200, help="bytes")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument(
+        "--cold-start",
+        type=int,
+        default=0,
+        metavar="RUNS",
+        help="benchmark cold starts instead of the mux hot path",
+    )
+    args = parser.parse_args(argv)
+
+    server = StandInServer(args.latency, args.error_rate, args.body_size)
+    try:
+        cases = []
+        cold_starts = []
+        if args.cold_start:
+            for lazy in (False, True):
+                cold_start = run_cold_start(server.url, args.cold_start, lazy)
+                print(json.dumps(cold_start))
+                cold_starts.append(cold_start)
+
+        for mode in [] if args.cold_start else args.mode:
+            for engine in args.engine:
+                for fanout in args.fanout:
+                    for keyword_count in args.keywords:
+                        case = run_case(
+                            mode,
+                            server.url,
+                            fanout,
+                            keyword_count,
+                            engine,
+                            args.requests,
+                            args.concurrency,
+                        )
+                        print(json.dumps(case))
+                        cases.append(case)
+    finally:
+        server.close()
+
+    results = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "downstream": {
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "body_size": args.body_size,
+        },
+        "cases": cases,
+        "cold_starts": cold_starts,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
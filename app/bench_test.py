@@ -0,0 +1,69 @@
+import json
+
+from .bench import main, percentile
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 51
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([], 50) == 0
+
+
+def test_bench(tmp_path):
+    output = tmp_path / "bench.json"
+    results = main(
+        [
+            "--fanout",
+            "1,2",
+            "--keywords",
+            "5",
+            "--mode",
+            "mux",
+            "handler",
+            "--requests",
+            "10",
+            "--concurrency",
+            "2",
+            "--latency",
+            "0",
+            "--error-rate",
+            "0.5",
+            "--output",
+            str(output),
+        ]
+    )
+
+    assert json.loads(output.read_text()) == results
+    assert len(results["cases"]) == 4
+    for case in results["cases"]:
+        assert case["requests_per_second"] > 0
+        assert 0 < case["p50_ms"] <= case["p95_ms"] <= case["p99_ms"]
+        assert case["peak_rss_mb"] > 0
+
+    # Comparing against a baseline doesn't blow up
+    main(
+        [
+            "--fanout",
+            "1",
+            "--keywords",
+            "5",
+            "--requests",
+            "5",
+            "--baseline",
+            str(output),
+        ]
+    )
+
+
+def test_cold_start():
+    results = main(["--cold-start", "1"])
+
+    eager, lazy = results["cold_starts"]
+    assert not eager["lazy_init"]
+    assert lazy["lazy_init"]
+    for cold_start in (eager, lazy):
+        assert cold_start["import_p50_ms"] > 0
+        assert cold_start["first_request_p50_ms"] > 0
+        assert cold_start["slowest_imports_ms"]
@@ -0,0 +1,137 @@
+import collections
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+# Tracks the recent outcomes of requests to one downstream. While closed,
+# everything is let through. Once enough of the requests in the rolling window
+# have failed (or been too slow) it opens, and requests fail fast without
+# touching the network. After open_duration it goes half-open and lets a single
+# probe request through: if that succeeds it closes again, otherwise it
+# re-opens.
+class CircuitBreaker:
+    def __init__(
+        self,
+        window: float,
+        min_requests: int,
+        failure_ratio: float,
+        open_duration: float,
+        slow_call: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_ratio = failure_ratio
+        self.open_duration = open_duration
+        self.slow_call = slow_call
+        self.clock = clock
+
+        self.state = CLOSED
+        self.lock = threading.Lock()
+
+        # (time, failed) for each request in the window, oldest first
+        self.outcomes: Deque[Tuple[float, bool]] = collections.deque()
+        self.failures = 0
+
+        # When we last opened, and when the current half-open probe was let
+        # through (a probe whose outcome never gets recorded, e.g. because it
+        # was cancelled before it was sent, expires after open_duration)
+        self.opened_at = 0.0
+        self.probe_started: Optional[float] = None
+
+    def allow(self) -> Tuple[bool, Optional[str]]:
+        # Whether to send a request now, and the state we changed to (if any)
+        with self.lock:
+            now = self.clock()
+            transition = None
+
+            if self.state == OPEN:
+                if now - self.opened_at < self.open_duration:
+                    return False, None
+
+                self.state = HALF_OPEN
+                self.probe_started = None
+                transition = HALF_OPEN
+
+            if self.state == HALF_OPEN:
+                if (
+                    self.probe_started is not None
+                    and now - self.probe_started < self.open_duration
+                ):
+                    return False, transition
+
+                self.probe_started = now
+
+            return True, transition
+
+    def record(self, failed: bool, latency: float) -> Optional[str]:
+        # Record the outcome of a request we let through, returning the state
+        # we changed to (if any)
+        if self.slow_call is not None and latency >= self.slow_call:
+            failed = True
+
+        with self.lock:
+            now = self.clock()
+
+            if self.state == HALF_OPEN:
+                if failed:
+                    return self.open(now)
+
+                self.state = CLOSED
+                self.probe_started = None
+                self.outcomes.clear()
+                self.failures = 0
+                return CLOSED
+
+            if self.state == OPEN:
+                # A request that was sent before we opened
+                return None
+
+            self.outcomes.append((now, failed))
+            self.failures += failed
+            while self.outcomes and self.outcomes[0][0] <= now - self.window:
+                _, expired_failed = self.outcomes.popleft()
+                self.failures -= expired_failed
+
+            total = len(self.outcomes)
+            if (
+                total >= self.min_requests
+                and self.failures >= self.failure_ratio * total
+            ):
+                return self.open(now)
+
+            return None
+
+    def open(self, now: float) -> str:
+        self.state = OPEN
+        self.opened_at = now
+        self.probe_started = None
+        self.outcomes.clear()
+        self.failures = 0
+        return OPEN
+
+
+# A CircuitBreaker per downstream URL, created on first use
+class CircuitBreakers:
+    def __init__(self, **breaker_args: Any):
+        self.breaker_args = breaker_args
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, url: str) -> CircuitBreaker:
+        breaker = self.breakers.get(url)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(
+                    url, CircuitBreaker(**self.breaker_args)
+                )
+
+        return breaker
+
+    def states(self) -> Dict[str, str]:
+        return {url: breaker.state for url, breaker in list(self.breakers.items())}
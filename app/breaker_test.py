@@ -0,0 +1,100 @@
+from .breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers
+
+
+def make_breaker(clock, **kwargs):
+    args = dict(window=60, min_requests=4, failure_ratio=0.5, open_duration=30)
+    args.update(kwargs)
+    return CircuitBreaker(clock=clock, **args)
+
+
+def test_opens_after_failures(clock):
+    breaker = make_breaker(clock)
+
+    assert breaker.record(False, 0.1) is None
+    assert breaker.record(True, 0.1) is None
+    assert breaker.record(False, 0.1) is None
+    assert breaker.state == CLOSED
+
+    # 2 of 4 failed
+    assert breaker.record(True, 0.1) == OPEN
+    assert breaker.allow() == (False, None)
+
+
+def test_needs_min_requests(clock):
+    breaker = make_breaker(clock)
+
+    for _ in range(3):
+        assert breaker.record(True, 0.1) is None
+    assert breaker.allow() == (True, None)
+
+
+def test_rolling_window(clock):
+    breaker = make_breaker(clock)
+
+    for _ in range(3):
+        breaker.record(True, 0.1)
+
+    # Those failures have aged out by the time we've seen enough requests
+    clock.now += 61
+    for _ in range(3):
+        assert breaker.record(False, 0.1) is None
+    assert breaker.record(True, 0.1) is None
+    assert breaker.state == CLOSED
+
+
+def test_slow_calls_count_as_failures(clock):
+    breaker = make_breaker(clock, slow_call=2)
+
+    breaker.record(False, 0.1)
+    breaker.record(False, 1.9)
+    assert breaker.record(False, 2.5) is None
+    assert breaker.record(False, 3) == OPEN
+
+
+def test_half_open(clock):
+    breaker = make_breaker(clock, min_requests=1)
+    assert breaker.record(True, 0.1) == OPEN
+
+    clock.now += 29
+    assert breaker.allow() == (False, None)
+
+    # One probe at a time
+    clock.now += 1
+    assert breaker.allow() == (True, HALF_OPEN)
+    assert breaker.allow() == (False, None)
+
+    # A failed probe re-opens it...
+    assert breaker.record(True, 0.1) == OPEN
+    assert breaker.allow() == (False, None)
+
+    # ...and a successful one closes it
+    clock.now += 30
+    assert breaker.allow() == (True, HALF_OPEN)
+    assert breaker.record(False, 0.1) == CLOSED
+    assert breaker.allow() == (True, None)
+    assert breaker.allow() == (True, None)
+
+
+def test_lost_probe_expires(clock):
+    breaker = make_breaker(clock, min_requests=1)
+    breaker.record(True, 0.1)
+
+    clock.now += 30
+    assert breaker.allow() == (True, HALF_OPEN)
+
+    # The probe never reports back, so another is let through eventually
+    clock.now += 29
+    assert breaker.allow() == (False, None)
+    clock.now += 1
+    assert breaker.allow() == (True, None)
+
+
+def test_per_url():
+    breakers = CircuitBreakers(
+        window=60, min_requests=1, failure_ratio=0.5, open_duration=30
+    )
+    assert breakers["https://a.com"] is breakers["https://a.com"]
+
+    breakers["https://a.com"].record(True, 0.1)
+    assert breakers.states() == {"https://a.com": OPEN}
+    assert breakers["https://b.com"].allow() == (True, None)
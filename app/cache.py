@@ -0,0 +1,55 @@
+import collections
+import threading
+import time
+from typing import Callable, Dict, Hashable, Optional, OrderedDict, Tuple
+
+# A reply to Twilio: status code, body and headers
+Reply = Tuple[int, str, Dict[str, str]]
+
+
+# A size-bounded LRU of replies. Entries are fresh for ttl seconds, then
+# stale (still usable, but due for a refresh) for another stale_ttl seconds,
+# then gone.
+class ResponseCache:
+    def __init__(
+        self,
+        ttl: float,
+        stale_ttl: float,
+        max_entries: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+
+        self.entries: OrderedDict[Hashable, Tuple[float, Reply]] = (
+            collections.OrderedDict()
+        )
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Tuple[Optional[Reply], bool]:
+        # The cached reply (if any), and whether it's fresh
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None, False
+
+            stored_at, reply = entry
+            age = self.clock() - stored_at
+            if age >= self.ttl + self.stale_ttl:
+                del self.entries[key]
+                return None, False
+
+            self.entries.move_to_end(key)
+            return reply, age < self.ttl
+
+    def put(self, key: Hashable, reply: Reply) -> None:
+        with self.lock:
+            self.entries[key] = (self.clock(), reply)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,33 @@
+from .cache import ResponseCache
+
+REPLY = (200, "<Response>help</Response>", {"Content-Type": "application/xml"})
+
+
+def test_ttl(clock):
+    cache = ResponseCache(ttl=60, stale_ttl=30, max_entries=10, clock=clock)
+    assert cache.get(("a",)) == (None, False)
+
+    cache.put(("a",), REPLY)
+    assert cache.get(("a",)) == (REPLY, True)
+
+    clock.now += 60
+    assert cache.get(("a",)) == (REPLY, False)
+
+    clock.now += 30
+    assert cache.get(("a",)) == (None, False)
+    assert len(cache) == 0
+
+
+def test_lru():
+    cache = ResponseCache(ttl=60, stale_ttl=0, max_entries=2)
+    cache.put(("a",), REPLY)
+    cache.put(("b",), REPLY)
+
+    # Using "a" makes "b" the least recently used
+    cache.get(("a",))
+    cache.put(("c",), REPLY)
+
+    assert len(cache) == 2
+    assert cache.get(("a",))[0] == REPLY
+    assert cache.get(("b",))[0] is None
+    assert cache.get(("c",))[0] == REPLY
@@ -1,9 +1,15 @@
 import base64
+import functools
 import json
 import re
-from typing import Dict, List, Optional
+import string
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Optional, Pattern, Tuple
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, ValidationError, validator
+from pydantic.error_wrappers import ErrorWrapper
+
+from .fuzzy import FuzzyIndex
 
 # From https://github.com/django/django/blob/stable/1.3.x/django/core/validators.py#L45
 # but no ftp:// support
@@ -18,11 +24,78 @@ url_regex = re.compile(
 )
 
 
+# Deletes punctuation (see normalize_body())
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
+
+def normalize_body(body: str) -> str:
+    # Normalize a message body (or a keyword or alternate) for matching:
+    # strip punctuation, lowercase, and collapse whitespace
+    return " ".join(body.translate(PUNCTUATION_TABLE).lower().split())
+
+
+class CacheConfig(BaseModel):
+    # Replies are served from the cache for ttl seconds, and for stale_ttl
+    # seconds after that while being refreshed
+    ttl: float
+    stale_ttl: float = 300
+
+    # The most replies to keep (per keyword)
+    max_entries: int = 128
+
+    # Body fields (besides the keyword) that select the reply, e.g. "To"
+    key_fields: List[str] = []
+
+    @validator("ttl")
+    def ttl_must_be_positive(cls, v):
+        if v <= 0:
+            raise ValueError("ttl must be > 0")
+
+        return v
+
+    @validator("stale_ttl")
+    def stale_ttl_must_not_be_negative(cls, v):
+        if v < 0:
+            raise ValueError("stale_ttl must be >= 0")
+
+        return v
+
+    @validator("max_entries")
+    def max_entries_must_be_positive(cls, v):
+        if v < 1:
+            raise ValueError("max_entries must be >= 1")
+
+        return v
+
+
 class KeywordConfig(BaseModel):
     downstreams: List[str]
     responder: Optional[int]
+
+    # Other downstreams (by index, in order of preference) whose
+    # reply we use if the responder fails or doesn't give a non-empty TwiML
+    # reply, or, with hedge_percentile, is slow
+    fallback_responders: Optional[List[int]]
+
+    # If set, only wait this percentile of the responder's recent latency for it
+    # before using the first good reply from a fallback responder
+    hedge_percentile: Optional[float]
+
     alternates: Optional[List[str]]
 
+    # Per-request connect and read timeouts for these downstreams, in seconds.
+    # Defaults to DOWNSTREAM_TIMEOUT. Requests are additionally bounded by the
+    # overall fan-out deadline.
+    connect_timeout: Optional[float]
+    read_timeout: Optional[float]
+
+    # Also match messages within this many edits (insertions, deletions or
+    # substitutions) of the keyword or one of its alternates. Off by default.
+    max_edit_distance: Optional[int]
+
+    # Cache the responder's reply (see CacheConfig). Off by default.
+    cache: Optional[CacheConfig]
+
     @validator("responder")
     def responder_must_be_a_valid_index(cls, v, values, **kwargs):
         if v is not None:
@@ -34,6 +107,51 @@ class KeywordConfig(BaseModel):
 
         return v
 
+    @validator("fallback_responders")
+    def fallback_responders_must_be_valid_indexes(cls, v, values, **kwargs):
+        if v is not None:
+            if values.get("responder") is None:
+                raise ValueError("fallback_responders requires a responder")
+
+            if len(set(v)) != len(v) or values["responder"] in v:
+                raise ValueError("fallback_responders must be unique")
+
+            for index in v:
+                if index < 0 or index >= len(values.get("downstreams", [])):
+                    raise ValueError(
+                        "fallback_responders are out-of-bounds of the downstreams list"
+                    )
+
+        return v
+
+    @validator("cache")
+    def cache_requires_a_responder(cls, v, values, **kwargs):
+        if v is not None and values.get("responder") is None:
+            raise ValueError("cache requires a responder")
+
+        return v
+
+    @validator("hedge_percentile")
+    def hedge_percentile_must_be_a_percentile(cls, v):
+        if v is not None and not 0 < v < 100:
+            raise ValueError("hedge_percentile must be > 0 and < 100")
+
+        return v
+
+    @validator("connect_timeout", "read_timeout")
+    def timeouts_must_be_positive(cls, v):
+        if v is not None and v <= 0:
+            raise ValueError("timeouts must be > 0")
+
+        return v
+
+    @validator("max_edit_distance")
+    def max_edit_distance_must_not_be_negative(cls, v):
+        if v is not None and v < 0:
+            raise ValueError("max_edit_distance must be >= 0")
+
+        return v
+
     @validator("downstreams")
     def downstreams_must_be_urls(cls, v):
         for url in v:
@@ -42,18 +160,479 @@ class KeywordConfig(BaseModel):
 
         return v
 
+    @property
+    def responders(self) -> List[int]:
+        # The responder followed by any fallbacks, in order of preference
+        if self.responder is None:
+            return []
+
+        return [self.responder, *(self.fallback_responders or [])]
+
+
+class BreakerConfig(BaseModel):
+    # A downstream's breaker opens once at least min_requests were sent to it
+    # in the last window seconds and at least failure_ratio of them failed
+    # (errored, returned a retryable status, or took slow_call seconds or
+    # longer). It stays open for open_duration seconds before letting a probe
+    # request through.
+    window: float = 60
+    min_requests: int = 5
+    failure_ratio: float = 0.5
+    open_duration: float = 30
+    slow_call: Optional[float]
+
+    @validator("window", "open_duration", "slow_call")
+    def durations_must_be_positive(cls, v):
+        if v is not None and v <= 0:
+            raise ValueError("durations must be > 0")
+
+        return v
+
+    @validator("min_requests")
+    def min_requests_must_be_positive(cls, v):
+        if v < 1:
+            raise ValueError("min_requests must be >= 1")
+
+        return v
+
+    @validator("failure_ratio")
+    def failure_ratio_must_be_a_ratio(cls, v):
+        if not 0 < v <= 1:
+            raise ValueError("failure_ratio must be > 0 and <= 1")
+
+        return v
+
+
+class LimitConfig(BaseModel):
+    # At most max_in_flight requests to the host at once, and at most rate
+    # per second (in bursts of up to burst, default max(rate, 1)). Requests
+    # over either limit wait their turn.
+    max_in_flight: Optional[int]
+    rate: Optional[float]
+    burst: Optional[float]
+
+    # Adjust the in-flight limit between min_in_flight and max_in_flight based
+    # on how the host is doing: up while requests succeed (and are faster than
+    # latency_target, if set), down when they fail or are slow
+    adaptive: bool = False
+    min_in_flight: int = 1
+    latency_target: Optional[float]
+
+    @validator("max_in_flight", "min_in_flight")
+    def in_flight_must_be_positive(cls, v):
+        if v is not None and v < 1:
+            raise ValueError("in-flight limits must be >= 1")
+
+        return v
+
+    @validator("rate", "burst", "latency_target")
+    def must_be_positive(cls, v):
+        if v is not None and v <= 0:
+            raise ValueError("rate, burst and latency_target must be > 0")
+
+        return v
+
+    @validator("adaptive")
+    def adaptive_requires_max_in_flight(cls, v, values, **kwargs):
+        if v and values.get("max_in_flight") is None:
+            raise ValueError("adaptive requires max_in_flight")
+
+        return v
+
+    @validator("min_in_flight")
+    def min_in_flight_must_not_exceed_max(cls, v, values, **kwargs):
+        max_in_flight = values.get("max_in_flight")
+        if max_in_flight is not None and v > max_in_flight:
+            raise ValueError("min_in_flight must be <= max_in_flight")
+
+        return v
+
+
+class DedupeConfig(BaseModel):
+    # Remember each webhook (by idempotency token and MessageSid) for ttl
+    # seconds, keeping the max_entries most recent (per container)
+    ttl: float = 600
+    max_entries: int = 10000
+
+    @validator("ttl")
+    def ttl_must_be_positive(cls, v):
+        if v <= 0:
+            raise ValueError("ttl must be > 0")
+
+        return v
+
+    @validator("max_entries")
+    def max_entries_must_be_positive(cls, v):
+        if v < 1:
+            raise ValueError("max_entries must be >= 1")
+
+        return v
+
+
+class RuleConfig(BaseModel):
+    # Identifies the rule in metrics
+    name: str
+
+    # Conditions, all of which must hold for the rule to match (a rule with
+    # none matches every message). prefix is normalized, and compared to the
+    # start of the normalized message body; regex is searched for in the
+    # message body, ignoring case; fields maps form fields (e.g. "To" or
+    # "From") to the values they may have.
+    prefix: Optional[str]
+    regex: Optional[str]
+    fields: Dict[str, List[str]] = {}
+
+    # Where matching messages go: the same place as one of Config.keywords
+    # (without rewriting the body to the keyword), or these downstreams
+    keyword: Optional[str]
+    route: Optional[KeywordConfig]
+
+    @validator("prefix")
+    def prefix_must_not_be_empty(cls, v):
+        if v is not None and not normalize_body(v):
+            raise ValueError("prefix must not be empty")
+
+        return v
+
+    @validator("regex")
+    def regex_must_compile(cls, v):
+        if v is not None:
+            try:
+                re.compile(v, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"Invalid regex {v!r}: {e}")
+
+        return v
+
+    @validator("route", always=True)
+    def must_have_one_destination(cls, v, values, **kwargs):
+        if (v is None) == (values.get("keyword") is None):
+            raise ValueError("rules need exactly one of keyword and route")
+
+        return v
+
+
+class Route(NamedTuple):
+    # The keyword (as it appears in Config.keywords) the message matched. The
+    # message body is rewritten to this before it's sent downstream. For a
+    # rule, this is the rule's keyword, or its name if it has its own route,
+    # and the body isn't rewritten.
+    keyword: str
+    config: KeywordConfig
+    rule: Optional[str] = None
+
+
+def build_route_index(keywords: Dict[str, KeywordConfig]) -> Dict[str, Route]:
+    # Map every normalized keyword and alternate to the route it selects,
+    # rejecting anything that would make the routing ambiguous
+    index: Dict[str, Route] = {}
+
+    def add(match: str, route: Route) -> None:
+        normalized = normalize_body(match)
+        if not normalized:
+            raise ValueError(f"{match!r} ({route.keyword}) matches an empty message")
+
+        existing = index.get(normalized)
+        if existing is None:
+            index[normalized] = route
+        elif existing.keyword == route.keyword:
+            raise ValueError(f"Duplicate alternate {match!r} for {route.keyword}")
+        else:
+            raise ValueError(
+                f"{match!r} matches both {existing.keyword} and {route.keyword}"
+            )
+
+    for keyword, keyword_config in keywords.items():
+        add(keyword, Route(keyword, keyword_config))
+
+    for keyword, keyword_config in keywords.items():
+        for alternate in keyword_config.alternates or []:
+            add(alternate, Route(keyword, keyword_config))
+
+    return index
+
+
+def build_fuzzy_index(index: Mapping[str, Route]) -> FuzzyIndex:
+    fuzzy_index = FuzzyIndex()
+    for normalized, route in index.items():
+        if route.config.max_edit_distance:
+            fuzzy_index.add(normalized, route, route.config.max_edit_distance)
+
+    return fuzzy_index
+
+
+class PrefixNode:
+    __slots__ = ("children", "mask")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "PrefixNode"] = {}
+        # The rules whose prefix ends here
+        self.mask = 0
+
+
+# The rules, compiled so that a message is checked against all of them at
+# once. Each kind of condition gives a bitmask of the rules it allows (bit i
+# for rule i): one dict lookup per form field that any rule looks at, one walk
+# down a trie of the prefixes, and one match of a single pattern combining
+# every regex. The first rule allowed by all of them wins.
+class RuleIndex:
+    def __init__(self, routes: List[Route], rules: List[RuleConfig]):
+        self.routes = routes
+        self.all = (1 << len(rules)) - 1
+
+        # field -> (the rules that don't look at it, value -> rules allowing it)
+        self.fields: Dict[str, Tuple[int, Dict[str, int]]] = {}
+        for i, rule in enumerate(rules):
+            for field, values in rule.fields.items():
+                unconstrained, by_value = self.fields.setdefault(field, (self.all, {}))
+                self.fields[field] = (unconstrained & ~(1 << i), by_value)
+                for value in values:
+                    by_value[value] = by_value.get(value, 0) | 1 << i
+
+        self.prefixes = PrefixNode()
+        self.no_prefix = self.all
+        for i, rule in enumerate(rules):
+            if rule.prefix is not None:
+                node = self.prefixes
+                for char in normalize_body(rule.prefix):
+                    node = node.children.setdefault(char, PrefixNode())
+                node.mask |= 1 << i
+                self.no_prefix &= ~(1 << i)
+
+        # Each regex is in its own lookahead from the start of the body, so
+        # one match tells us every regex that matches: its group is set if
+        # it did. The lookaheads never consume anything, so the match as a
+        # whole always succeeds.
+        self.regex: Optional[Pattern[str]] = None
+        self.no_regex = self.all
+        lookaheads = []
+        for i, rule in enumerate(rules):
+            if rule.regex is not None:
+                lookaheads.append(rf"(?:(?=[\s\S]*?(?P<_rule{i}>{rule.regex}))|)")
+                self.no_regex &= ~(1 << i)
+        if lookaheads:
+            try:
+                self.regex = re.compile("".join(lookaheads), re.IGNORECASE)
+            except re.error as e:
+                # e.g. a numbered backreference, which can't be combined
+                raise ValueError(f"Rule regexes can't be combined: {e}")
+
+    def match(self, normalized_body: str, fields: Mapping[str, str]) -> Optional[Route]:
+        candidates = self.all
+
+        for field, (unconstrained, by_value) in self.fields.items():
+            candidates &= unconstrained | by_value.get(fields.get(field, ""), 0)
+            if not candidates:
+                return None
+
+        if self.no_prefix != self.all:
+            matched = 0
+            node = self.prefixes
+            for char in normalized_body:
+                child = node.children.get(char)
+                if child is None:
+                    break
+                node = child
+                matched |= node.mask
+            candidates &= self.no_prefix | matched
+
+        if self.regex is not None and candidates & ~self.no_regex:
+            regex_match = self.regex.match(fields.get("Body", ""))
+            assert regex_match is not None
+            matched = 0
+            for name, value in regex_match.groupdict().items():
+                if value is not None and name.startswith("_rule"):
+                    matched |= 1 << int(name[len("_rule") :])
+            candidates &= self.no_regex | matched
+
+        if not candidates:
+            return None
+
+        # The lowest set bit
+        return self.routes[(candidates & -candidates).bit_length() - 1]
+
+
+def build_rule_index(
+    rules: List[RuleConfig], keywords: Mapping[str, KeywordConfig]
+) -> RuleIndex:
+    routes = []
+    for rule in rules:
+        if rule.keyword is not None:
+            keyword = rule.keyword.lower().strip()
+            if keyword not in keywords:
+                raise ValueError(f"Rule {rule.name} has an unknown keyword: {keyword}")
+            routes.append(Route(keyword, keywords[keyword], rule.name))
+        else:
+            assert rule.route is not None
+            routes.append(Route(rule.name, rule.route, rule.name))
+
+    return RuleIndex(routes, rules)
+
 
 class Config(BaseModel):
+    # Precomputed at load time from keywords and rules (see route(),
+    # fuzzy_route() and rule_route())
+    __slots__ = ("_routes", "_fuzzy_index", "_rules")
+    _routes: Mapping[str, Route]
+    _fuzzy_index: FuzzyIndex
+    _rules: RuleIndex
+
     default: KeywordConfig
     keywords: Dict[str, KeywordConfig]
 
+    # Checked in order for messages that don't match a keyword (exactly or
+    # fuzzily) before falling back to default; the first that matches wins
+    rules: List[RuleConfig] = []
+
+    # Reply to Twilio as soon as the responder has answered (or right away if
+    # there is no responder) instead of waiting for every downstream
+    respond_early: bool = False
+
+    # How downstream requests are sent: "threads" (a thread pool using
+    # requests) or "asyncio" (a single event loop using httpx)
+    engine: str = "threads"
+
+    # The most downstream requests to have in flight at once
+    max_concurrency: Optional[int]
+
+    # Stop sending to downstreams that keep failing, for a while (see
+    # BreakerConfig). Off by default.
+    circuit_breaker: Optional[BreakerConfig]
+
+    # Per-downstream-host request limits (see LimitConfig), keyed by any URL
+    # on the host, or "*" for hosts that aren't listed. Off by default.
+    downstream_limits: Optional[Dict[str, LimitConfig]]
+
+    # Run the fan-out once per webhook, giving Twilio's retries of it the
+    # same reply (see DedupeConfig). Off by default.
+    dedupe: Optional[DedupeConfig]
+
+    @validator("engine")
+    def engine_must_be_known(cls, v):
+        if v not in ("threads", "asyncio"):
+            raise ValueError('engine must be "threads" or "asyncio"')
+
+        return v
+
+    @validator("max_concurrency")
+    def max_concurrency_must_be_positive(cls, v):
+        if v is not None and v < 1:
+            raise ValueError("max_concurrency must be >= 1")
+
+        return v
+
+    @validator("downstream_limits")
+    def downstream_limits_must_be_keyed_by_url(cls, v):
+        for key in v or {}:
+            if key != "*" and not url_regex.fullmatch(key):
+                raise ValueError(f'downstream_limits keys must be URLs or "*": {key}')
+
+        return v
+
+    @validator("rules")
+    def rules_must_be_valid(cls, rules, values, **kwargs):
+        names = [rule.name for rule in rules]
+        if len(set(names)) != len(names):
+            raise ValueError("Rule names must be unique")
+
+        keywords = values.get("keywords", {})
+        for name in names:
+            if name in keywords:
+                raise ValueError(f"Rule {name} has the same name as a keyword")
+
+        # Unknown keywords and regexes that don't combine are caught when the
+        # rule index is built, once (see __init__())
+        return rules
+
     @validator("keywords")
     def normalize_keywords(cls, keywords):
-        return {k.lower().strip(): v for k, v in keywords.items()}
+        normalized = {k.lower().strip(): v for k, v in keywords.items()}
+        if len(normalized) != len(keywords):
+            raise ValueError("Keywords must be unique (ignoring case and spaces)")
+
+        # Raises if any keywords or alternates conflict
+        build_route_index(normalized)
+
+        return normalized
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        try:
+            self.build_indexes()
+        except ValueError as e:
+            # Only the rule index can fail here; the keywords were checked by
+            # normalize_keywords()
+            raise ValidationError([ErrorWrapper(e, loc="rules")], type(self))
+
+    def build_indexes(self) -> None:
+        routes = MappingProxyType(build_route_index(self.keywords))
+        object.__setattr__(self, "_routes", routes)
+        object.__setattr__(self, "_fuzzy_index", build_fuzzy_index(routes))
+        object.__setattr__(self, "_rules", build_rule_index(self.rules, self.keywords))
+
+    @property
+    def routes(self) -> Mapping[str, Route]:
+        try:
+            return self._routes
+        except AttributeError:
+            # copy() doesn't go through __init__
+            self.build_indexes()
+            return self._routes
+
+    @property
+    def fuzzy_index(self) -> FuzzyIndex:
+        try:
+            return self._fuzzy_index
+        except AttributeError:
+            self.build_indexes()
+            return self._fuzzy_index
 
+    @property
+    def rule_index(self) -> RuleIndex:
+        try:
+            return self._rules
+        except AttributeError:
+            self.build_indexes()
+            return self._rules
 
+    def route(self, normalized_body: str) -> Optional[Route]:
+        # Look up the keyword route for an already-normalized message body
+        return self.routes.get(normalized_body)
+
+    def fuzzy_route(self, normalized_body: str) -> Optional[Route]:
+        # Find the keyword route within its max_edit_distance of an
+        # already-normalized message body, if there's exactly one
+        return self.fuzzy_index.match(normalized_body)
+
+    def rule_route(
+        self, normalized_body: str, fields: Mapping[str, str]
+    ) -> Optional[Route]:
+        # Find the first rule that matches a message, given its normalized
+        # body and its form fields (including the original Body)
+        return self.rule_index.match(normalized_body, fields)
+
+
+@functools.lru_cache(maxsize=16)
 def parse_config(config_env: str) -> Config:
+    # Cached, since validating the config and building its indexes is the
+    # most expensive part of starting up. The returned Config is shared, so
+    # don't modify it.
     # Base64-decode the config. We have to base64-encode because Lambda does
     # not support having commas in environment variables
     config = json.loads(base64.b64decode(config_env))
     return Config(**config)
+
+
+def parse_config_bytes(raw: bytes) -> Config:
+    # Plain JSON, or base64-encoded JSON like DOWNSTREAM_CONFIG
+    raw = raw.strip()
+    if not raw.startswith(b"{"):
+        raw = base64.b64decode(raw)
+
+    return Config(**json.loads(raw))
+
+
+def parse_config_file(path: str) -> Config:
+    # A config file, for running outside Lambda
+    with open(path, "rb") as f:
+        return parse_config_bytes(f.read())
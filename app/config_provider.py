@@ -0,0 +1,190 @@
+import abc
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Optional, Tuple
+
+from .config import Config, parse_config_bytes
+
+# How often to check the source for a new config (in seconds)
+POLL_INTERVAL = 60
+
+
+# Where a config is loaded from. fetch() returns the raw config and a version
+# tag for it (an ETag, mtime, or parameter version), or None if the version
+# is still the one we passed in.
+class ConfigSource(abc.ABC):
+    @abc.abstractmethod
+    def fetch(self, etag: Optional[str]) -> Optional[Tuple[str, bytes]]:
+        raise NotImplementedError()
+
+
+class FileSource(ConfigSource):
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch(self, etag: Optional[str]) -> Optional[Tuple[str, bytes]]:
+        stat = os.stat(self.path)
+        current = f"{stat.st_mtime_ns}-{stat.st_size}"
+        if current == etag:
+            return None
+
+        with open(self.path, "rb") as f:
+            return current, f.read()
+
+
+def is_not_modified(error: Exception) -> bool:
+    # botocore's ClientError for a 304, without importing botocore
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code") in ("304", "NotModified")
+
+
+class S3Source(ConfigSource):
+    def __init__(self, bucket: str, key: str, client: Any = None):
+        if client is None:
+            # boto3 is available on Lambda; it's only needed for this source
+            import boto3  # type: ignore
+
+            client = boto3.client("s3")
+
+        self.bucket = bucket
+        self.key = key
+        self.client = client
+
+    def fetch(self, etag: Optional[str]) -> Optional[Tuple[str, bytes]]:
+        kwargs = {"Bucket": self.bucket, "Key": self.key}
+        if etag is not None:
+            kwargs["IfNoneMatch"] = etag
+
+        try:
+            response = self.client.get_object(**kwargs)
+        except Exception as e:
+            if is_not_modified(e):
+                return None
+            raise
+
+        return response["ETag"], response["Body"].read()
+
+
+class SsmSource(ConfigSource):
+    def __init__(self, name: str, client: Any = None):
+        if client is None:
+            import boto3  # type: ignore
+
+            client = boto3.client("ssm")
+
+        self.name = name
+        self.client = client
+
+    def fetch(self, etag: Optional[str]) -> Optional[Tuple[str, bytes]]:
+        # SSM has no conditional get, but parameters are small
+        parameter = self.client.get_parameter(Name=self.name, WithDecryption=True)[
+            "Parameter"
+        ]
+        version = str(parameter["Version"])
+        if version == etag:
+            return None
+
+        return version, parameter["Value"].encode("utf-8")
+
+
+def make_source(uri: str) -> ConfigSource:
+    # "s3://bucket/key", "ssm:/parameter/name", or a file path
+    if uri.startswith("s3://"):
+        bucket, _, key = uri[len("s3://") :].partition("/")
+        return S3Source(bucket, key)
+
+    if uri.startswith("ssm:"):
+        return SsmSource(uri[len("ssm:") :])
+
+    if uri.startswith("file://"):
+        return FileSource(uri[len("file://") :])
+
+    return FileSource(uri)
+
+
+# Keeps a Config up to date with a ConfigSource. The current config is only
+# ever replaced by a fully validated one (with its indexes built), in a single
+# assignment, so readers never see a half-loaded config; if a new version
+# doesn't validate (or on_change raises), we keep the last good one.
+#
+# Reloads happen on a background thread, kicked off by maybe_refresh() at most
+# once per interval, so requests never wait on them.
+class ConfigProvider:
+    def __init__(
+        self,
+        source: ConfigSource,
+        interval: float = POLL_INTERVAL,
+        on_change: Optional[Callable[[Config], None]] = None,
+        on_error: Optional[Callable[[BaseException], None]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.source = source
+        self.interval = interval
+        self.on_change = on_change
+        self.on_error = on_error
+        self.clock = clock
+
+        self.refresh_lock = threading.Lock()
+        self.checked_at = clock()
+
+        # Load the first config synchronously; without one we can't start
+        fetched = source.fetch(None)
+        if fetched is None:
+            raise ValueError("Config source returned no config")
+
+        self.etag: Optional[str] = fetched[0]
+        self.config = parse_config_bytes(fetched[1])
+
+    def refresh(self) -> bool:
+        # Check for a new config now. Returns whether we swapped one in.
+        try:
+            fetched = self.source.fetch(self.etag)
+        except Exception as e:
+            logging.exception("Failed to fetch config; keeping the current one")
+            if self.on_error is not None:
+                self.on_error(e)
+            return False
+
+        if fetched is None:
+            return False
+
+        etag, raw = fetched
+        try:
+            config = parse_config_bytes(raw)
+            # The muxer can reject a config too (see TwilioMuxer.build_state())
+            if self.on_change is not None:
+                self.on_change(config)
+        except Exception as e:
+            # Don't try this version again
+            self.etag = etag
+            logging.exception(
+                f"Invalid config (version {etag}); keeping the current one"
+            )
+            if self.on_error is not None:
+                self.on_error(e)
+            return False
+
+        self.etag = etag
+        self.config = config
+        logging.info(f"Loaded new config (version {etag})")
+        return True
+
+    def maybe_refresh(self) -> None:
+        # Start a background refresh if one is due and none is running
+        if self.clock() - self.checked_at < self.interval:
+            return
+
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+
+        self.checked_at = self.clock()
+
+        def run() -> None:
+            try:
+                self.refresh()
+            finally:
+                self.refresh_lock.release()
+
+        threading.Thread(target=run, name="config-refresh", daemon=True).start()
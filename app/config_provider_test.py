@@ -0,0 +1,244 @@
+import base64
+import json
+
+import pytest
+import responses  # type: ignore
+
+from .config import Config
+from .config_provider import (
+    ConfigProvider,
+    ConfigSource,
+    FileSource,
+    S3Source,
+    SsmSource,
+    make_source,
+)
+from .muxer import TwilioMuxer
+from .muxer_test import MOCK_AUTH_TOKEN, MOCK_MUXER_URL, mock_response, mux_request
+
+
+def config_json(url):
+    return json.dumps(
+        {
+            "default": {"downstreams": [url], "responder": 0},
+            "keywords": {},
+        }
+    ).encode()
+
+
+class FakeSource(ConfigSource):
+    def __init__(self, raw):
+        self.version = 1
+        self.raw = raw
+        self.fetches = 0
+
+    def publish(self, raw):
+        self.version += 1
+        self.raw = raw
+
+    def fetch(self, etag):
+        self.fetches += 1
+        if str(self.version) == etag:
+            return None
+
+        return str(self.version), self.raw
+
+
+def test_refresh():
+    source = FakeSource(config_json("https://downstream1.com"))
+    changes = []
+    provider = ConfigProvider(source, on_change=changes.append)
+    assert provider.config.default.downstreams == ["https://downstream1.com"]
+
+    # Unchanged
+    assert not provider.refresh()
+    assert changes == []
+
+    # Base64-encoded configs are accepted too
+    source.publish(base64.b64encode(config_json("https://downstream2.com")))
+    assert provider.refresh()
+    assert provider.config.default.downstreams == ["https://downstream2.com"]
+    assert changes == [provider.config]
+
+
+def test_refresh_keeps_last_good_config():
+    source = FakeSource(config_json("https://downstream1.com"))
+    errors = []
+    provider = ConfigProvider(source, on_error=errors.append)
+    good = provider.config
+
+    source.publish(json.dumps({"default": {"downstreams": ["nope"]}}).encode())
+    assert not provider.refresh()
+    assert provider.config is good
+    assert len(errors) == 1
+
+    # The bad version isn't fetched and parsed again
+    assert not provider.refresh()
+    assert len(errors) == 1
+
+    def fail(etag):
+        raise IOError("unavailable")
+
+    source.fetch = fail
+    assert not provider.refresh()
+    assert provider.config is good
+    assert len(errors) == 2
+
+
+def test_maybe_refresh_interval(clock):
+    source = FakeSource(config_json("https://downstream1.com"))
+    provider = ConfigProvider(source, interval=60, clock=clock)
+    assert source.fetches == 1
+
+    provider.maybe_refresh()
+    assert source.fetches == 1
+
+    clock.now += 61
+    provider.maybe_refresh()
+    # The refresh runs in the background; wait for it
+    with provider.refresh_lock:
+        pass
+    assert source.fetches == 2
+
+
+def test_initial_config_must_be_valid():
+    with pytest.raises(ValueError):
+        ConfigProvider(FakeSource(b"{}"))
+
+
+def test_file_source(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_bytes(config_json("https://downstream1.com"))
+    source = FileSource(str(path))
+
+    etag, raw = source.fetch(None)
+    assert raw == config_json("https://downstream1.com")
+    assert source.fetch(etag) is None
+
+
+class NotModified(Exception):
+    response = {"Error": {"Code": "304"}}
+
+
+class FakeS3:
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        assert (Bucket, Key) == ("bucket", "path/config.json")
+        if IfNoneMatch == '"v1"':
+            raise NotModified()
+
+        class Body:
+            def read(self):
+                return config_json("https://downstream1.com")
+
+        return {"ETag": '"v1"', "Body": Body()}
+
+
+class FakeSsm:
+    def get_parameter(self, Name, WithDecryption):
+        assert Name == "/muxer/config"
+        return {
+            "Parameter": {
+                "Version": 3,
+                "Value": config_json("https://downstream1.com").decode(),
+            }
+        }
+
+
+def test_s3_source():
+    source = S3Source("bucket", "path/config.json", client=FakeS3())
+    etag, raw = source.fetch(None)
+    assert etag == '"v1"'
+    assert raw == config_json("https://downstream1.com")
+    assert source.fetch(etag) is None
+
+
+def test_ssm_source():
+    source = SsmSource("/muxer/config", client=FakeSsm())
+    etag, raw = source.fetch(None)
+    assert etag == "3"
+    assert raw == config_json("https://downstream1.com")
+    assert source.fetch(etag) is None
+
+
+def test_make_source(tmp_path):
+    assert isinstance(make_source(str(tmp_path / "config.json")), FileSource)
+    assert make_source("file:///etc/muxer.json").path == "/etc/muxer.json"
+
+
+@responses.activate
+def test_muxer_reload():
+    mock_response("https://downstream1.com", body="d1")
+    mock_response("https://downstream2.com", body="d2")
+
+    source = FakeSource(config_json("https://downstream1.com"))
+    provider = ConfigProvider(source)
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=provider.config,
+        config_provider=provider,
+    )
+    assert mux_request(muxer)[1] == "d1"
+
+    source.publish(config_json("https://downstream2.com"))
+    provider.refresh()
+    assert muxer.state.config is provider.config
+    assert mux_request(muxer)[1] == "d2"
+
+
+@responses.activate
+def test_muxer_reload_mid_request():
+    mock_response("https://downstream1.com", body="d1")
+    mock_response("https://downstream2.com", body="d2")
+
+    config = json.loads(config_json("https://downstream1.com"))
+    config["default"]["downstreams"].append("https://downstream2.com")
+    config["circuit_breaker"] = {}
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(**config),
+    )
+    started_with = muxer.state
+
+    # A reload (dropping the breakers) lands between the two downstream
+    # requests; the second is still sent with the state the request started
+    # with
+    engine = muxer.engine
+
+    class ReloadingEngine:
+        def submit(self, url, *args):
+            if url == "https://downstream1.com":
+                muxer.set_config(Config(**json.loads(config_json(url))))
+            return engine.submit(url, *args)
+
+    muxer.engine = ReloadingEngine()
+    assert mux_request(muxer)[1] == "d1"
+
+    assert muxer.state.breakers is None
+    assert set(started_with.breakers.states()) == {
+        "https://downstream1.com",
+        "https://downstream2.com",
+    }
+
+
+def test_muxer_rejects_reload():
+    source = FakeSource(config_json("https://downstream1.com"))
+    errors = []
+    provider = ConfigProvider(source, on_error=errors.append)
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=provider.config,
+        config_provider=provider,
+    )
+    started_with = muxer.state
+
+    # Valid on its own, but this muxer has nowhere to queue deliveries
+    config = json.loads(config_json("https://downstream2.com"))
+    config["respond_early"] = True
+    source.publish(json.dumps(config).encode())
+    assert not provider.refresh()
+    assert muxer.state is started_with
+    assert provider.config is started_with.config
+    assert len(errors) == 1
@@ -4,7 +4,7 @@ import json
 import pytest
 from pydantic import ValidationError
 
-from .config import Config, KeywordConfig, parse_config
+from .config import Config, KeywordConfig, Route, normalize_body, parse_config
 
 
 def test_valid_config():
@@ -174,3 +174,262 @@ def test_invalid_url():
                 ).encode()
             )
         )
+
+
+def test_invalid_timeout():
+    with pytest.raises(ValidationError):
+        KeywordConfig(downstreams=["http://a.com"], responder=0, read_timeout=0)
+
+    assert (
+        KeywordConfig(
+            downstreams=["http://a.com"], responder=0, connect_timeout=1.5
+        ).connect_timeout
+        == 1.5
+    )
+
+
+def test_route_index():
+    stop = KeywordConfig(
+        downstreams=["http://c.com"],
+        responder=None,
+        alternates=["Stip!", "stop   texting me"],
+    )
+    help = KeywordConfig(downstreams=["http://d.com"], responder=0)
+    config = Config(
+        default=KeywordConfig(downstreams=["http://a.com"], responder=0),
+        keywords={" STOP ": stop, "help": help},
+    )
+
+    assert dict(config.routes) == {
+        "stop": Route("stop", stop),
+        "stip": Route("stop", stop),
+        "stop texting me": Route("stop", stop),
+        "help": Route("help", help),
+    }
+    assert config.route("stip") == Route("stop", stop)
+    assert config.route("something else") is None
+
+    # The index can't be modified
+    with pytest.raises(TypeError):
+        config.routes["foo"] = Route("help", help)  # type: ignore
+
+    # ...and survives copying
+    assert config.copy().route("help") == Route("help", help)
+
+
+def test_conflicting_alternates():
+    # An alternate of another keyword
+    with pytest.raises(ValidationError):
+        Config(
+            default=KeywordConfig(downstreams=["http://a.com"], responder=0),
+            keywords={
+                "stop": KeywordConfig(
+                    downstreams=["http://c.com"], responder=0, alternates=["help!"]
+                ),
+                "help": KeywordConfig(downstreams=["http://c.com"], responder=0),
+            },
+        )
+
+    # The same alternate under two keywords
+    with pytest.raises(ValidationError):
+        Config(
+            default=KeywordConfig(downstreams=["http://a.com"], responder=0),
+            keywords={
+                "stop": KeywordConfig(
+                    downstreams=["http://c.com"], responder=0, alternates=["quit"]
+                ),
+                "end": KeywordConfig(
+                    downstreams=["http://c.com"], responder=0, alternates=["QUIT"]
+                ),
+            },
+        )
+
+    # The same alternate twice (after normalization)
+    with pytest.raises(ValidationError):
+        Config(
+            default=KeywordConfig(downstreams=["http://a.com"], responder=0),
+            keywords={
+                "stop": KeywordConfig(
+                    downstreams=["http://c.com"],
+                    responder=0,
+                    alternates=["stip", "stip."],
+                ),
+            },
+        )
+
+    # An alternate that matches empty messages
+    with pytest.raises(ValidationError):
+        Config(
+            default=KeywordConfig(downstreams=["http://a.com"], responder=0),
+            keywords={
+                "stop": KeywordConfig(
+                    downstreams=["http://c.com"], responder=0, alternates=["!!"]
+                ),
+            },
+        )
+
+    # Two keywords that only differ by case
+    with pytest.raises(ValidationError):
+        Config(
+            default=KeywordConfig(downstreams=["http://a.com"], responder=0),
+            keywords={
+                "stop": KeywordConfig(downstreams=["http://c.com"], responder=0),
+                "STOP": KeywordConfig(downstreams=["http://c.com"], responder=0),
+            },
+        )
+
+
+def test_parse_config_is_cached():
+    config_env = base64.b64encode(
+        json.dumps(
+            {
+                "default": {"downstreams": ["http://a.com"], "responder": 0},
+                "keywords": {},
+            }
+        ).encode()
+    )
+
+    assert parse_config(config_env) is parse_config(config_env)
+
+
+def test_invalid_circuit_breaker():
+    default = KeywordConfig(downstreams=["http://a.com"], responder=0)
+
+    for breaker in ({"min_requests": 0}, {"failure_ratio": 0}, {"window": -1}):
+        with pytest.raises(ValidationError):
+            Config(default=default, keywords={}, circuit_breaker=breaker)
+
+    config = Config(default=default, keywords={}, circuit_breaker={})
+    assert config.circuit_breaker.failure_ratio == 0.5
+    assert Config(default=default, keywords={}).circuit_breaker is None
+
+
+def test_invalid_fallback_responders():
+    downstreams = ["http://a.com", "http://b.com"]
+
+    for responder, fallbacks in ((None, [1]), (0, [0]), (0, [1, 1]), (0, [2])):
+        with pytest.raises(ValidationError):
+            KeywordConfig(
+                downstreams=downstreams,
+                responder=responder,
+                fallback_responders=fallbacks,
+            )
+
+    with pytest.raises(ValidationError):
+        KeywordConfig(downstreams=downstreams, responder=0, hedge_percentile=100)
+
+    config = KeywordConfig(
+        downstreams=downstreams, responder=1, fallback_responders=[0]
+    )
+    assert config.responders == [1, 0]
+    assert KeywordConfig(downstreams=downstreams, responder=None).responders == []
+
+
+def test_invalid_cache():
+    for responder, cache in ((None, {"ttl": 60}), (0, {"ttl": 0}), (0, {})):
+        with pytest.raises(ValidationError):
+            KeywordConfig(
+                downstreams=["http://a.com"], responder=responder, cache=cache
+            )
+
+    config = KeywordConfig(downstreams=["http://a.com"], responder=0, cache={"ttl": 5})
+    assert config.cache.max_entries == 128
+
+
+def test_invalid_downstream_limits():
+    default = KeywordConfig(downstreams=["http://a.com"], responder=0)
+
+    for limits in (
+        {"not a url": {"max_in_flight": 1}},
+        {"*": {"max_in_flight": 0}},
+        {"*": {"rate": 0}},
+        {"*": {"adaptive": True}},
+        {"*": {"max_in_flight": 2, "min_in_flight": 3}},
+    ):
+        with pytest.raises(ValidationError):
+            Config(default=default, keywords={}, downstream_limits=limits)
+
+    config = Config(
+        default=default,
+        keywords={},
+        downstream_limits={"http://a.com": {"max_in_flight": 4, "adaptive": True}},
+    )
+    assert config.downstream_limits["http://a.com"].min_in_flight == 1
+
+
+def test_invalid_dedupe():
+    default = KeywordConfig(downstreams=["http://a.com"], responder=0)
+
+    for dedupe in ({"ttl": 0}, {"max_entries": 0}):
+        with pytest.raises(ValidationError):
+            Config(default=default, keywords={}, dedupe=dedupe)
+
+    assert Config(default=default, keywords={}, dedupe={}).dedupe.ttl == 600
+
+
+def test_rules():
+    default = KeywordConfig(downstreams=["http://default.com"], responder=0)
+    stop = KeywordConfig(downstreams=["http://stop.com"], responder=0)
+    config = Config(
+        default=default,
+        keywords={"STOP": stop},
+        rules=[
+            {
+                "name": "campaign",
+                "prefix": "Join,",
+                "fields": {"To": ["+15550001111"]},
+                "route": {"downstreams": ["http://campaign.com"], "responder": 0},
+            },
+            {
+                "name": "unsubscribe",
+                "regex": r"\bunsubscribe\b",
+                "keyword": "stop",
+            },
+            {
+                "name": "second number",
+                "fields": {"To": ["+15550002222", "+15550003333"]},
+                "route": {"downstreams": ["http://second.com"], "responder": None},
+            },
+        ],
+    )
+
+    def rule_route(body, **fields):
+        route = config.rule_route(normalize_body(body), {"Body": body, **fields})
+        return route.rule if route is not None else None
+
+    assert rule_route("join now", To="+15550001111") == "campaign"
+    assert rule_route("JOIN", To="+15550001111") == "campaign"
+    # Every condition must hold
+    assert rule_route("join now", To="+15550009999") is None
+    assert rule_route("hi", To="+15550001111") is None
+
+    assert rule_route("please UNSUBSCRIBE me") == "unsubscribe"
+    assert config.rule_route("unsubscribe", {"Body": "unsubscribe"}) == Route(
+        "stop", config.keywords["stop"], "unsubscribe"
+    )
+
+    assert rule_route("hi", To="+15550003333") == "second number"
+    # The first matching rule wins
+    assert rule_route("unsubscribe", To="+15550003333") == "unsubscribe"
+
+
+def test_invalid_rules():
+    default = KeywordConfig(downstreams=["http://a.com"], responder=0)
+    route = {"downstreams": ["http://b.com"], "responder": 0}
+
+    for rules in (
+        [{"name": "a"}],
+        [{"name": "a", "keyword": "stop", "route": route}],
+        [{"name": "a", "keyword": "nope"}],
+        [{"name": "a", "regex": "(", "route": route}],
+        [{"name": "a", "regex": r"(a)\1", "route": route}],
+        [{"name": "a", "prefix": "!", "route": route}],
+        [{"name": "a", "route": route}, {"name": "a", "route": route}],
+        [{"name": "stop", "route": route}],
+    ):
+        with pytest.raises(ValidationError):
+            Config(
+                default=default,
+                keywords={"stop": KeywordConfig(downstreams=[], responder=None)},
+                rules=rules,
+            )
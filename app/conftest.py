@@ -0,0 +1,16 @@
+import pytest
+
+
+# A clock for the time-based tests (breakers, caches, limits, dedupe and
+# config reloads) that only moves when the test sets its `now`
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,387 @@
+import abc
+import collections
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, OrderedDict, Tuple
+
+from .cache import Reply
+
+# How long a shared store keeps a claim on a webhook whose fan-out hasn't
+# finished (in seconds). If the container handling it dies, retries can run
+# it again after this.
+CLAIM_TTL = 30
+
+# How often to check a shared store for the reply to a webhook another
+# container is handling (in seconds)
+POLL_INTERVAL = 0.1
+
+# What a retry gets if the webhook it duplicates is still being handled when
+# it runs out of time, so that Twilio tries again later
+IN_PROGRESS_REPLY: Reply = (
+    500,
+    "<Response></Response>",
+    {"Content-Type": "application/xml"},
+)
+
+
+def dedupe_key(headers: Dict[str, str], params: Dict[str, str]) -> Optional[str]:
+    # Twilio sends the same idempotency token and MessageSid with every retry
+    # of a webhook. None if the webhook has neither.
+    token = next(
+        (v for k, v in headers.items() if k.lower() == "i-twilio-idempotency-token"),
+        "",
+    )
+    sid = params.get("MessageSid") or params.get("SmsSid") or ""
+    if not token and not sid:
+        return None
+
+    return f"{token}:{sid}"
+
+
+def is_final(reply: Reply) -> bool:
+    # Whether a retry should get this reply too. After a server error, a
+    # retry runs the fan-out again.
+    return reply[0] < 500
+
+
+# Webhooks we're handling or have recently handled in this process: a future
+# for each one's reply, for ttl seconds after it arrived, keeping the
+# max_entries most recent.
+class DedupeTable:
+    def __init__(
+        self,
+        ttl: float,
+        max_entries: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+
+        self.entries: OrderedDict[str, Tuple[float, concurrent.futures.Future]] = (
+            collections.OrderedDict()
+        )
+        self.lock = threading.Lock()
+
+    def claim(self, key: str) -> Tuple[concurrent.futures.Future, bool]:
+        # The future for the webhook's reply, and whether it's new (in which
+        # case the caller must finish() it)
+        with self.lock:
+            now = self.clock()
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                return entry[1], False
+
+            future: concurrent.futures.Future = concurrent.futures.Future()
+            future.set_running_or_notify_cancel()
+            self.entries[key] = (now, future)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+            return future, True
+
+    def finish(
+        self,
+        key: str,
+        future: concurrent.futures.Future,
+        reply: Optional[Reply] = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        # Hand the reply (or error) to any retries waiting on it. Only final
+        # replies are kept for later retries.
+        if error is not None or reply is None or not is_final(reply):
+            self.forget(key, future)
+
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(reply)
+
+    def forget(self, key: str, future: concurrent.futures.Future) -> None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is future:
+                del self.entries[key]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+# Webhooks being handled or recently handled by any container, so retries
+# that land on a different container are deduped too. claim() atomically
+# records that we're handling a webhook, unless someone else already is.
+class DedupeStore(abc.ABC):
+    @abc.abstractmethod
+    def claim(self, key: str, ttl: float) -> Tuple[bool, Optional[Reply]]:
+        # Whether we claimed it, and if not, its reply (None if it's still
+        # being handled)
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Tuple[bool, Optional[Reply]]:
+        # Whether anyone has claimed it, and its reply if there is one yet
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def complete(self, key: str, reply: Reply, ttl: float) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def release(self, key: str) -> None:
+        # Give up a claim, so the next retry runs the fan-out again
+        raise NotImplementedError()
+
+
+def encode_reply(reply: Reply) -> str:
+    return json.dumps(list(reply))
+
+
+def decode_reply(encoded: Optional[str]) -> Optional[Reply]:
+    if encoded is None:
+        return None
+
+    status_code, body, headers = json.loads(encoded)
+    return status_code, body, headers
+
+
+# Stores claims in a SQLite database, e.g. to share them between the worker
+# processes of a server on one host
+class SqliteDedupeStore(DedupeStore):
+    def __init__(self, path: str = ":memory:"):
+        # Imported here to keep it off the handler's cold-start path
+        import sqlite3
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS webhooks ("
+            "  key TEXT PRIMARY KEY,"
+            "  reply TEXT,"
+            "  expires_at REAL NOT NULL"
+            ")"
+        )
+
+    def claim(self, key: str, ttl: float) -> Tuple[bool, Optional[Reply]]:
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT reply FROM webhooks WHERE key = ? AND expires_at > ?",
+                    (key, now),
+                ).fetchone()
+                if row is None:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO webhooks (key, reply, expires_at) "
+                        "VALUES (?, NULL, ?)",
+                        (key, now + ttl),
+                    )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return True, None
+
+        return False, decode_reply(row[0])
+
+    def get(self, key: str) -> Tuple[bool, Optional[Reply]]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT reply FROM webhooks WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+
+        if row is None:
+            return False, None
+
+        return True, decode_reply(row[0])
+
+    def complete(self, key: str, reply: Reply, ttl: float) -> None:
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO webhooks (key, reply, expires_at) "
+                "VALUES (?, ?, ?)",
+                (key, encode_reply(reply), time.time() + ttl),
+            )
+
+    def release(self, key: str) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM webhooks WHERE key = ?", (key,))
+
+
+def error_code(error: Exception) -> Optional[str]:
+    # The error code of a botocore ClientError, without importing botocore
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code")
+
+
+# Stores claims in a DynamoDB table with a string partition key named "key".
+# Turn on the table's TTL on the "expires_at" attribute to clean up old
+# items; until they're deleted, expired items are ignored.
+class DynamoDedupeStore(DedupeStore):
+    def __init__(self, table: str, client: Any = None):
+        if client is None:
+            # boto3 is available on Lambda; it's only needed for this backend
+            import boto3  # type: ignore
+
+            client = boto3.client("dynamodb")
+
+        self.table = table
+        self.client = client
+
+    def claim(self, key: str, ttl: float) -> Tuple[bool, Optional[Reply]]:
+        now = time.time()
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={"key": {"S": key}, "expires_at": {"N": str(int(now + ttl))}},
+                ConditionExpression="attribute_not_exists(#key) OR expires_at < :now",
+                ExpressionAttributeNames={"#key": "key"},
+                ExpressionAttributeValues={":now": {"N": str(int(now))}},
+            )
+        except Exception as e:
+            if error_code(e) != "ConditionalCheckFailedException":
+                raise
+
+            return False, self.get(key)[1]
+
+        return True, None
+
+    def get(self, key: str) -> Tuple[bool, Optional[Reply]]:
+        item = self.client.get_item(
+            TableName=self.table, Key={"key": {"S": key}}, ConsistentRead=True
+        ).get("Item")
+        if item is None or int(item["expires_at"]["N"]) < time.time():
+            return False, None
+
+        return True, decode_reply(item.get("reply", {}).get("S"))
+
+    def complete(self, key: str, reply: Reply, ttl: float) -> None:
+        self.client.put_item(
+            TableName=self.table,
+            Item={
+                "key": {"S": key},
+                "reply": {"S": encode_reply(reply)},
+                "expires_at": {"N": str(int(time.time() + ttl))},
+            },
+        )
+
+    def release(self, key: str) -> None:
+        self.client.delete_item(TableName=self.table, Key={"key": {"S": key}})
+
+
+def make_store(store: Optional[str]) -> Optional[DedupeStore]:
+    # "sqlite:///path/to/db" or "dynamodb://table-name"
+    if not store:
+        return None
+
+    if store.startswith("sqlite://"):
+        return SqliteDedupeStore(store[len("sqlite://") :])
+
+    if store.startswith("dynamodb://"):
+        return DynamoDedupeStore(store[len("dynamodb://") :])
+
+    raise ValueError(f"Unknown dedupe store: {store}")
+
+
+# Runs the fan-out for each webhook at most once (per ttl), giving retries of
+# it the same reply: a retry that arrives while the fan-out is still running
+# waits for it, and one that arrives after gets the reply straight away. With
+# a shared store, this works across containers too, by polling the store for
+# the reply. A problem with the store never stops a webhook from being handled;
+# at worst it's handled twice.
+class Deduper:
+    def __init__(
+        self,
+        ttl: float,
+        max_entries: int,
+        store: Optional[DedupeStore] = None,
+        on_error: Optional[Callable[[BaseException], None]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.table = DedupeTable(ttl, max_entries, clock)
+        self.store = store
+        self.on_error = on_error
+        self.clock = clock
+
+    def run(
+        self, key: str, timeout: float, fan_out: Callable[[], Reply]
+    ) -> Tuple[Reply, Optional[str]]:
+        # The reply to the webhook, and how it was deduped: "attached" (to a
+        # fan-out in progress), "replayed" (an earlier reply), or None if we
+        # ran the fan-out
+        future, new = self.table.claim(key)
+        if not new:
+            how = "replayed" if future.done() else "attached"
+            try:
+                return future.result(timeout=timeout), how
+            except concurrent.futures.TimeoutError:
+                return IN_PROGRESS_REPLY, how
+
+        store = self.store
+        if store is not None:
+            claimed, reply = self.try_store(lambda: store.claim(key, CLAIM_TTL))
+            if not claimed:
+                if reply is None:
+                    reply = self.poll(key, timeout)
+                if reply is None:
+                    self.table.forget(key, future)
+                    future.set_result(IN_PROGRESS_REPLY)
+                    return IN_PROGRESS_REPLY, "attached"
+
+                self.table.finish(key, future, reply)
+                return reply, "replayed"
+
+        try:
+            reply = fan_out()
+        except BaseException as e:
+            self.table.finish(key, future, error=e)
+            self.release(key)
+            raise
+
+        self.table.finish(key, future, reply)
+        if store is not None:
+            if is_final(reply):
+                self.try_store(lambda: store.complete(key, reply, self.ttl))
+            else:
+                self.release(key)
+
+        return reply, None
+
+    def poll(self, key: str, timeout: float) -> Optional[Reply]:
+        # Wait for another container's reply. If it gives up its claim we
+        # stop waiting, and Twilio's next retry runs the fan-out.
+        store = self.store
+        assert store is not None
+        give_up_at = self.clock() + timeout
+        while self.clock() < give_up_at:
+            time.sleep(min(POLL_INTERVAL, max(give_up_at - self.clock(), 0)))
+            claimed, reply = self.try_store(lambda: store.get(key))
+            if reply is not None or not claimed:
+                return reply
+
+        return None
+
+    def release(self, key: str) -> None:
+        store = self.store
+        if store is not None:
+            self.try_store(lambda: store.release(key))
+
+    def try_store(self, call: Callable[[], Any]) -> Any:
+        # Returns (True, None) if the store fails, as if we'd claimed the
+        # webhook
+        try:
+            return call()
+        except Exception as e:
+            logging.exception("Dedupe store failed")
+            if self.on_error is not None:
+                self.on_error(e)
+            return True, None
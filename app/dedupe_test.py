@@ -0,0 +1,211 @@
+import threading
+
+import pytest
+
+from .dedupe import (
+    IN_PROGRESS_REPLY,
+    Deduper,
+    DedupeTable,
+    DynamoDedupeStore,
+    SqliteDedupeStore,
+    dedupe_key,
+    make_store,
+)
+
+REPLY = (200, "<Response>hi</Response>", {"Content-Type": "application/xml"})
+ERROR_REPLY = (500, "<Response></Response>", {"Content-Type": "application/xml"})
+
+
+def test_dedupe_key():
+    assert dedupe_key({"I-Twilio-Idempotency-Token": "t"}, {"MessageSid": "SM1"}) == (
+        "t:SM1"
+    )
+    assert dedupe_key({"i-twilio-idempotency-token": "t"}, {}) == "t:"
+    assert dedupe_key({}, {"SmsSid": "SM1"}) == ":SM1"
+    assert dedupe_key({}, {"Body": "hi"}) is None
+
+
+def test_table(clock):
+    table = DedupeTable(ttl=60, max_entries=2, clock=clock)
+
+    future, new = table.claim("a")
+    assert new
+    assert table.claim("a") == (future, False)
+
+    table.finish("a", future, REPLY)
+    assert table.claim("a")[0].result() == REPLY
+
+    # Expired
+    clock.now += 60
+    assert table.claim("a")[1]
+
+    # Bounded
+    table.claim("b")
+    table.claim("c")
+    assert len(table) == 2
+    assert table.claim("a")[1]
+
+
+def test_table_forgets_errors():
+    table = DedupeTable(ttl=60, max_entries=10)
+
+    future, _ = table.claim("a")
+    table.finish("a", future, ERROR_REPLY)
+    assert future.result() == ERROR_REPLY
+    assert table.claim("a")[1]
+
+    future, _ = table.claim("b")
+    table.finish("b", future, error=RuntimeError())
+    with pytest.raises(RuntimeError):
+        future.result()
+    assert table.claim("b")[1]
+
+
+def test_deduper_replays():
+    deduper = Deduper(ttl=60, max_entries=10)
+    calls = []
+
+    def fan_out():
+        calls.append(1)
+        return REPLY
+
+    assert deduper.run("a", 1, fan_out) == (REPLY, None)
+    assert deduper.run("a", 1, fan_out) == (REPLY, "replayed")
+    assert deduper.run("b", 1, fan_out) == (REPLY, None)
+    assert len(calls) == 2
+
+
+def test_deduper_attaches():
+    deduper = Deduper(ttl=60, max_entries=10)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_fan_out():
+        started.set()
+        assert release.wait(5)
+        return REPLY
+
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(deduper.run("a", 5, slow_fan_out))
+    )
+    thread.start()
+    assert started.wait(5)
+
+    # A retry that runs out of time gets a 500, so Twilio tries again
+    assert deduper.run("a", 0.01, slow_fan_out) == (IN_PROGRESS_REPLY, "attached")
+
+    def attach():
+        results.append(deduper.run("a", 5, slow_fan_out))
+
+    attached = threading.Thread(target=attach)
+    attached.start()
+    release.set()
+    thread.join()
+    attached.join()
+    assert sorted(results, key=str) == [(REPLY, "attached"), (REPLY, None)]
+
+
+def test_deduper_shared_store():
+    store = SqliteDedupeStore()
+    calls = []
+
+    def fan_out():
+        calls.append(1)
+        return REPLY
+
+    # Two containers sharing a store
+    Deduper(ttl=60, max_entries=10, store=store).run("a", 1, fan_out)
+    assert Deduper(ttl=60, max_entries=10, store=store).run("a", 1, fan_out) == (
+        REPLY,
+        "replayed",
+    )
+    assert len(calls) == 1
+
+    # Still in progress elsewhere
+    store.claim("b", 30)
+    assert Deduper(ttl=60, max_entries=10, store=store).run("b", 0.2, fan_out) == (
+        IN_PROGRESS_REPLY,
+        "attached",
+    )
+    assert len(calls) == 1
+
+    # Server errors are retried
+    Deduper(ttl=60, max_entries=10, store=store).run("c", 1, lambda: ERROR_REPLY)
+    assert store.get("c") == (False, None)
+
+
+def test_deduper_store_errors():
+    class BrokenStore(SqliteDedupeStore):
+        def claim(self, key, ttl):
+            raise IOError("unavailable")
+
+    errors = []
+    deduper = Deduper(
+        ttl=60, max_entries=10, store=BrokenStore(), on_error=errors.append
+    )
+
+    # We handle the webhook anyway
+    assert deduper.run("a", 1, lambda: REPLY) == (REPLY, None)
+    assert len(errors) == 1
+
+
+def test_sqlite_store():
+    store = SqliteDedupeStore()
+    assert store.claim("a", 30) == (True, None)
+    assert store.claim("a", 30) == (False, None)
+    assert store.get("a") == (True, None)
+
+    store.complete("a", REPLY, 60)
+    assert store.claim("a", 30) == (False, REPLY)
+
+    store.release("a")
+    assert store.claim("a", 30) == (True, None)
+
+    # Expired claims can be taken over
+    assert store.claim("b", -1) == (True, None)
+    assert store.claim("b", 30) == (True, None)
+
+
+class ConditionalCheckFailed(Exception):
+    response = {"Error": {"Code": "ConditionalCheckFailedException"}}
+
+
+class FakeDynamo:
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, TableName, Item, **kwargs):
+        key = Item["key"]["S"]
+        if "ConditionExpression" in kwargs and key in self.items:
+            now = int(kwargs["ExpressionAttributeValues"][":now"]["N"])
+            if int(self.items[key]["expires_at"]["N"]) >= now:
+                raise ConditionalCheckFailed()
+        self.items[key] = Item
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        item = self.items.get(Key["key"]["S"])
+        return {"Item": item} if item is not None else {}
+
+    def delete_item(self, TableName, Key):
+        self.items.pop(Key["key"]["S"], None)
+
+
+def test_dynamo_store():
+    store = DynamoDedupeStore("webhooks", client=FakeDynamo())
+    assert store.claim("a", 30) == (True, None)
+    assert store.claim("a", 30) == (False, None)
+
+    store.complete("a", REPLY, 60)
+    assert store.claim("a", 30) == (False, REPLY)
+    assert store.get("a") == (True, REPLY)
+
+    store.release("a")
+    assert store.get("a") == (False, None)
+
+
+def test_make_store():
+    assert make_store(None) is None
+    assert isinstance(make_store("sqlite://:memory:"), SqliteDedupeStore)
+    with pytest.raises(ValueError):
+        make_store("redis://localhost")
@@ -0,0 +1,314 @@
+import abc
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .engines import Engine
+from .signing import Signer, canonicalize_params
+
+# How long a job handed out by get_batch() is hidden from other consumers
+# before it's assumed lost and handed out again (in seconds)
+VISIBILITY_TIMEOUT = 60
+
+# Exponential backoff between redelivery attempts (in seconds)
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 15 * 60
+
+# Give up on a delivery after this many attempts
+MAX_ATTEMPTS = 10
+
+
+# A single downstream delivery that still needs to happen. We store the
+# params and headers rather than the signed request, and sign it again when
+# it's sent.
+class DeliveryJob(BaseModel):
+    url: str
+    params: Dict[str, str]
+
+    # The headers we preserve from the inbound request (see PRESERVE_HEADERS),
+    # including Twilio's idempotency token, so downstreams can dedupe
+    headers: Dict[str, str]
+
+    # How many times we've tried to send this
+    attempts: int = 0
+
+    # Which tenant's auth token to sign it with (see tenants.py), if it's not
+    # for the deployment's own account
+    tenant: Optional[str] = None
+
+
+# Returns the signer for a tenant's jobs (see DeliveryJob.tenant)
+TenantSigners = Callable[[str], Signer]
+
+
+# A durable queue of delivery jobs. get_batch() hands out due jobs with a
+# receipt; each must then be either ack()ed (done, or given up on) or
+# retry()ed with a delay. Jobs that are neither come back after
+# VISIBILITY_TIMEOUT.
+class DeliveryQueue(abc.ABC):
+    @abc.abstractmethod
+    def put(self, job: DeliveryJob, delay: float = 0) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def get_batch(self, max_jobs: int) -> List[Tuple[str, DeliveryJob]]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def ack(self, receipt: str) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def retry(self, receipt: str, job: DeliveryJob, delay: float) -> None:
+        raise NotImplementedError()
+
+
+# Stores jobs in a SQLite database; use ":memory:" for an in-process queue
+class SqliteDeliveryQueue(DeliveryQueue):
+    def __init__(self, path: str = ":memory:"):
+        # Imported here to keep it off the handler's cold-start path
+        import sqlite3
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "  job TEXT NOT NULL,"
+            "  visible_at REAL NOT NULL"
+            ")"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_visible_at ON jobs (visible_at)"
+        )
+
+    def put(self, job: DeliveryJob, delay: float = 0) -> None:
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO jobs (job, visible_at) VALUES (?, ?)",
+                (job.json(), time.time() + delay),
+            )
+
+    def get_batch(self, max_jobs: int) -> List[Tuple[str, DeliveryJob]]:
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute(
+                    "SELECT id, job FROM jobs WHERE visible_at <= ? "
+                    "ORDER BY visible_at LIMIT ?",
+                    (now, max_jobs),
+                ).fetchall()
+                self.db.executemany(
+                    "UPDATE jobs SET visible_at = ? WHERE id = ?",
+                    [(now + VISIBILITY_TIMEOUT, row[0]) for row in rows],
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+        return [(str(row[0]), DeliveryJob.parse_raw(row[1])) for row in rows]
+
+    def ack(self, receipt: str) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (int(receipt),))
+
+    def retry(self, receipt: str, job: DeliveryJob, delay: float) -> None:
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET job = ?, visible_at = ? WHERE id = ?",
+                (job.json(), time.time() + delay, int(receipt)),
+            )
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+
+# Stores jobs in an SQS queue
+class SqsDeliveryQueue(DeliveryQueue):
+    # SQS's limits on DelaySeconds and on messages per receive
+    MAX_DELAY = 15 * 60
+    MAX_BATCH = 10
+
+    def __init__(self, queue_url: str, client: Any = None):
+        if client is None:
+            # boto3 is available on Lambda; it's only needed for this backend
+            import boto3  # type: ignore
+
+            client = boto3.client("sqs")
+
+        self.queue_url = queue_url
+        self.client = client
+
+    def put(self, job: DeliveryJob, delay: float = 0) -> None:
+        self.client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=job.json(),
+            DelaySeconds=int(min(delay, self.MAX_DELAY)),
+        )
+
+    def get_batch(self, max_jobs: int) -> List[Tuple[str, DeliveryJob]]:
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max(1, min(max_jobs, self.MAX_BATCH)),
+            VisibilityTimeout=VISIBILITY_TIMEOUT,
+            WaitTimeSeconds=0,
+        )
+        return [
+            (message["ReceiptHandle"], DeliveryJob.parse_raw(message["Body"]))
+            for message in response.get("Messages", [])
+        ]
+
+    def ack(self, receipt: str) -> None:
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+    def retry(self, receipt: str, job: DeliveryJob, delay: float) -> None:
+        # SQS messages can't be modified, so replace it with the updated job
+        self.put(job, delay)
+        self.ack(receipt)
+
+
+def make_queue(queue: Optional[str]) -> Optional[DeliveryQueue]:
+    # "sqlite:///path/to/db", "sqlite://:memory:" or an SQS queue URL
+    if not queue:
+        return None
+
+    if queue.startswith("sqlite://"):
+        return SqliteDeliveryQueue(queue[len("sqlite://") :])
+
+    if queue.startswith("https://sqs.") or queue.startswith("https://queue."):
+        return SqsDeliveryQueue(queue)
+
+    raise ValueError(f"Unknown delivery queue: {queue}")
+
+
+def is_retryable_status(status_code: int) -> bool:
+    # Server errors, timeouts and rate limiting are worth retrying; other
+    # client errors will just fail again
+    return status_code >= 500 or status_code in (408, 429)
+
+
+def backoff_delay(attempts: int, rng: Any = random) -> float:
+    # Exponential backoff with full jitter, so a downstream that comes back
+    # up isn't hit by every queued delivery at once
+    return rng.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempts))
+
+
+class RedeliveryStats(NamedTuple):
+    delivered: int
+    retried: int
+    abandoned: int
+
+
+def send_jobs(
+    jobs: List[DeliveryJob],
+    signer: Signer,
+    engine: Engine,
+    timeout: Tuple[float, float],
+    tenant_signers: Optional[TenantSigners] = None,
+) -> List[Optional[int]]:
+    # Send jobs concurrently, re-signing each for its URL (with its tenant's
+    # signer, if it has one), and return each one's status code (None if the
+    # request failed)
+    def on_complete(
+        response: Any, error: Optional[BaseException], timings: Dict[str, float]
+    ) -> Optional[int]:
+        return None if error is not None else response.status_code
+
+    futures = []
+    for job in jobs:
+        job_signer = signer
+        if job.tenant is not None and tenant_signers is not None:
+            job_signer = tenant_signers(job.tenant)
+
+        headers = dict(job.headers)
+        headers["X-Twilio-Signature"] = job_signer.sign(
+            job.url, canonicalize_params(job.params)
+        )
+        futures.append(
+            engine.submit(job.url, job.params, headers, timeout, on_complete)
+        )
+
+    concurrent.futures.wait(futures)
+    return [future.result() for future in futures]
+
+
+def settle(job: DeliveryJob, status_code: Optional[int]) -> str:
+    # Count an attempt at job, and decide what happens to it next:
+    # "delivered", "retried" (it should be tried again later) or "abandoned"
+    job.attempts += 1
+
+    if status_code is not None and not is_retryable_status(status_code):
+        if status_code >= 400:
+            logging.error(
+                f"Giving up on delivery to {job.url}: status code {status_code}"
+            )
+            return "abandoned"
+        return "delivered"
+
+    if job.attempts >= MAX_ATTEMPTS:
+        logging.error(
+            f"Giving up on delivery to {job.url} after {job.attempts} attempts"
+        )
+        return "abandoned"
+
+    return "retried"
+
+
+def redeliver_batch(
+    queue: DeliveryQueue,
+    signer: Signer,
+    engine: Engine,
+    timeout: Tuple[float, float],
+    max_jobs: int = 10,
+    rng: Any = random,
+    tenant_signers: Optional[TenantSigners] = None,
+) -> RedeliveryStats:
+    # Send one batch of due jobs, and ack, retry (with backoff) or give up on
+    # each depending on how it went
+    jobs = queue.get_batch(max_jobs)
+    status_codes = send_jobs(
+        [job for _, job in jobs], signer, engine, timeout, tenant_signers
+    )
+
+    outcomes = {"delivered": 0, "retried": 0, "abandoned": 0}
+    for (receipt, job), status_code in zip(jobs, status_codes):
+        outcome = settle(job, status_code)
+        outcomes[outcome] += 1
+        if outcome == "retried":
+            queue.retry(receipt, job, backoff_delay(job.attempts, rng))
+        else:
+            queue.ack(receipt)
+
+    return RedeliveryStats(**outcomes)
+
+
+def deliver_jobs(
+    queue: DeliveryQueue,
+    jobs: List[DeliveryJob],
+    signer: Signer,
+    engine: Engine,
+    timeout: Tuple[float, float],
+    rng: Any = random,
+    tenant_signers: Optional[TenantSigners] = None,
+) -> RedeliveryStats:
+    # Send jobs we were handed directly rather than through get_batch() (e.g.
+    # by an SQS trigger, which deletes them once we return), putting any that
+    # fail back on the queue with backoff
+    status_codes = send_jobs(jobs, signer, engine, timeout, tenant_signers)
+
+    outcomes = {"delivered": 0, "retried": 0, "abandoned": 0}
+    for job, status_code in zip(jobs, status_codes):
+        outcome = settle(job, status_code)
+        outcomes[outcome] += 1
+        if outcome == "retried":
+            queue.put(job, backoff_delay(job.attempts, rng))
+
+    return RedeliveryStats(**outcomes)
@@ -0,0 +1,165 @@
+import random
+import time
+
+import pytest
+import responses  # type: ignore
+
+from . import deliveries
+from .config import Config
+from .deliveries import (
+    MAX_ATTEMPTS,
+    DeliveryJob,
+    SqliteDeliveryQueue,
+    SqsDeliveryQueue,
+    backoff_delay,
+    make_queue,
+    redeliver_batch,
+)
+from .engines import ThreadedEngine
+from .muxer_test import MOCK_AUTH_TOKEN, MOCK_WEBHOOK_IDEMPOTENCY_TOKEN, sign_request
+from .signing import Signer
+
+CONFIG = Config.parse_obj(
+    {
+        "default": {"downstreams": ["https://downstream1.com"], "responder": None},
+        "keywords": {},
+    }
+)
+
+TIMEOUT = (1, 1)
+
+
+def make_job(url="https://downstream1.com", attempts=0):
+    return DeliveryJob(
+        url=url,
+        params={"Body": "stop", "From": "+15555555555"},
+        headers={"I-Twilio-Idempotency-Token": MOCK_WEBHOOK_IDEMPOTENCY_TOKEN},
+        attempts=attempts,
+    )
+
+
+def test_sqlite_queue():
+    queue = SqliteDeliveryQueue()
+    queue.put(make_job("https://downstream1.com"))
+    queue.put(make_job("https://downstream2.com"))
+    queue.put(make_job("https://downstream3.com"), delay=60)
+
+    (receipt1, job1), (receipt2, job2) = queue.get_batch(10)
+    assert job1 == make_job("https://downstream1.com")
+    assert job2 == make_job("https://downstream2.com")
+
+    # Handed-out and delayed jobs aren't due
+    assert queue.get_batch(10) == []
+    assert len(queue) == 3
+
+    queue.ack(receipt1)
+    job2.attempts += 1
+    queue.retry(receipt2, job2, delay=0)
+    assert len(queue) == 2
+
+    ((receipt, job),) = queue.get_batch(10)
+    assert job == make_job("https://downstream2.com", attempts=1)
+
+
+def test_sqlite_visibility_timeout(monkeypatch):
+    queue = SqliteDeliveryQueue()
+    queue.put(make_job())
+    assert len(queue.get_batch(10)) == 1
+
+    # A job that's never acked or retried comes back
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + deliveries.VISIBILITY_TIMEOUT + 1)
+    assert len(queue.get_batch(10)) == 1
+
+
+def test_sqs_queue():
+    class FakeSqsClient:
+        def __init__(self):
+            self.calls = []
+
+        def send_message(self, **kwargs):
+            self.calls.append(("send", kwargs))
+
+        def receive_message(self, **kwargs):
+            self.calls.append(("receive", kwargs))
+            return {"Messages": [{"ReceiptHandle": "r1", "Body": make_job().json()}]}
+
+        def delete_message(self, **kwargs):
+            self.calls.append(("delete", kwargs))
+
+    client = FakeSqsClient()
+    queue = SqsDeliveryQueue("https://sqs.us-east-1.amazonaws.com/1/q", client)
+
+    queue.put(make_job(), delay=10**6)
+    assert queue.get_batch(100) == [("r1", make_job())]
+    queue.retry("r1", make_job(attempts=1), delay=5)
+
+    (_, send), (_, receive), (_, resend), (_, delete) = client.calls
+    assert send["DelaySeconds"] == SqsDeliveryQueue.MAX_DELAY
+    assert receive["MaxNumberOfMessages"] == SqsDeliveryQueue.MAX_BATCH
+    assert resend["DelaySeconds"] == 5
+    assert DeliveryJob.parse_raw(resend["MessageBody"]).attempts == 1
+    assert delete["ReceiptHandle"] == "r1"
+
+
+def test_make_queue():
+    assert make_queue(None) is None
+    assert make_queue("") is None
+    assert isinstance(make_queue("sqlite://:memory:"), SqliteDeliveryQueue)
+
+    with pytest.raises(ValueError):
+        make_queue("redis://localhost")
+
+
+def test_backoff_delay():
+    rng = random.Random(0)
+    for attempts in range(20):
+        delay = backoff_delay(attempts, rng)
+        assert 0 <= delay <= deliveries.RETRY_MAX_DELAY
+        assert delay <= deliveries.RETRY_BASE_DELAY * 2**attempts
+
+
+@responses.activate
+def test_redeliver_batch():
+    def callback(request):
+        # Re-signed for the URL, with the original idempotency token
+        params = {"Body": "stop", "From": "+15555555555"}
+        assert request.headers["X-Twilio-Signature"] == sign_request(
+            request.url.rstrip("/"), params
+        )
+        assert (
+            request.headers["I-Twilio-Idempotency-Token"]
+            == MOCK_WEBHOOK_IDEMPOTENCY_TOKEN
+        )
+
+        status = {
+            "downstream1.com": 200,
+            "downstream2.com": 503,
+            "downstream3.com": 404,
+            "downstream4.com": 500,
+        }[request.url.split("/")[2]]
+        return (status, {}, "")
+
+    for i in range(1, 5):
+        responses.add_callback(
+            responses.POST, f"https://downstream{i}.com", callback=callback
+        )
+
+    queue = SqliteDeliveryQueue()
+    queue.put(make_job("https://downstream1.com"))
+    queue.put(make_job("https://downstream2.com"))
+    queue.put(make_job("https://downstream3.com"))
+    queue.put(make_job("https://downstream4.com", attempts=MAX_ATTEMPTS - 1))
+
+    engine = ThreadedEngine(CONFIG)
+    try:
+        stats = redeliver_batch(
+            queue, Signer(MOCK_AUTH_TOKEN), engine, TIMEOUT, rng=random.Random(0)
+        )
+    finally:
+        engine.close()
+
+    # 1 succeeded, 2 is retried, 3 can't succeed, 4 has run out of attempts
+    assert stats == (1, 1, 2)
+    assert len(queue) == 1
+    assert queue.get_batch(10) == []
@@ -0,0 +1,193 @@
+import concurrent.futures
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from typing_extensions import Protocol
+
+from .config import Config
+from .pool import DownstreamPool, downstream_hosts
+
+# Called with either the downstream's response or the exception raised while
+# making the request, plus whatever timings (in seconds) the engine could
+# measure: "ttfb" (time to response headers) and "connect" (time to open a
+# new connection, if one was opened). It's called in whichever thread the
+# engine completes requests on, and its return value becomes the result of
+# the future returned by submit().
+CompletionCallback = Callable[
+    [Optional[Any], Optional[BaseException], Dict[str, float]], Any
+]
+
+# (connect, read) timeouts in seconds
+Timeout = Tuple[float, float]
+
+# The most downstream requests the asyncio engine will have in flight at
+# once, if Config.max_concurrency isn't set
+DEFAULT_MAX_CONCURRENCY = 32
+
+
+# What the muxer and the delivery worker need from an engine: submit() sends
+# a POST and returns a future for on_complete's return value, and close()
+# waits for anything in flight, then frees the engine's connections
+class Engine(Protocol):
+    def submit(
+        self,
+        url: str,
+        data: Any,
+        headers: Dict[str, str],
+        timeout: Timeout,
+        on_complete: CompletionCallback,
+    ) -> concurrent.futures.Future:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+# Sends downstream requests on a thread pool, using pooled keep-alive
+# connections. Both the pool and the executor live as long as the container.
+class ThreadedEngine:
+    def __init__(self, config: Config):
+        self.pool = DownstreamPool(config)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.max_concurrency, thread_name_prefix="muxer-engine"
+        )
+
+    def submit(
+        self,
+        url: str,
+        data: Any,
+        headers: Dict[str, str],
+        timeout: Timeout,
+        on_complete: CompletionCallback,
+    ) -> concurrent.futures.Future:
+        def send() -> Any:
+            try:
+                response = self.pool.post(
+                    url, data=data, headers=headers, timeout=timeout
+                )
+            except Exception as e:
+                return on_complete(None, e, {})
+
+            # requests measures up to when the response headers are parsed.
+            # It doesn't expose connect time separately.
+            return on_complete(
+                response, None, {"ttfb": response.elapsed.total_seconds()}
+            )
+
+        return self.executor.submit(send)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+
+# Sends downstream requests from a single event loop running in a background
+# thread, with one httpx.AsyncClient shared by every request. This avoids a
+# thread (and its stack) per in-flight request. Completion callbacks can
+# block (on locks, logging, queueing retries), so they run on a small thread
+# pool rather than on the loop, where they'd hold up every other request.
+class AsyncioEngine:
+    def __init__(self, config: Config, transport: Any = None):
+        # These are only needed if this engine is selected
+        import asyncio
+
+        import httpx
+
+        self.asyncio = asyncio
+        self.httpx = httpx
+        self.max_concurrency = config.max_concurrency or DEFAULT_MAX_CONCURRENCY
+        self.callbacks = concurrent.futures.ThreadPoolExecutor(
+            thread_name_prefix="muxer-callbacks"
+        )
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="muxer-asyncio", daemon=True
+        )
+        self.thread.start()
+
+        hosts = downstream_hosts(config)
+
+        async def setup() -> None:
+            # Both of these must be created on the loop they'll be used from
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.client = httpx.AsyncClient(
+                transport=transport,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=max(sum(hosts.values()), 1),
+                ),
+            )
+
+        asyncio.run_coroutine_threadsafe(setup(), self.loop).result()
+
+    def submit(
+        self,
+        url: str,
+        data: Any,
+        headers: Dict[str, str],
+        timeout: Timeout,
+        on_complete: CompletionCallback,
+    ) -> concurrent.futures.Future:
+        connect_timeout, read_timeout = timeout
+
+        async def send() -> Any:
+            async with self.semaphore:
+                start = time.perf_counter()
+                timings: Dict[str, float] = {}
+
+                async def trace(event: str, info: Any) -> None:
+                    if event in (
+                        "connection.connect_tcp.complete",
+                        "connection.start_tls.complete",
+                    ):
+                        timings["connect"] = time.perf_counter() - start
+                    elif event == "http11.receive_response_headers.complete":
+                        timings["ttfb"] = time.perf_counter() - start
+
+                # httpx wants an already-encoded body as content=
+                body = {"content" if isinstance(data, bytes) else "data": data}
+                try:
+                    response = await self.client.post(
+                        url,
+                        **body,
+                        headers=headers,
+                        timeout=self.httpx.Timeout(
+                            read_timeout, connect=connect_timeout
+                        ),
+                        extensions={"trace": trace},
+                    )
+                except Exception as e:
+                    return await self.complete(on_complete, None, e, timings)
+
+            return await self.complete(on_complete, response, None, timings)
+
+        # Cancelling the returned future cancels the task, even mid-request
+        return self.asyncio.run_coroutine_threadsafe(send(), self.loop)
+
+    async def complete(
+        self,
+        on_complete: CompletionCallback,
+        response: Optional[Any],
+        error: Optional[BaseException],
+        timings: Dict[str, float],
+    ) -> Any:
+        return await self.loop.run_in_executor(
+            self.callbacks, on_complete, response, error, timings
+        )
+
+    def close(self) -> None:
+        self.asyncio.run_coroutine_threadsafe(self.client.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.callbacks.shutdown(wait=True)
+
+
+def make_engine(config: Config) -> Engine:
+    if config.engine == "asyncio":
+        return AsyncioEngine(config)
+
+    return ThreadedEngine(config)
@@ -0,0 +1,154 @@
+import threading
+import urllib.parse
+
+import httpx
+
+from .config import Config
+from .engines import AsyncioEngine, ThreadedEngine, make_engine
+from .muxer import TwilioMuxer
+from .muxer_test import (
+    MOCK_AUTH_TOKEN,
+    MOCK_MUXER_URL,
+    MOCK_WEBHOOK_CONTENT_TYPE,
+    MOCK_WEBHOOK_IDEMPOTENCY_TOKEN,
+    MOCK_WEBHOOK_PAYLOAD,
+    MOCK_WEBHOOK_USER_AGENT,
+    PARSED_MOCK_WEBHOOK_PAYLOAD,
+    mux_request,
+    sign_request,
+)
+
+ASYNCIO_CONFIG = Config.parse_obj(
+    {
+        "default": {
+            "downstreams": ["https://downstream1.com", "https://downstream2.com"],
+            "responder": 1,
+        },
+        "keywords": {
+            "stop": {"downstreams": ["https://downstream3.com"], "responder": None},
+        },
+        "engine": "asyncio",
+    }
+)
+
+
+def mock_transport(request_body="foobar", fail_hosts=()):
+    request_with_body = (
+        f"Body={urllib.parse.quote_plus(request_body)}&{MOCK_WEBHOOK_PAYLOAD}"
+    )
+    parsed_request_with_body = {"Body": request_body, **PARSED_MOCK_WEBHOOK_PAYLOAD}
+    requested = []
+
+    def handler(request):
+        url = str(request.url).rstrip("/")
+        requested.append(url)
+
+        if request.url.host in fail_hosts:
+            raise httpx.ConnectError("Some connection error", request=request)
+
+        # check body
+        assert request.content.decode() == request_with_body
+
+        # check signature
+        assert request.headers["X-Twilio-Signature"] == sign_request(
+            url, parsed_request_with_body
+        )
+
+        # check header passthrough
+        assert request.headers["Content-Type"] == MOCK_WEBHOOK_CONTENT_TYPE
+        assert (
+            request.headers["I-Twilio-Idempotency-Token"]
+            == MOCK_WEBHOOK_IDEMPOTENCY_TOKEN
+        )
+        assert request.headers["User-Agent"] == MOCK_WEBHOOK_USER_AGENT
+        assert request.headers.get("Cloudfront-Foo") is None
+
+        return httpx.Response(
+            200,
+            headers={"Content-Type": "application/xml"},
+            text=f"<Response>{request.url.host}</Response>",
+        )
+
+    return httpx.MockTransport(handler), requested
+
+
+def asyncio_muxer(transport):
+    return TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=ASYNCIO_CONFIG,
+        engine=AsyncioEngine(ASYNCIO_CONFIG, transport=transport),
+    )
+
+
+def test_make_engine():
+    assert isinstance(
+        make_engine(ASYNCIO_CONFIG.copy(update={"engine": "threads"})), ThreadedEngine
+    )
+
+    engine = make_engine(ASYNCIO_CONFIG)
+    assert isinstance(engine, AsyncioEngine)
+    engine.close()
+
+
+def test_asyncio_responder():
+    transport, requested = mock_transport()
+    muxer = asyncio_muxer(transport)
+
+    assert mux_request(muxer) == (
+        200,
+        "<Response>downstream2.com</Response>",
+        {"Content-Type": "application/xml"},
+    )
+    assert sorted(requested) == ["https://downstream1.com", "https://downstream2.com"]
+
+    muxer.engine.close()
+
+
+def test_asyncio_keyword():
+    transport, requested = mock_transport(request_body="stop")
+    muxer = asyncio_muxer(transport)
+
+    assert mux_request(muxer, body="STOP!") == (
+        200,
+        "<Response></Response>",
+        {"Content-Type": "application/xml"},
+    )
+    assert requested == ["https://downstream3.com"]
+
+    muxer.engine.close()
+
+
+def test_asyncio_responder_error():
+    transport, _ = mock_transport(fail_hosts=("downstream2.com",))
+    muxer = asyncio_muxer(transport)
+
+    assert mux_request(muxer) == (
+        500,
+        "<Response></Response>",
+        {"Content-Type": "application/xml"},
+    )
+
+    muxer.engine.close()
+
+
+def test_asyncio_callbacks_off_the_loop():
+    transport = httpx.MockTransport(lambda request: httpx.Response(200))
+    engine = AsyncioEngine(ASYNCIO_CONFIG, transport=transport)
+    second_done = threading.Event()
+
+    # A callback that blocks doesn't hold up other requests' callbacks
+    def first(response, error, timings):
+        return second_done.wait(5)
+
+    def second(response, error, timings):
+        second_done.set()
+        return response.status_code
+
+    futures = [
+        engine.submit("https://downstream1.com", b"Body=hi", {}, (1, 1), callback)
+        for callback in (first, second)
+    ]
+    assert [future.result(timeout=5) for future in futures] == [True, 200]
+
+    engine.close()
@@ -0,0 +1,53 @@
+from typing import Dict, Union
+from urllib.parse import unquote_plus, urlencode
+
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+
+
+def parse_form(text: str) -> Dict[str, str]:
+    # Like dict(parse_qsl(text, keep_blank_values=True)), but only unquotes
+    # the names and values that need it. Most of a Twilio webhook (SIDs,
+    # counts, country codes) doesn't.
+    params: Dict[str, str] = {}
+    for pair in text.split("&"):
+        if not pair:
+            continue
+
+        name, _, value = pair.partition("=")
+        if "%" in name or "+" in name:
+            name = unquote_plus(name)
+        if "%" in value or "+" in value:
+            value = unquote_plus(value)
+        params[name] = value
+
+    return params
+
+
+# An inbound form-encoded body, parsed once: the params, in the order they
+# arrived, and the encoded body as we received it. Unless a field is changed
+# (see replace()), the encoded body is what we forward to every downstream, so
+# it's never re-encoded per request or per downstream.
+class FormBody:
+    __slots__ = ("raw", "params")
+
+    def __init__(self, raw: bytes, params: Dict[str, str]):
+        self.raw = raw
+        self.params = params
+
+    @classmethod
+    def parse(cls, body: Union[str, bytes, "FormBody"]) -> "FormBody":
+        if isinstance(body, FormBody):
+            return body
+        if isinstance(body, bytes):
+            # Twilio sends ASCII, but anyone can post to the muxer: invalid
+            # UTF-8 becomes U+FFFD (as %-escaped invalid UTF-8 already does in
+            # unquote_plus()) rather than failing the request
+            return cls(body, parse_form(body.decode("utf-8", errors="replace")))
+
+        return cls(body.encode("utf-8"), parse_form(body))
+
+    def replace(self, name: str, value: str) -> "FormBody":
+        # A copy with one field changed (or added), re-encoded
+        params = dict(self.params)
+        params[name] = value
+        return FormBody(urlencode(params).encode("utf-8"), params)
@@ -0,0 +1,44 @@
+from urllib.parse import parse_qsl
+
+import pytest
+
+from .forms import FormBody, parse_form
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "Body=hi&From=%2B15555550100",
+        "Body=stop+texting+me&NumMedia=0",
+        "Body=&To=&SmsSid=SM1",
+        "Body=a%26b%3Dc&Body=second",
+        "Body=%F0%9F%9B%91&FromCity=SAN+FRANCISCO",
+        "Flag&Body=x%2By",
+    ],
+)
+def test_parse_form(text):
+    assert parse_form(text) == dict(parse_qsl(text, keep_blank_values=True))
+
+
+def test_form_body():
+    raw = b"Body=stop+now&From=%2B15555550100"
+
+    form = FormBody.parse(raw)
+    assert form.raw is raw
+    assert form.params == {"Body": "stop now", "From": "+15555550100"}
+    assert FormBody.parse(raw.decode()).raw == raw
+
+    # Only a rewrite re-encodes the body, keeping the field order
+    rewritten = form.replace("Body", "STOP")
+    assert rewritten.raw == b"Body=STOP&From=%2B15555550100"
+    assert rewritten.params == {"Body": "STOP", "From": "+15555550100"}
+    assert form.params["Body"] == "stop now"
+
+
+def test_form_body_invalid_utf8():
+    raw = b"Body=caf\xe9&FromCity=%FF"
+
+    form = FormBody.parse(raw)
+    assert form.raw is raw
+    assert form.params == {"Body": "caf\ufffd", "FromCity": "\ufffd"}
@@ -0,0 +1,97 @@
+from typing import Any, Dict, List, Set, Tuple
+
+
+def edit_distance(a: str, b: str) -> int:
+    # Levenshtein distance (insertions, deletions and substitutions)
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (char_a != char_b),
+                )
+            )
+        previous = current
+
+    return previous[-1]
+
+
+def deletes(term: str, max_distance: int) -> Set[str]:
+    # Every string that can be made by deleting up to max_distance characters
+    # from term (including term itself)
+    results = {term}
+    frontier = {term}
+    for _ in range(max_distance):
+        frontier = {
+            variant[:i] + variant[i + 1 :]
+            for variant in frontier
+            for i in range(len(variant))
+        }
+        results |= frontier
+
+    return results
+
+
+# Matches messages to keywords (or their alternates) within each keyword's
+# max_edit_distance, using a symmetric-deletion index: two strings within
+# edit distance d always share a string reachable by deleting at most d
+# characters from each, so a lookup only has to hash the message's deletes
+# and verify the handful of candidates that share one. Built once, when the
+# config is loaded.
+class FuzzyIndex:
+    def __init__(self) -> None:
+        self.deletes: Dict[str, List[Tuple[str, Any, int]]] = {}
+        self.max_radius = 0
+        self.max_term_length = 0
+        self.size = 0
+
+    def add(self, term: str, route: Any, max_distance: int) -> None:
+        for variant in deletes(term, max_distance):
+            self.deletes.setdefault(variant, []).append((term, route, max_distance))
+
+        self.max_radius = max(self.max_radius, max_distance)
+        self.max_term_length = max(self.max_term_length, len(term))
+        self.size += 1
+
+    def match(self, normalized_body: str) -> Any:
+        if (
+            not normalized_body
+            or self.max_radius == 0
+            or len(normalized_body) > self.max_term_length + self.max_radius
+        ):
+            return None
+
+        best_distance = None
+        best_routes: List[Any] = []
+        checked: Set[str] = set()
+        for variant in deletes(normalized_body, self.max_radius):
+            for term, route, max_distance in self.deletes.get(variant, ()):
+                if term in checked:
+                    continue
+                checked.add(term)
+
+                if abs(len(term) - len(normalized_body)) > max_distance:
+                    continue
+
+                distance = edit_distance(normalized_body, term)
+                if distance > max_distance:
+                    continue
+
+                if best_distance is None or distance < best_distance:
+                    best_distance = distance
+                    best_routes = [route]
+                elif distance == best_distance and route not in best_routes:
+                    best_routes.append(route)
+
+        # If the closest matches are equally close to different keywords,
+        # we can't tell which one was meant
+        if len(best_routes) != 1:
+            return None
+
+        return best_routes[0]
@@ -0,0 +1,82 @@
+import random
+import string
+import time
+
+from .fuzzy import FuzzyIndex, deletes, edit_distance
+
+
+def test_edit_distance():
+    assert edit_distance("stop", "stop") == 0
+    assert edit_distance("stop", "stip") == 1
+    assert edit_distance("stop", "sotp") == 2
+    assert edit_distance("stop", "stopp") == 1
+    assert edit_distance("", "stop") == 4
+    assert edit_distance("kitten", "sitting") == 3
+
+
+def test_deletes():
+    assert deletes("abc", 0) == {"abc"}
+    assert deletes("abc", 1) == {"abc", "bc", "ac", "ab"}
+    assert deletes("abc", 2) == {"abc", "bc", "ac", "ab", "a", "b", "c"}
+
+
+def test_fuzzy_index_matches_brute_force():
+    rng = random.Random(1234)
+    terms = {
+        "".join(rng.choice("abcde") for _ in range(rng.randint(1, 8)))
+        for _ in range(300)
+    }
+
+    for max_distance in range(1, 3):
+        index = FuzzyIndex()
+        for term in terms:
+            index.add(term, term, max_distance)
+
+        for _ in range(100):
+            query = "".join(rng.choice("abcde") for _ in range(rng.randint(1, 8)))
+            distances = sorted((edit_distance(query, t), t) for t in terms)
+            closest = [t for d, t in distances if d == distances[0][0]]
+
+            if distances[0][0] > max_distance or len(closest) > 1:
+                assert index.match(query) is None
+            else:
+                assert index.match(query) == closest[0]
+
+
+def test_fuzzy_index():
+    index = FuzzyIndex()
+    index.add("stop", "STOP", 1)
+    index.add("stop texting me", "STOP", 2)
+    index.add("help", "HELP", 1)
+    index.add("join", "JOIN", 0)
+
+    assert index.match("stip") == "STOP"
+    assert index.match("stop textin mee") == "STOP"
+    assert index.match("hepl") is None
+    assert index.match("hlep") is None
+    assert index.match("helpp") == "HELP"
+
+    # max_edit_distance is per keyword
+    assert index.match("jion") is None
+
+    # Ambiguous between two keywords
+    index.add("stap", "STAP", 1)
+    assert index.match("stip") is None
+
+    assert index.match("") is None
+
+
+def test_fuzzy_index_is_fast():
+    rng = random.Random(1234)
+    index = FuzzyIndex()
+    for i in range(5000):
+        term = "".join(rng.choice(string.ascii_lowercase) for _ in range(8))
+        index.add(term, i, 1)
+
+    start = time.perf_counter()
+    for _ in range(100):
+        index.match("".join(rng.choice(string.ascii_lowercase) for _ in range(8)))
+
+    # Generous, to avoid flakiness on slow machines; this is usually tens of
+    # microseconds per lookup
+    assert (time.perf_counter() - start) / 100 < 0.005
@@ -0,0 +1,39 @@
+import collections
+import threading
+from typing import Deque, Dict, Optional
+
+# How many recent latencies to keep per downstream, and how many we need
+# before we trust a percentile of them
+LATENCY_SAMPLES = 200
+MIN_LATENCY_SAMPLES = 20
+
+
+# Recent response latencies (in seconds) per downstream URL, used to decide
+# how long to wait on a responder before hedging to a fallback
+class LatencyTracker:
+    def __init__(
+        self,
+        samples: int = LATENCY_SAMPLES,
+        min_samples: int = MIN_LATENCY_SAMPLES,
+    ):
+        self.samples = samples
+        self.min_samples = min_samples
+        self.latencies: Dict[str, Deque[float]] = {}
+        self.lock = threading.Lock()
+
+    def record(self, url: str, latency: float) -> None:
+        with self.lock:
+            latencies = self.latencies.get(url)
+            if latencies is None:
+                latencies = self.latencies[url] = collections.deque(maxlen=self.samples)
+            latencies.append(latency)
+
+    def percentile(self, url: str, p: float) -> Optional[float]:
+        # None until we've seen enough requests to the URL
+        with self.lock:
+            latencies = sorted(self.latencies.get(url, ()))
+
+        if len(latencies) < self.min_samples:
+            return None
+
+        return latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)]
@@ -0,0 +1,26 @@
+from .hedging import LatencyTracker
+
+
+def test_percentile():
+    tracker = LatencyTracker(samples=100, min_samples=10)
+    for i in range(9):
+        tracker.record("https://a.com", i / 100)
+
+    # Not enough samples yet
+    assert tracker.percentile("https://a.com", 50) is None
+    assert tracker.percentile("https://b.com", 50) is None
+
+    tracker.record("https://a.com", 0.09)
+    assert tracker.percentile("https://a.com", 50) == 0.05
+    assert tracker.percentile("https://a.com", 99) == 0.09
+
+
+def test_window():
+    tracker = LatencyTracker(samples=10, min_samples=10)
+    for _ in range(10):
+        tracker.record("https://a.com", 5)
+    for _ in range(10):
+        tracker.record("https://a.com", 0.1)
+
+    # Only the most recent samples count
+    assert tracker.percentile("https://a.com", 99) == 0.1
@@ -0,0 +1,250 @@
+import argparse
+import json
+import math
+import sys
+import threading
+import time
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .metrics import MetricsSink
+
+# Quantiles are accurate to within this fraction of the true value (e.g. a
+# reported p99 of 200ms means the real one is between 198ms and 202ms)
+RELATIVE_ACCURACY = 0.01
+
+# Most buckets a histogram keeps. At 1% accuracy this covers more than eight
+# orders of magnitude (e.g. 10 microseconds to over an hour) before the
+# lowest buckets are merged together.
+MAX_BUCKETS = 1024
+
+# Latencies are recorded in milliseconds; anything smaller counts as this
+MIN_LATENCY_MS = 0.001
+
+# Most (route, downstream) pairs we keep a histogram for. Latencies for any
+# more are recorded under OTHER_SERIES.
+MAX_SERIES = 256
+OTHER_SERIES = ("<other>", "<other>")
+
+# How often the histograms are flushed to the metrics sink (in seconds)
+FLUSH_INTERVAL = 60.0
+
+# The quantiles we report
+QUANTILES = (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99))
+
+
+# A streaming latency histogram with logarithmically-sized buckets, like
+# DDSketch: the value v goes in bucket ceil(log(v) / log(gamma)), so every
+# bucket is the same fraction wider than the one below it. That keeps quantiles
+# within RELATIVE_ACCURACY of the truth in a fixed amount of memory, and two
+# histograms can be merged by adding up their buckets.
+class LatencyHistogram:
+    def __init__(
+        self,
+        relative_accuracy: float = RELATIVE_ACCURACY,
+        max_buckets: int = MAX_BUCKETS,
+    ):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, ms: float) -> None:
+        ms = max(ms, MIN_LATENCY_MS)
+        self.add_bucket(math.ceil(math.log(ms) / self.log_gamma), 1)
+        self.count += 1
+        self.sum += ms
+        self.min = min(self.min, ms)
+        self.max = max(self.max, ms)
+
+    def add_bucket(self, index: int, count: int) -> None:
+        if index in self.buckets:
+            self.buckets[index] += count
+            return
+
+        self.buckets[index] = count
+        if len(self.buckets) > self.max_buckets:
+            # Out of buckets: fold the lowest into the next one up, so we lose
+            # accuracy for the fastest requests rather than the slowest
+            lowest, second = sorted(self.buckets)[:2]
+            self.buckets[second] += self.buckets.pop(lowest)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        for index, count in other.buckets.items():
+            self.add_bucket(index, count)
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                break
+
+        # The middle of the bucket (in relative terms), clamped to what we've
+        # actually seen
+        value = 2 * self.gamma**index / (self.gamma + 1)
+        return min(max(value, self.min), self.max)
+
+    def summary(self) -> Dict[str, Any]:
+        summary: Dict[str, Any] = {"count": self.count}
+        if self.count:
+            summary["mean_ms"] = round(self.sum / self.count, 3)
+            for name, q in QUANTILES:
+                summary[name] = round(self.quantile(q) or 0.0, 3)
+            summary["max_ms"] = round(self.max, 3)
+
+        return summary
+
+    def as_dict(self) -> Dict[str, Any]:
+        # The summary, plus what's needed to merge it with other histograms
+        # later (see main())
+        return {
+            **self.summary(),
+            "sum_ms": round(self.sum, 3),
+            "min_ms": round(self.min, 3) if self.count else None,
+            "buckets": {str(index): count for index, count in self.buckets.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LatencyHistogram":
+        histogram = cls()
+        for index, count in data["buckets"].items():
+            histogram.add_bucket(int(index), int(count))
+        histogram.count = int(data["count"])
+        histogram.sum = float(data["sum_ms"])
+        if histogram.count:
+            histogram.min = float(data["min_ms"])
+            histogram.max = float(data["max_ms"])
+
+        return histogram
+
+
+# Latency histograms per route and downstream URL, held by the muxer for as
+# long as the container lives. Memory is bounded by MAX_SERIES histograms of
+# MAX_BUCKETS buckets each, however much traffic we see. flush() hands the
+# histograms to the metrics sink and starts new ones, so each flush covers
+# the requests since the last one.
+class LatencyHistograms:
+    def __init__(
+        self,
+        flush_interval: float = FLUSH_INTERVAL,
+        max_series: int = MAX_SERIES,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.flush_interval = flush_interval
+        self.max_series = max_series
+        self.clock = clock
+        self.series: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self.last_flush = clock()
+        self.lock = threading.Lock()
+
+    def record(self, route: str, url: str, ms: float) -> None:
+        key = (route, url)
+        with self.lock:
+            histogram = self.series.get(key)
+            if histogram is None:
+                if len(self.series) >= self.max_series - 1:
+                    key = OTHER_SERIES
+                histogram = self.series.get(key)
+                if histogram is None:
+                    histogram = self.series[key] = LatencyHistogram()
+            histogram.record(ms)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        # Quantiles for the requests since the last flush
+        with self.lock:
+            return [
+                {"route": route, "downstream": url, **histogram.summary()}
+                for (route, url), histogram in sorted(self.series.items())
+            ]
+
+    def flush(self, sink: MetricsSink) -> None:
+        with self.lock:
+            series, self.series = self.series, {}
+            self.last_flush = self.clock()
+
+        if series:
+            sink.emit_histograms(
+                [
+                    {"route": route, "downstream": url, **histogram.as_dict()}
+                    for (route, url), histogram in sorted(series.items())
+                ]
+            )
+
+    def maybe_flush(self, sink: MetricsSink) -> None:
+        # Called at the end of every request
+        if self.clock() - self.last_flush >= self.flush_interval:
+            self.flush(sink)
+
+
+def read_histograms(f: IO[str]) -> Iterator[Dict[str, Any]]:
+    # The flushed histograms in log output, e.g. from `aws logs tail` or
+    # `serverless logs`. Log lines often have a prefix (a timestamp and
+    # request ID) before the JSON.
+    for line in f:
+        start = line.find("{")
+        if start == -1 or "latency_histograms" not in line:
+            continue
+
+        try:
+            yield from json.loads(line[start:])["latency_histograms"]
+        except (ValueError, KeyError, TypeError):
+            continue
+
+
+def main(argv: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    parser = argparse.ArgumentParser(
+        description="Merge the latency histograms in the muxer's logs, and print "
+        "p50/p90/p99 per route and downstream"
+    )
+    parser.add_argument(
+        "logs", nargs="*", help="log files to read (default: standard input)"
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args(argv)
+
+    merged: Dict[Tuple[str, str], LatencyHistogram] = {}
+    for path in args.logs or ["-"]:
+        f = sys.stdin if path == "-" else open(path)
+        try:
+            for data in read_histograms(f):
+                key = (data["route"], data["downstream"])
+                merged.setdefault(key, LatencyHistogram()).merge(
+                    LatencyHistogram.from_dict(data)
+                )
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    results = [
+        {"route": route, "downstream": url, **histogram.summary()}
+        for (route, url), histogram in sorted(merged.items())
+    ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(
+                f"{result['route']:<16} {result['downstream']:<48} "
+                f"n={result['count']:<8} p50={result['p50_ms']:.1f}ms "
+                f"p90={result['p90_ms']:.1f}ms p99={result['p99_ms']:.1f}ms "
+                f"max={result['max_ms']:.1f}ms"
+            )
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import io
+import json
+import random
+
+from .histograms import (
+    MAX_SERIES,
+    OTHER_SERIES,
+    LatencyHistogram,
+    LatencyHistograms,
+    main,
+    read_histograms,
+)
+from .metrics import EmfSink, JsonLogSink
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def test_histogram_accuracy():
+    rng = random.Random(1)
+    values = [rng.lognormvariate(4, 1) for _ in range(10000)]
+
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+
+    for q in (0.5, 0.9, 0.99):
+        assert abs(histogram.quantile(q) / exact_quantile(values, q) - 1) <= 0.011
+
+    summary = histogram.summary()
+    assert summary["count"] == 10000
+    assert summary["max_ms"] == round(max(values), 3)
+    assert len(histogram.buckets) < 1024
+
+
+def test_histogram_bounded():
+    histogram = LatencyHistogram(max_buckets=10)
+    for i in range(1000):
+        histogram.record(1.5**i)
+
+    assert len(histogram.buckets) == 10
+    assert histogram.count == 1000
+    # The slowest requests stay accurate
+    assert histogram.quantile(1) == histogram.max
+    # ... at the expense of the fastest
+    assert histogram.quantile(0) > histogram.min
+
+
+def test_histogram_merge():
+    a, b, both = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+    for i in range(1, 100):
+        (a if i % 2 else b).record(i)
+        both.record(i)
+
+    merged = LatencyHistogram.from_dict(json.loads(json.dumps(a.as_dict())))
+    merged.merge(b)
+    assert merged.summary() == both.summary()
+
+    assert LatencyHistogram().summary() == {"count": 0}
+    assert LatencyHistogram().quantile(0.5) is None
+
+
+def test_histograms():
+    now = [1000.0]
+    histograms = LatencyHistograms(flush_interval=60, clock=lambda: now[0])
+    histograms.record("stop", "https://a.com", 10)
+    histograms.record("stop", "https://a.com", 20)
+    histograms.record("<default>", "https://b.com", 30)
+
+    assert [
+        (h["route"], h["downstream"], h["count"]) for h in histograms.snapshot()
+    ] == [("<default>", "https://b.com", 1), ("stop", "https://a.com", 2)]
+
+    # A bounded number of series
+    for i in range(MAX_SERIES * 2):
+        histograms.record("stop", f"https://{i}.com", 10)
+    assert len(histograms.series) == MAX_SERIES
+    assert histograms.series[OTHER_SERIES].count == MAX_SERIES * 2 - MAX_SERIES + 3
+
+
+def test_flush(capsys):
+    now = [1000.0]
+    histograms = LatencyHistograms(flush_interval=60, clock=lambda: now[0])
+    sink = JsonLogSink()
+
+    histograms.record("stop", "https://a.com", 10)
+    histograms.maybe_flush(sink)
+    assert capsys.readouterr().out == ""
+
+    now[0] += 60
+    histograms.maybe_flush(sink)
+    (flushed,) = json.loads(capsys.readouterr().out)["latency_histograms"]
+    assert flushed["route"] == "stop"
+    assert flushed["count"] == 1
+    assert histograms.snapshot() == []
+
+    # Nothing to flush
+    now[0] += 60
+    histograms.maybe_flush(sink)
+    assert capsys.readouterr().out == ""
+
+
+def test_emf_histograms(capsys):
+    histogram = LatencyHistogram()
+    histogram.record(12.5)
+    EmfSink(namespace="Test").emit_histograms(
+        [{"route": "stop", "downstream": "https://a.com", **histogram.as_dict()}]
+    )
+    emitted = json.loads(capsys.readouterr().out)
+
+    assert emitted["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [
+        ["route", "downstream"]
+    ]
+    assert emitted["downstream_p99_ms"] == 12.5
+    assert emitted["downstream_count"] == 1
+    assert emitted["latency_histograms"][0]["buckets"]
+
+
+def test_main(tmp_path, capsys):
+    logs = io.StringIO()
+    for values in ([10, 20], [30, 40]):
+        histograms = LatencyHistograms()
+        for value in values:
+            histograms.record("stop", "https://a.com", value)
+        histograms.flush(JsonLogSink())
+        logs.write(f"2020-10-01T00:00:00 req-1 {capsys.readouterr().out}")
+    logs.write("not a histogram\n")
+
+    assert len(list(read_histograms(io.StringIO(logs.getvalue())))) == 2
+
+    path = tmp_path / "logs.txt"
+    path.write_text(logs.getvalue())
+    (result,) = main([str(path)])
+    assert result["count"] == 4
+    assert result["max_ms"] == 40
+    assert "p99=" in capsys.readouterr().out
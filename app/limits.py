@@ -0,0 +1,208 @@
+import collections
+import concurrent.futures
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from .pool import host_key
+
+# How much an adaptive limit shrinks by when a downstream is slow or failing
+DECREASE_FACTOR = 0.5
+
+
+# A token bucket: holds up to burst tokens and refills at rate tokens per
+# second. Not thread-safe on its own (HostLimiter holds its lock around it).
+class TokenBucket:
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+
+        self.tokens = burst
+        self.updated_at = clock()
+
+    def take(self) -> float:
+        # Take a token if there is one and return 0, otherwise return how long
+        # until there will be one (in seconds)
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+
+# Called to send a queued request once it's allowed through, with the number
+# to pass to HostLimiter.release() once it's finished. Returns whether it was
+# sent (False if it was cancelled or given up on while it waited).
+Start = Callable[[int], bool]
+
+
+# Limits the requests to one downstream host: at most limit of them in flight
+# at once, and (with a rate) at most rate per second on average. Requests over
+# the limit wait in a FIFO queue and are sent as earlier ones finish; nothing
+# is dropped here, though a waiting request can be cancelled.
+#
+# With adaptive, the in-flight limit follows AIMD: every request that succeeds
+# (and is faster than latency_target, if set) grows it by 1/limit, up to
+# max_in_flight, and a failed or slow request halves it, down to min_in_flight.
+# It only halves once per round trip: a request sent before the last decrease
+# can't decrease it again, so a burst of failures doesn't collapse it to the
+# minimum.
+class HostLimiter:
+    def __init__(
+        self,
+        max_in_flight: Optional[int] = None,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        adaptive: bool = False,
+        min_in_flight: int = 1,
+        latency_target: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_in_flight = max_in_flight
+        self.adaptive = adaptive
+        self.min_in_flight = min_in_flight
+        self.latency_target = latency_target
+
+        self.limit = float(max_in_flight) if max_in_flight is not None else None
+        self.bucket = (
+            TokenBucket(rate, burst if burst is not None else max(rate, 1), clock)
+            if rate is not None
+            else None
+        )
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting: Deque[Tuple[concurrent.futures.Future, Start]] = (
+            collections.deque()
+        )
+
+        # Requests are numbered as they're sent, so we know which were sent
+        # after the last decrease
+        self.sent = 0
+        self.decreased_at = 0
+
+        # Set while a timer is waiting for the bucket to refill
+        self.refill_timer: Optional[threading.Timer] = None
+
+    def submit(self, future: concurrent.futures.Future, start: Start) -> None:
+        # Send the request now if we can, otherwise queue it. future is the
+        # request's future: if it's cancelled while queued, start isn't called.
+        with self.lock:
+            self.waiting.append((future, start))
+
+        self.dispatch()
+
+    def queued(self) -> int:
+        with self.lock:
+            return len(self.waiting)
+
+    def dispatch(self) -> None:
+        # Send as many queued requests as the limits allow
+        while True:
+            with self.lock:
+                while self.waiting and self.waiting[0][0].cancelled():
+                    self.waiting.popleft()
+
+                if not self.waiting:
+                    return
+
+                if self.limit is not None and self.in_flight >= max(
+                    int(self.limit), self.min_in_flight
+                ):
+                    return
+
+                if self.bucket is not None:
+                    wait = self.bucket.take()
+                    if wait > 0:
+                        self.wait_for_refill(wait)
+                        return
+
+                _, start = self.waiting.popleft()
+                self.in_flight += 1
+                self.sent += 1
+                sequence = self.sent
+
+            if not start(sequence):
+                with self.lock:
+                    self.in_flight -= 1
+
+    def wait_for_refill(self, wait: float) -> None:
+        # Called with the lock held
+        if self.refill_timer is not None:
+            return
+
+        def refilled() -> None:
+            with self.lock:
+                self.refill_timer = None
+            self.dispatch()
+
+        self.refill_timer = threading.Timer(wait, refilled)
+        self.refill_timer.daemon = True
+        self.refill_timer.start()
+
+    def release(self, sequence: int, failed: bool, latency: float) -> None:
+        # Record that a request we sent (numbered sequence) has finished
+        with self.lock:
+            self.in_flight -= 1
+
+            if self.adaptive and self.limit is not None:
+                slow = self.latency_target is not None and latency > self.latency_target
+                if failed or slow:
+                    if sequence > self.decreased_at:
+                        self.limit = max(
+                            self.limit * DECREASE_FACTOR, float(self.min_in_flight)
+                        )
+                        self.decreased_at = self.sent
+                elif self.max_in_flight is not None:
+                    self.limit = min(
+                        self.limit + 1 / self.limit, float(self.max_in_flight)
+                    )
+
+        self.dispatch()
+
+
+# A HostLimiter per downstream host, created on first use. limit_args maps a
+# host (any downstream URL on it, e.g. "https://helpline.example.com") to its
+# HostLimiter arguments; "*" applies to hosts that aren't listed. Hosts with
+# no limits get no limiter.
+class DownstreamLimiters:
+    def __init__(self, limit_args: Dict[str, Dict[str, Any]]):
+        self.limit_args = limit_args
+        self.host_args = {
+            (key if key == "*" else host_key(key)): args
+            for key, args in limit_args.items()
+        }
+        self.limiters: Dict[str, Optional[HostLimiter]] = {}
+        self.lock = threading.Lock()
+
+    def for_url(self, url: str) -> Optional[HostLimiter]:
+        key = host_key(url)
+        try:
+            return self.limiters[key]
+        except KeyError:
+            pass
+
+        with self.lock:
+            if key not in self.limiters:
+                args = self.host_args.get(key, self.host_args.get("*"))
+                self.limiters[key] = HostLimiter(**args) if args is not None else None
+
+            return self.limiters[key]
+
+    def limits(self) -> Dict[str, float]:
+        # The current in-flight limit for each host that has one
+        return {
+            key: limiter.limit
+            for key, limiter in list(self.limiters.items())
+            if limiter is not None and limiter.limit is not None
+        }
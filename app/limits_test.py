@@ -0,0 +1,144 @@
+import concurrent.futures
+
+from .limits import DownstreamLimiters, HostLimiter, TokenBucket
+
+
+class Recorder:
+    # Starts that record the order they were called in
+    def __init__(self):
+        self.started = []
+
+    def start(self, name):
+        def start(sequence):
+            self.started.append((name, sequence))
+            return True
+
+        return start
+
+
+def submit(limiter, start):
+    future = concurrent.futures.Future()
+    limiter.submit(future, start)
+    return future
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(rate=2, burst=2, clock=clock)
+
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == 0.5
+
+    clock.now += 0.5
+    assert bucket.take() == 0
+
+
+def test_max_in_flight():
+    limiter = HostLimiter(max_in_flight=2)
+    recorder = Recorder()
+
+    for name in "abcd":
+        submit(limiter, recorder.start(name))
+    assert recorder.started == [("a", 1), ("b", 2)]
+    assert limiter.queued() == 2
+
+    # Queued requests go out in order as earlier ones finish
+    limiter.release(1, failed=False, latency=0.1)
+    assert recorder.started[-1] == ("c", 3)
+    limiter.release(2, failed=False, latency=0.1)
+    assert recorder.started[-1] == ("d", 4)
+    assert limiter.queued() == 0
+
+
+def test_cancelled_while_queued():
+    limiter = HostLimiter(max_in_flight=1)
+    recorder = Recorder()
+
+    submit(limiter, recorder.start("a"))
+    cancelled = submit(limiter, recorder.start("b"))
+    submit(limiter, recorder.start("c"))
+    assert cancelled.cancel()
+
+    limiter.release(1, failed=False, latency=0.1)
+    assert [name for name, _ in recorder.started] == ["a", "c"]
+
+
+def test_not_started():
+    # A request that's given up on when it's let through doesn't hold a slot
+    limiter = HostLimiter(max_in_flight=1)
+    recorder = Recorder()
+
+    submit(limiter, lambda sequence: False)
+    submit(limiter, recorder.start("a"))
+    assert recorder.started == [("a", 2)]
+
+
+def test_rate_limit(clock):
+    limiter = HostLimiter(rate=1, burst=1, clock=clock)
+    recorder = Recorder()
+
+    submit(limiter, recorder.start("a"))
+    submit(limiter, recorder.start("b"))
+    assert [name for name, _ in recorder.started] == ["a"]
+    assert limiter.refill_timer is not None
+
+    # The timer would do this after a second
+    limiter.refill_timer.cancel()
+    limiter.refill_timer = None
+    clock.now += 1
+    limiter.dispatch()
+    assert [name for name, _ in recorder.started] == ["a", "b"]
+
+
+def test_adaptive():
+    limiter = HostLimiter(max_in_flight=8, adaptive=True, latency_target=1)
+    recorder = Recorder()
+    for name in range(8):
+        submit(limiter, recorder.start(name))
+
+    # A burst of failures from the same round only halves the limit once
+    limiter.release(1, failed=True, latency=0.1)
+    limiter.release(2, failed=True, latency=0.1)
+    assert limiter.limit == 4
+
+    # Slow requests count as failures
+    for name in range(8, 11):
+        submit(limiter, recorder.start(name))
+    limiter.release(9, failed=False, latency=2)
+    assert limiter.limit == 2
+
+    # Successes grow it back, by about one per limit's worth
+    limiter.release(10, failed=False, latency=0.1)
+    limiter.release(11, failed=False, latency=0.1)
+    assert limiter.limit == 2.9
+
+    for sequence in range(3, 9):
+        limiter.release(sequence, failed=False, latency=0.1)
+    assert 4 < limiter.limit <= 8
+
+    # Never below min_in_flight
+    limiter = HostLimiter(max_in_flight=2, adaptive=True)
+    submit(limiter, Recorder().start("a"))
+    limiter.release(1, failed=True, latency=0.1)
+    assert limiter.limit == 1
+
+
+def test_downstream_limiters():
+    limiters = DownstreamLimiters(
+        {
+            "https://helpline.example.com": {"max_in_flight": 2},
+            "*": {"max_in_flight": 10},
+        }
+    )
+    assert limiters.for_url("https://HELPLINE.example.com:443/a").max_in_flight == 2
+    assert limiters.for_url("https://helpline.example.com/b") is limiters.for_url(
+        "https://helpline.example.com/a"
+    )
+    assert limiters.for_url("http://other.com").max_in_flight == 10
+    assert limiters.limits() == {
+        "https://helpline.example.com:443": 2,
+        "http://other.com:80": 10,
+    }
+
+    limiters = DownstreamLimiters({"https://helpline.example.com": {"rate": 5}})
+    assert limiters.for_url("https://other.com") is None
@@ -0,0 +1,202 @@
+import abc
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+
+def elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+# Timings and outcome of a single inbound webhook. Downstream requests record
+# into this from whichever thread they complete on.
+class RequestMetrics:
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+        self.downstreams: Dict[int, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = elapsed_ms(start)
+
+    def set(self, **fields: Any) -> None:
+        self.fields.update(fields)
+
+    def record_downstream(self, index: int, url: str, **fields: Any) -> None:
+        with self.lock:
+            self.downstreams.setdefault(index, {"url": url}).update(fields)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            downstreams = [dict(self.downstreams[i]) for i in sorted(self.downstreams)]
+
+        return {
+            "total_ms": elapsed_ms(self.start),
+            "phases": dict(self.phases),
+            "downstreams": downstreams,
+            **self.fields,
+        }
+
+
+# Where per-request metrics go. emit() is called once per inbound webhook, on
+# the request path, so implementations that talk to the network (e.g. a
+# Datadog client) should buffer in emit() and send in flush(), which is
+# called once the reply has been computed.
+#
+# emit_histograms() gets the downstream latency histograms (see
+# histograms.py) every so often, each one a dict with the route, downstream,
+# count, mean_ms, p50_ms, p90_ms, p99_ms and max_ms, plus the buckets.
+#
+# emit_deliveries() gets how many queued deliveries a run of the delivery
+# ("delivery") or retry ("redelivery") handler delivered, retried and
+# abandoned.
+class MetricsSink(abc.ABC):
+    @abc.abstractmethod
+    def emit(self, metrics: Dict[str, Any]) -> None:
+        raise NotImplementedError()
+
+    def emit_histograms(self, histograms: List[Dict[str, Any]]) -> None:
+        pass
+
+    def emit_deliveries(self, kind: str, totals: Dict[str, int]) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+
+class NullSink(MetricsSink):
+    def emit(self, metrics: Dict[str, Any]) -> None:
+        pass
+
+
+# One compact JSON line per request in the function's logs, and one for each
+# flush of the latency histograms
+class JsonLogSink(MetricsSink):
+    def emit(self, metrics: Dict[str, Any]) -> None:
+        print(json.dumps(metrics, separators=(",", ":"), default=str))
+
+    def emit_histograms(self, histograms: List[Dict[str, Any]]) -> None:
+        print(json.dumps({"latency_histograms": histograms}, separators=(",", ":")))
+
+    def emit_deliveries(self, kind: str, totals: Dict[str, int]) -> None:
+        print(json.dumps({kind: totals}, separators=(",", ":")))
+
+
+# CloudWatch Embedded Metric Format: still one JSON line per request, but
+# CloudWatch also extracts the timings as metrics, by route
+class EmfSink(MetricsSink):
+    def __init__(self, namespace: str = "TwilioWebhookMuxer"):
+        self.namespace = namespace
+
+    def emit(self, metrics: Dict[str, Any]) -> None:
+        values: Dict[str, float] = {"total_ms": metrics["total_ms"]}
+        for phase, ms in metrics["phases"].items():
+            values[f"{phase}_ms"] = ms
+
+        metric_names: List[Dict[str, str]] = [
+            {"Name": name, "Unit": "Milliseconds"} for name in values
+        ]
+
+        print(
+            json.dumps(
+                {
+                    "_aws": {
+                        "Timestamp": int(time.time() * 1000),
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": self.namespace,
+                                "Dimensions": [["route"]],
+                                "Metrics": metric_names,
+                            }
+                        ],
+                    },
+                    **metrics,
+                    **values,
+                    "route": metrics.get("route") or "<none>",
+                },
+                separators=(",", ":"),
+                default=str,
+            )
+        )
+
+    def emit_histograms(self, histograms: List[Dict[str, Any]]) -> None:
+        # One line per route and downstream, with its quantiles as metrics.
+        # CloudWatch can't merge quantiles, so the buckets are in there too
+        # (see `pipenv run latencies`).
+        for histogram in histograms:
+            values = {
+                f"downstream_{name}": histogram[name]
+                for name in ("p50_ms", "p90_ms", "p99_ms", "max_ms")
+            }
+            metric_names = [
+                {"Name": name, "Unit": "Milliseconds"} for name in values
+            ] + [{"Name": "downstream_count", "Unit": "Count"}]
+
+            print(
+                json.dumps(
+                    {
+                        "_aws": {
+                            "Timestamp": int(time.time() * 1000),
+                            "CloudWatchMetrics": [
+                                {
+                                    "Namespace": self.namespace,
+                                    "Dimensions": [["route", "downstream"]],
+                                    "Metrics": metric_names,
+                                }
+                            ],
+                        },
+                        "route": histogram["route"],
+                        "downstream": histogram["downstream"],
+                        "downstream_count": histogram["count"],
+                        **values,
+                        "latency_histograms": [histogram],
+                    },
+                    separators=(",", ":"),
+                )
+            )
+
+    def emit_deliveries(self, kind: str, totals: Dict[str, int]) -> None:
+        # The counts as metrics, by handler
+        print(
+            json.dumps(
+                {
+                    "_aws": {
+                        "Timestamp": int(time.time() * 1000),
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": self.namespace,
+                                "Dimensions": [["handler"]],
+                                "Metrics": [
+                                    {"Name": name, "Unit": "Count"} for name in totals
+                                ],
+                            }
+                        ],
+                    },
+                    "handler": kind,
+                    **totals,
+                    kind: totals,
+                },
+                separators=(",", ":"),
+            )
+        )
+
+
+def make_sink(name: Optional[str]) -> MetricsSink:
+    if name == "emf":
+        return EmfSink()
+    if name == "none":
+        return NullSink()
+    if name in (None, "", "json"):
+        return JsonLogSink()
+
+    raise ValueError(f"Unknown metrics sink: {name}")
@@ -0,0 +1,93 @@
+import json
+import time
+
+import pytest
+
+from .metrics import EmfSink, JsonLogSink, NullSink, RequestMetrics, make_sink
+
+
+def test_request_metrics():
+    metrics = RequestMetrics()
+    with metrics.phase("parse"):
+        time.sleep(0.01)
+
+    metrics.set(route="stop")
+    metrics.record_downstream(1, "https://b.com", status=200)
+    metrics.record_downstream(0, "https://a.com", error="timeout")
+    metrics.record_downstream(1, "https://b.com", total_ms=5.0)
+
+    result = metrics.as_dict()
+    assert result["phases"]["parse"] >= 10
+    assert result["total_ms"] >= result["phases"]["parse"]
+    assert result["route"] == "stop"
+    assert result["downstreams"] == [
+        {"url": "https://a.com", "error": "timeout"},
+        {"url": "https://b.com", "status": 200, "total_ms": 5.0},
+    ]
+
+
+def test_json_log_sink(capsys):
+    JsonLogSink().emit({"total_ms": 1.5, "phases": {}, "route": None})
+    out = capsys.readouterr().out
+    assert out.count("\n") == 1
+    assert json.loads(out) == {"total_ms": 1.5, "phases": {}, "route": None}
+
+
+def test_emf_sink(capsys):
+    EmfSink(namespace="Test").emit(
+        {"total_ms": 3.0, "phases": {"parse": 1.0, "fanout": 2.0}, "route": "stop"}
+    )
+    emitted = json.loads(capsys.readouterr().out)
+
+    assert emitted["_aws"]["CloudWatchMetrics"] == [
+        {
+            "Namespace": "Test",
+            "Dimensions": [["route"]],
+            "Metrics": [
+                {"Name": "total_ms", "Unit": "Milliseconds"},
+                {"Name": "parse_ms", "Unit": "Milliseconds"},
+                {"Name": "fanout_ms", "Unit": "Milliseconds"},
+            ],
+        }
+    ]
+    assert emitted["route"] == "stop"
+    assert emitted["parse_ms"] == 1.0
+    assert emitted["fanout_ms"] == 2.0
+    assert emitted["total_ms"] == 3.0
+
+
+def test_emit_deliveries(capsys):
+    totals = {"delivered": 2, "retried": 1, "abandoned": 0}
+
+    JsonLogSink().emit_deliveries("redelivery", totals)
+    assert json.loads(capsys.readouterr().out) == {"redelivery": totals}
+
+    EmfSink(namespace="Test").emit_deliveries("delivery", totals)
+    emitted = json.loads(capsys.readouterr().out)
+    assert emitted["_aws"]["CloudWatchMetrics"] == [
+        {
+            "Namespace": "Test",
+            "Dimensions": [["handler"]],
+            "Metrics": [
+                {"Name": "delivered", "Unit": "Count"},
+                {"Name": "retried", "Unit": "Count"},
+                {"Name": "abandoned", "Unit": "Count"},
+            ],
+        }
+    ]
+    assert emitted["handler"] == "delivery"
+    assert emitted["delivered"] == 2
+    assert emitted["delivery"] == totals
+
+    NullSink().emit_deliveries("delivery", totals)
+    assert capsys.readouterr().out == ""
+
+
+def test_make_sink():
+    assert isinstance(make_sink(None), JsonLogSink)
+    assert isinstance(make_sink("json"), JsonLogSink)
+    assert isinstance(make_sink("emf"), EmfSink)
+    assert isinstance(make_sink("none"), NullSink)
+
+    with pytest.raises(ValueError):
+        make_sink("statsd")
@@ -2,17 +2,33 @@ import concurrent.futures
 import logging
 import os
 import re
-import string
-import sys
-from typing import Any, Dict, Optional, Tuple
-from urllib.parse import parse_qsl
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple, Union
 
-import requests
-import sentry_sdk
-from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
-from twilio.request_validator import RequestValidator
-
-from .config import Config, parse_config
+from .breaker import CircuitBreaker, CircuitBreakers
+from .cache import Reply, ResponseCache
+from .config import Config, normalize_body, parse_config, parse_config_file
+from .config_provider import POLL_INTERVAL, ConfigProvider, make_source
+from .dedupe import Deduper, DedupeStore, dedupe_key, make_store
+from .deliveries import (
+    DeliveryJob,
+    DeliveryQueue,
+    RedeliveryStats,
+    deliver_jobs,
+    is_retryable_status,
+    make_queue,
+    redeliver_batch,
+)
+from .engines import Engine, make_engine
+from .forms import FORM_CONTENT_TYPE, FormBody
+from .hedging import LatencyTracker
+from .histograms import FLUSH_INTERVAL, LatencyHistograms
+from .limits import DownstreamLimiters
+from .metrics import JsonLogSink, MetricsSink, RequestMetrics, elapsed_ms, make_sink
+from .profiling import Profiler, make_profiler
+from .signing import Signer, canonicalize_params
+from .tenants import TenantConfig, TenantRegistry, TenantsConfig, load_tenants
 
 # Which request headers should be passed downstream
 PRESERVE_HEADERS = {"content-type", "i-twilio-idempotency-token", "user-agent"}
@@ -21,6 +37,46 @@ PRESERVE_HEADERS = {"content-type", "i-twilio-idempotency-token", "user-agent"}
 # Twilio has a default timeout of 15 seconds we we will wait up to 10
 DOWNSTREAM_TIMEOUT = 10
 
+# How much of the Lambda invocation's remaining time to hold back for
+# replying to Twilio once the fan-out deadline has passed (in seconds)
+DEADLINE_MARGIN = 0.5
+
+
+def fanout_deadline(context: Any) -> float:
+    # The time.monotonic() by which we stop waiting for downstreams: at most
+    # DOWNSTREAM_TIMEOUT from now, and never past the end of the invocation
+    budget = float(DOWNSTREAM_TIMEOUT)
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        invocation_remaining = context.get_remaining_time_in_millis() / 1000
+        budget = min(budget, invocation_remaining - DEADLINE_MARGIN)
+
+    return time.monotonic() + max(budget, 0)
+
+
+def time_remaining(deadline: float) -> float:
+    return max(deadline - time.monotonic(), 0)
+
+
+# sentry_sdk is only imported once something goes wrong (or when the Lambda
+# handler initializes it), which keeps it off the import path. Until
+# init_sentry() is called these are no-ops.
+def capture_exception(error: BaseException) -> None:
+    import sentry_sdk
+
+    sentry_sdk.capture_exception(error)
+
+
+def capture_message(message: str) -> None:
+    import sentry_sdk
+
+    sentry_sdk.capture_message(message)
+
+
+def done_future(result: Any) -> concurrent.futures.Future:
+    future: concurrent.futures.Future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
 
 def is_nonempty_twiml_response(response: Any) -> bool:
     if response.status_code < 200 or response.status_code >= 300:
@@ -39,130 +95,1063 @@ def is_nonempty_twiml_response(response: Any) -> bool:
     return True
 
 
+# A config and the state built from it (see TwilioMuxer.set_config()). It's
+# replaced as a whole, and each request reads it once, so a request sees the
+# same config, breakers, limiters, deduper and caches from start to finish
+# even if a reload swaps in new ones halfway through.
+class ConfigState(NamedTuple):
+    config: Config
+    breakers: Optional[CircuitBreakers]
+    limiters: Optional[DownstreamLimiters]
+    deduper: Optional[Deduper]
+    response_caches: Dict[Optional[str], ResponseCache]
+
+
 class TwilioMuxer:
-    def __init__(self, twilio_auth_token: str, muxer_url: str, config: Config):
-        self.validator = RequestValidator(twilio_auth_token)
+    def __init__(
+        self,
+        twilio_auth_token: str,
+        muxer_url: str,
+        config: Config,
+        engine: Optional[Engine] = None,
+        metrics_sink: Optional[MetricsSink] = None,
+        retry_queue: Optional[DeliveryQueue] = None,
+        config_provider: Optional[ConfigProvider] = None,
+        dedupe_store: Optional[DedupeStore] = None,
+        delivery_queue: Optional[DeliveryQueue] = None,
+        histograms: Optional[LatencyHistograms] = None,
+        profiler: Optional[Profiler] = None,
+        tenants: Optional[TenantsConfig] = None,
+    ):
+        self.signer = Signer(twilio_auth_token)
         self.muxer_url = muxer_url
-        self.config = config
+
+        # Sends the downstream requests (see engines.py). The engine and its
+        # connection pools live as long as the container, so deliveries we don't
+        # wait for (see Config.respond_early) can keep running after we've
+        # replied.
+        self.engine = engine or make_engine(config)
+        self.metrics_sink = metrics_sink or JsonLogSink()
+
+        # Where failed non-responder deliveries go to be retried (optional)
+        self.retry_queue = retry_queue
+
+        # Where deliveries for routes without a responder go, to be sent by
+        # delivery_handler instead of while Twilio waits (optional)
+        self.delivery_queue = delivery_queue
+
+        # Where webhooks are deduped across containers (optional; see
+        # Config.dedupe)
+        self.dedupe_store = dedupe_store
+
+        self.state = self.build_state(config, None)
+
+        # Reloads the config in the background (optional)
+        self.config_provider = config_provider
+        if config_provider is not None:
+            config_provider.on_change = self.set_config
+
+        # Recent latencies per downstream, for hedging between responders
+        self.latencies = LatencyTracker()
+
+        # Latency distributions per route and downstream, flushed to the
+        # metrics sink every so often (see histograms.py)
+        self.histograms = histograms or LatencyHistograms()
+
+        # Profiles a sample of requests (optional; see profiling.py)
+        self.profiler = profiler
+
+        # Other Twilio accounts we handle webhooks for (optional; see
+        # tenants.py). Each gets its own muxer, built by build_tenant();
+        # webhooks that aren't for one of them are ours. Their signers are
+        # made up front (one per tenant, and cheap), so signing queued
+        # deliveries doesn't build muxers.
+        self.tenant: Optional[str] = None
+        self.tenants: Optional[TenantRegistry["TwilioMuxer"]] = None
+        self.tenant_signers: Dict[str, Signer] = {}
+        if tenants is not None:
+            self.tenants = TenantRegistry(
+                tenants, self.build_tenant, on_evict=self.evict_tenant
+            )
+            self.tenant_signers = {
+                name: Signer(tenant.auth_token)
+                for name, tenant in tenants.tenants.items()
+            }
+
+        self.pending: Set[concurrent.futures.Future] = set()
+        self.pending_lock = threading.Lock()
+
+    def set_config(self, config: Config) -> None:
+        # Swap in a new config, along with the state built from it, in a single
+        # assignment. Requests already in flight finish with the state they
+        # started with. The engine isn't rebuilt, so changes to engine and
+        # max_concurrency only take effect in new containers.
+        self.state = self.build_state(config, self.state)
+
+    def build_state(
+        self, config: Config, previous: Optional[ConfigState]
+    ) -> ConfigState:
+        # Replying early means queueing the deliveries we don't wait for (see
+        # fan_out()), so there has to be somewhere to queue them
+        if (
+            config.respond_early
+            and self.delivery_queue is None
+            and self.retry_queue is None
+        ):
+            raise ValueError("respond_early requires DELIVERY_QUEUE or RETRY_QUEUE")
+
+        # Per-downstream circuit breakers (optional), kept across reloads
+        # unless their settings changed
+        breakers = previous.breakers if previous is not None else None
+        if config.circuit_breaker is None:
+            breakers = None
+        elif breakers is None or breakers.breaker_args != config.circuit_breaker.dict():
+            breakers = CircuitBreakers(**config.circuit_breaker.dict())
+
+        # Requests still waiting on a host's limits when we stop waiting for
+        # downstreams are never sent, only queued for retry, so without a
+        # retry queue they'd be dropped
+        if config.downstream_limits is not None and self.retry_queue is None:
+            raise ValueError("downstream_limits requires RETRY_QUEUE")
+
+        # Per-downstream-host limits (optional), likewise kept unless their
+        # settings changed. Requests already queued by a replaced limiter are
+        # still sent by it.
+        limiters = previous.limiters if previous is not None else None
+        if config.downstream_limits is None:
+            limiters = None
+        else:
+            limit_args = {
+                key: limit.dict() for key, limit in config.downstream_limits.items()
+            }
+            if limiters is None or limiters.limit_args != limit_args:
+                limiters = DownstreamLimiters(limit_args)
+
+        # Webhooks we've seen (optional), kept unless their settings changed
+        deduper = previous.deduper if previous is not None else None
+        if config.dedupe is None:
+            deduper = None
+        elif (
+            deduper is None
+            or deduper.ttl != config.dedupe.ttl
+            or deduper.max_entries != config.dedupe.max_entries
+        ):
+            deduper = Deduper(
+                config.dedupe.ttl,
+                config.dedupe.max_entries,
+                store=self.dedupe_store,
+                on_error=capture_exception,
+            )
+
+        # Cached replies, per keyword (None for the default, and the rule's
+        # name for rules with their own route); a new config starts with
+        # empty caches
+        response_caches: Dict[Optional[str], ResponseCache] = {
+            keyword: ResponseCache(
+                keyword_config.cache.ttl,
+                keyword_config.cache.stale_ttl,
+                keyword_config.cache.max_entries,
+            )
+            for keyword, keyword_config in [
+                (None, config.default),
+                *config.keywords.items(),
+                # Every rule gets its own cache, even one using a keyword's
+                # route: its messages aren't rewritten to the keyword, so its
+                # replies can't be shared with the keyword's
+                *((route.rule, route.config) for route in config.rule_index.routes),
+            ]
+            if keyword_config.cache is not None
+        }
+
+        # Likewise for replying from the cache
+        if response_caches and self.delivery_queue is None and self.retry_queue is None:
+            raise ValueError("cache requires DELIVERY_QUEUE or RETRY_QUEUE")
+
+        return ConfigState(config, breakers, limiters, deduper, response_caches)
+
+    def build_tenant(self, name: str, tenant: TenantConfig) -> "TwilioMuxer":
+        # A muxer for one of our tenants, with its own auth token, callback
+        # URL and config. Everything that isn't specific to the tenant is
+        # shared with us: the engine (and so its connection pools), queues,
+        # metrics, profiler, and deliveries still running in the background.
+        config_provider = None
+        if tenant.config_source is not None:
+            config_provider = ConfigProvider(
+                make_source(tenant.config_source),
+                interval=(
+                    self.config_provider.interval
+                    if self.config_provider is not None
+                    else POLL_INTERVAL
+                ),
+                on_error=capture_exception,
+            )
+            config = config_provider.config
+        else:
+            config = Config(**(tenant.config or {}))
+
+        muxer = TwilioMuxer(
+            twilio_auth_token=tenant.auth_token,
+            muxer_url=tenant.callback_url,
+            config=config,
+            engine=self.engine,
+            metrics_sink=self.metrics_sink,
+            retry_queue=self.retry_queue,
+            config_provider=config_provider,
+            dedupe_store=self.dedupe_store,
+            delivery_queue=self.delivery_queue,
+            histograms=self.histograms,
+            profiler=self.profiler,
+        )
+        muxer.tenant = name
+        muxer.latencies = self.latencies
+        muxer.pending = self.pending
+        muxer.pending_lock = self.pending_lock
+        return muxer
+
+    def evict_tenant(self, name: str, muxer: "TwilioMuxer") -> None:
+        # A tenant's muxer was dropped from the registry. Its config provider
+        # goes with it (a rebuild loads the config again), and stops swapping
+        # configs into it, so nothing keeps it alive.
+        if muxer.config_provider is not None:
+            muxer.config_provider.on_change = None
+
+    def signer_for(self, tenant: str) -> Signer:
+        # Signs queued deliveries for one of our tenants (see
+        # DeliveryJob.tenant)
+        signer = self.tenant_signers.get(tenant)
+        if signer is not None:
+            return signer
+
+        logging.warning(f"Signing a delivery for unknown tenant {tenant} as our own")
+        return self.signer
 
     def mux_request(
-        self, request_body: str, request_headers: Dict[str, str]
+        self,
+        request_body: Union[str, bytes, FormBody],
+        request_headers: Dict[str, str],
+        deadline: Optional[float] = None,
+        path: Optional[str] = None,
     ) -> Tuple[int, str, Dict[str, str]]:
-        parsed_body = dict(parse_qsl(request_body, keep_blank_values=True))
-
-        request_valid = self.validator.validate(
-            self.muxer_url,
-            parsed_body,
-            request_headers.get(
-                "x-twilio-signature", request_headers.get("X-Twilio-Signature")
-            ),
-        )
+        # Hand webhooks for our tenants (by the path they were posted to, or
+        # their AccountSid) to the tenant's muxer
+        if self.tenants is not None:
+            form = FormBody.parse(request_body)
+            name = self.tenants.find(path, form.params.get("AccountSid"))
+            if name is not None:
+                return self.tenants.get(name).mux_request(
+                    form, request_headers, deadline
+                )
+            request_body = form
+
+        metrics = RequestMetrics()
+        try:
+            if self.profiler is None:
+                return self.mux_request_with_metrics(
+                    request_body, request_headers, deadline, metrics
+                )
+
+            with self.profiler.profile(metrics):
+                return self.mux_request_with_metrics(
+                    request_body, request_headers, deadline, metrics
+                )
+        except Exception as e:
+            metrics.set(error=type(e).__name__)
+            raise
+        finally:
+            self.metrics_sink.emit(metrics.as_dict())
+            self.histograms.maybe_flush(self.metrics_sink)
+            self.metrics_sink.flush()
+
+    def mux_request_with_metrics(
+        self,
+        request_body: Union[str, bytes, FormBody],
+        request_headers: Dict[str, str],
+        deadline: Optional[float],
+        metrics: RequestMetrics,
+    ) -> Tuple[int, str, Dict[str, str]]:
+        if deadline is None:
+            deadline = fanout_deadline(None)
+
+        # The config can be swapped by a reload at any time, so read it (and
+        # the state built from it) once and use it for the whole request
+        state = self.state
+        if self.config_provider is not None:
+            self.config_provider.maybe_refresh()
+
+        metrics.set(budget_ms=round(time_remaining(deadline) * 1000, 3))
+        if self.tenant is not None:
+            metrics.set(tenant=self.tenant)
+
+        with metrics.phase("parse"):
+            form = FormBody.parse(request_body)
+            parsed_body = form.params
+
+            # Canonicalized once and shared by validation and every downstream
+            # signature (unless we rewrite the body below)
+            canonical_params = canonicalize_params(parsed_body)
+
+        with metrics.phase("validate"):
+            request_valid = self.signer.validate(
+                self.muxer_url,
+                canonical_params,
+                request_headers.get(
+                    "x-twilio-signature", request_headers.get("X-Twilio-Signature")
+                ),
+            )
 
         if not request_valid:
             raise RuntimeError(f"Invalid Twilio signature")
 
-        request_body_normalized = " ".join(
-            parsed_body.get("Body", "")
-            .translate(str.maketrans("", "", string.punctuation))
-            .strip()
-            .lower()
-            .split()
-        )
+        def fan_out() -> Reply:
+            return self.fan_out(
+                state,
+                form,
+                canonical_params,
+                request_headers,
+                deadline,
+                metrics,
+            )
+
+        # Only once we know the webhook is really from Twilio
+        deduper = state.deduper
+        key = dedupe_key(request_headers, parsed_body) if deduper else None
+        if deduper is None or key is None:
+            return fan_out()
+
+        reply, deduped = deduper.run(key, time_remaining(deadline), fan_out)
+        if deduped is not None:
+            metrics.set(deduped=deduped, status_code=reply[0])
+        return reply
 
-        for keyword, config in self.config.keywords.items():
-            if keyword == request_body_normalized:
-                print(f"Normalized {request_body_normalized} -> {keyword}")
-            elif config.alternates and request_body_normalized in config.alternates:
-                print(f"Normalized alternate {request_body_normalized} -> {keyword}")
+    def fan_out(
+        self,
+        state: ConfigState,
+        form: FormBody,
+        canonical_params: bytes,
+        request_headers: Dict[str, str],
+        deadline: float,
+        metrics: RequestMetrics,
+    ) -> Reply:
+        config = state.config
+        parsed_body = form.params
+
+        with metrics.phase("normalize"):
+            request_body_normalized = normalize_body(parsed_body.get("Body", ""))
+
+        with metrics.phase("route"):
+            match = "exact"
+            route = config.route(request_body_normalized)
+            if route is None:
+                with metrics.phase("fuzzy"):
+                    match = "fuzzy"
+                    route = config.fuzzy_route(request_body_normalized)
+            if route is None and config.rules:
+                with metrics.phase("rules"):
+                    match = "rule"
+                    route = config.rule_route(request_body_normalized, parsed_body)
+
+            if route is not None:
+                # clean up downstream request too (but rules pass the message
+                # on as it is)
+                if route.rule is None and parsed_body.get("Body") != route.keyword:
+                    form = form.replace("Body", route.keyword)
+                    parsed_body = form.params
+                    canonical_params = canonicalize_params(parsed_body)
+                request_config = route.config
             else:
-                continue
-            request_body_normalized = keyword
-            # clean up downstream request too
-            parsed_body["Body"] = keyword
-            break
+                match = "default"
+                request_config = config.default
+
+        metrics.set(route=route.keyword if route else None, match=match)
+        route_name = route.keyword if route else "<default>"
+        if self.tenant is not None:
+            route_name = f"{self.tenant}:{route_name}"
+        if route is not None and route.rule is not None:
+            metrics.set(rule=route.rule)
 
-        request_config = self.config.keywords.get(
-            request_body_normalized, self.config.default
+        cache = state.response_caches.get(
+            (route.rule or route.keyword) if route else None
         )
+        cache_key: Tuple[Optional[str], ...] = ()
+        cached_reply: Optional[Reply] = None
+        if cache is not None and request_config.cache is not None:
+            cache_key = tuple(
+                parsed_body.get(field) for field in request_config.cache.key_fields
+            )
+            cached_reply, fresh = cache.get(cache_key)
+            metrics.set(
+                cache="miss" if cached_reply is None else "hit" if fresh else "stale"
+            )
 
-        def make_downstream_request(url: str) -> Optional[requests.Response]:
-            downstream_headers = {
-                k: v
-                for k, v in request_headers.items()
-                if k.lower() in PRESERVE_HEADERS
-            }
+        preserved_headers = {
+            k: v for k, v in request_headers.items() if k.lower() in PRESERVE_HEADERS
+        }
+        # We forward the encoded body as it is, so it needs a content type
+        if not any(k.lower() == "content-type" for k in preserved_headers):
+            preserved_headers["Content-Type"] = FORM_CONTENT_TYPE
 
-            downstream_headers["X-Twilio-Signature"] = self.validator.compute_signature(
-                url, parsed_body
-            )
+        # Deliveries we won't wait for are queued before we reply, rather than
+        # left running once we have (where they'd be lost if the container is
+        # frozen or reaped before they finish): every downstream without a
+        # responder, if there's a delivery queue, every non-responder when we
+        # reply early, and everything but the responder (whose reply
+        # refreshes the cache) when we reply from the cache. delivery_handler
+        # sends them (or retry_handler, if there's only a retry queue).
+        # Anything we can't queue is sent as usual.
+        deferred: List[int] = []
+        if (
+            config.respond_early
+            or cached_reply is not None
+            or (request_config.responder is None and self.delivery_queue is not None)
+        ):
+            sent_now = request_config.responders
+            if cached_reply is not None:
+                sent_now = [request_config.responders[0]]
+            deferred = [
+                i for i in range(len(request_config.downstreams)) if i not in sent_now
+            ]
 
-            try:
-                result = requests.post(
-                    url, data=parsed_body, headers=downstream_headers
+        delivery_queued: Set[int] = set()
+        if deferred:
+            with metrics.phase("enqueue"):
+                delivery_queued = self.enqueue_deliveries(
+                    request_config.downstreams,
+                    deferred,
+                    parsed_body,
+                    preserved_headers,
+                    metrics,
                 )
-            except Exception as e:
-                logging.exception(f"Request failed to downstream {url}")
-                sentry_sdk.capture_exception(e)
-                return None
+
+            if len(delivery_queued) == len(request_config.downstreams):
+                reply = self.responder_reply(None, {})
+                metrics.set(responder=None, status_code=reply[0])
+                return reply
+
+        # Deliveries that fail are queued to be retried later (see
+        # retry_handler), except the one whose reply we send to Twilio. A
+        # delivery can fail more than one way (e.g. time out and then error),
+        # but is only queued once. Which responder we reply with isn't known
+        # until we've chosen it (see replying_with()), so until then their
+        # retries are held.
+        queued_for_retry: Set[int] = set()
+        queued_lock = threading.Lock()
+        replied: List[Optional[int]] = []
+        held_retries: List[Tuple[int, str]] = []
+
+        def queue_retry(index: int, url: str) -> None:
+            if self.retry_queue is None:
+                return
+
+            with queued_lock:
+                if index in queued_for_retry:
+                    return
+                if index in request_config.responders:
+                    if not replied:
+                        held_retries.append((index, url))
+                        return
+                    if index == replied[0]:
+                        return
+                queued_for_retry.add(index)
 
             try:
-                result.raise_for_status()
+                self.retry_queue.put(
+                    DeliveryJob(
+                        url=url,
+                        params=dict(parsed_body),
+                        headers=preserved_headers,
+                        tenant=self.tenant,
+                    )
+                )
             except Exception as e:
-                logging.exception(
-                    f"Request to downstream {url} return status code {result.status_code}"
+                logging.exception(f"Failed to queue retry for downstream {url}")
+                capture_exception(e)
+                return
+
+            metrics.record_downstream(index, url, queued_for_retry=True)
+
+        def replying_with(responder: Optional[int]) -> None:
+            # The responder whose reply Twilio gets (None if it's not any of
+            # theirs); the others' held retries can now be queued
+            with queued_lock:
+                replied.append(responder)
+                held = list(held_retries)
+            for index, url in held:
+                queue_retry(index, url)
+
+        def record_breaker_transition(index: int, url: str, state: str) -> None:
+            metrics.record_downstream(index, url, breaker=state)
+            logging.warning(f"Circuit breaker for downstream {url} is now {state}")
+
+        def give_up(index: int, url: str, reason: str) -> None:
+            metrics.record_downstream(index, url, error=reason)
+            queue_retry(index, url)
+
+        def skip(index: int, url: str, reason: str) -> concurrent.futures.Future:
+            give_up(index, url, reason)
+            return done_future(None)
+
+        def make_downstream_request(index: int, url: str) -> concurrent.futures.Future:
+            if time_remaining(deadline) <= 0:
+                return skip(index, url, "budget_exhausted")
+
+            breaker = state.breakers[url] if state.breakers is not None else None
+            if breaker is not None:
+                allowed, transition = breaker.allow()
+                if transition is not None:
+                    record_breaker_transition(index, url, transition)
+                if not allowed:
+                    return skip(index, url, "breaker_open")
+
+            downstream_headers = dict(preserved_headers)
+            downstream_headers["X-Twilio-Signature"] = self.signer.sign(
+                url, canonical_params
+            )
+
+            limiter = (
+                state.limiters.for_url(url) if state.limiters is not None else None
+            )
+            if limiter is None:
+                return send(index, url, downstream_headers, breaker)
+
+            # Over the host's limits, the request waits in the limiter's queue.
+            # If we stop waiting for it at the deadline, the future is
+            # cancelled and it's never sent (see wait_for_downstreams());
+            # otherwise, by the time it's let through it may be out of budget.
+            # Either way it's queued for retry, as for a timeout.
+            queued_at = time.perf_counter()
+            limited: concurrent.futures.Future = concurrent.futures.Future()
+
+            def start(sequence: int) -> bool:
+                if not limited.set_running_or_notify_cancel():
+                    return False
+
+                metrics.record_downstream(index, url, queued_ms=elapsed_ms(queued_at))
+                if time_remaining(deadline) <= 0:
+                    give_up(index, url, "budget_exhausted")
+                    limited.set_result(None)
+                    return False
+
+                sent_at = time.perf_counter()
+
+                def finished(future: concurrent.futures.Future) -> None:
+                    result = None
+                    error = None
+                    if not future.cancelled():
+                        error = future.exception()
+                        if error is None:
+                            result = future.result()
+
+                    limiter.release(
+                        sequence,
+                        failed=result is None
+                        or is_retryable_status(result.status_code),
+                        latency=time.perf_counter() - sent_at,
+                    )
+
+                    if error is not None:
+                        limited.set_exception(error)
+                    else:
+                        limited.set_result(result)
+
+                send(index, url, downstream_headers, breaker).add_done_callback(
+                    finished
                 )
-                sentry_sdk.capture_exception(e)
+                return True
 
-            # We return result whether or not raise_for_status() errored -- we're
-            # just doing raise_for_status so we can capture errors; we always want
-            # to return the result
-            return result
+            limiter.submit(limited, start)
+            return limited
 
-        print(f"Making requests to downstreams: {request_config.downstreams}")
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(
-                executor.map(make_downstream_request, request_config.downstreams)
+        def send(
+            index: int,
+            url: str,
+            downstream_headers: Dict[str, str],
+            breaker: Optional[CircuitBreaker],
+        ) -> concurrent.futures.Future:
+            # The read timeout applies per socket read, so we also clamp it to
+            # the remaining budget; the overall deadline is enforced when we
+            # wait on the futures below.
+            budget = time_remaining(deadline)
+            timeout = (
+                min(request_config.connect_timeout or DOWNSTREAM_TIMEOUT, budget),
+                min(request_config.read_timeout or DOWNSTREAM_TIMEOUT, budget),
             )
 
-        print(f"Downstream responses: {results}")
-        print(f"Taking result from responder: {request_config.responder}")
+            submitted = time.perf_counter()
+
+            def on_complete(
+                result: Any, error: Optional[BaseException], timings: Dict[str, float]
+            ) -> Any:
+                if breaker is not None:
+                    failed = error is not None or is_retryable_status(
+                        result.status_code
+                    )
+                    transition = breaker.record(
+                        failed, latency=time.perf_counter() - submitted
+                    )
+                    if transition is not None:
+                        record_breaker_transition(index, url, transition)
+
+                metrics.record_downstream(
+                    index,
+                    url,
+                    total_ms=elapsed_ms(submitted),
+                    **{
+                        f"{name}_ms": round(seconds * 1000, 3)
+                        for name, seconds in timings.items()
+                    },
+                )
+
+                if error is not None:
+                    metrics.record_downstream(index, url, error=type(error).__name__)
+                    logging.exception(
+                        f"Request failed to downstream {url}", exc_info=error
+                    )
+                    capture_exception(error)
+                    queue_retry(index, url)
+                    return None
+
+                latency = time.perf_counter() - submitted
+                self.latencies.record(url, latency)
+                self.histograms.record(route_name, url, latency * 1000)
+                metrics.record_downstream(index, url, status=result.status_code)
+                if is_retryable_status(result.status_code):
+                    queue_retry(index, url)
+
+                try:
+                    result.raise_for_status()
+                except Exception as e:
+                    logging.exception(
+                        f"Request to downstream {url} return status code {result.status_code}"
+                    )
+                    capture_exception(e)
+
+                # We return result whether or not raise_for_status() errored -- we're
+                # just doing raise_for_status so we can capture errors; we always want
+                # to return the result
+                return result
+
+            return self.engine.submit(
+                url, form.raw, downstream_headers, timeout, on_complete
+            )
+
+        with metrics.phase("fanout"):
+            responders = request_config.responders
+            hedge_delay = None
+            if len(responders) > 1 and request_config.hedge_percentile is not None:
+                hedge_delay = self.latencies.percentile(
+                    request_config.downstreams[responders[0]],
+                    request_config.hedge_percentile,
+                )
+            hedge_at = (
+                time.monotonic() + hedge_delay if hedge_delay is not None else None
+            )
+
+            futures = [
+                (
+                    done_future(None)
+                    if i in delivery_queued
+                    else make_downstream_request(i, url)
+                )
+                for i, url in enumerate(request_config.downstreams)
+            ]
+
+            responder = request_config.responder
+            if cached_reply is not None and responder is not None:
+                # Reply from the cache right away. The other downstreams were
+                # queued above; the responder's request finishes in the
+                # background (see drain()), and its reply refreshes the cache.
+                # Twilio never gets that reply, so it's retried if it fails.
+                replying_with(None)
+                self.track_pending(futures)
+
+                def refresh(future: concurrent.futures.Future) -> None:
+                    if cache is not None and not future.cancelled():
+                        self.cache_reply(cache, cache_key, future.result())
+
+                futures[responder].add_done_callback(refresh)
+                metrics.set(responder=responder, status_code=cached_reply[0])
+                return cached_reply
+
+            if len(responders) > 1:
+                responder = self.choose_responder(
+                    responders, futures, deadline, hedge_at
+                )
+            replying_with(responder)
 
-        if request_config.responder is None:
+            if config.respond_early:
+                # Only wait for the responder. The other downstreams were
+                # queued above; the responders we didn't choose (and anything
+                # we couldn't queue) finish in the background (see drain()).
+                self.track_pending(futures)
+                waiting_on = [] if responder is None else [responder]
+            else:
+                waiting_on = list(range(len(futures)))
+
+            def on_timeout(index: int, url: str) -> None:
+                metrics.record_downstream(index, url, error="timeout")
+                queue_retry(index, url)
+
+            results = self.wait_for_downstreams(
+                request_config.downstreams, futures, waiting_on, deadline, on_timeout
+            )
+
+        with metrics.phase("respond"):
+            reply = self.responder_reply(responder, results)
+            if cache is not None and responder is not None:
+                self.cache_reply(cache, cache_key, results[responder])
+
+        metrics.set(responder=responder, status_code=reply[0])
+        return reply
+
+    def enqueue_deliveries(
+        self,
+        downstreams: List[str],
+        indexes: List[int],
+        params: Dict[str, str],
+        headers: Dict[str, str],
+        metrics: RequestMetrics,
+    ) -> Set[int]:
+        # Queue a delivery to the downstreams at each of the indexes, on the
+        # delivery queue if there is one and otherwise the retry queue.
+        # Returns the indexes of the ones we queued.
+        queue = (
+            self.delivery_queue if self.delivery_queue is not None else self.retry_queue
+        )
+        assert queue is not None
+
+        queued = set()
+        for index in indexes:
+            url = downstreams[index]
+            try:
+                queue.put(
+                    DeliveryJob(
+                        url=url,
+                        params=dict(params),
+                        headers=headers,
+                        tenant=self.tenant,
+                    )
+                )
+            except Exception as e:
+                logging.exception(f"Failed to queue delivery to downstream {url}")
+                capture_exception(e)
+                continue
+
+            queued.add(index)
+            metrics.record_downstream(index, url, delivery_queued=True)
+
+        return queued
+
+    def responder_reply(
+        self, responder: Optional[int], results: Dict[int, Optional[Any]]
+    ) -> Tuple[int, str, Dict[str, str]]:
+        if responder is None:
             return 200, "<Response></Response>", {"Content-Type": "application/xml"}
 
-        result = results[request_config.responder]
+        result = results[responder]
         if result is None:
             return 500, "<Response></Response>", {"Content-Type": "application/xml"}
 
+        return self.result_reply(result)
+
+    def result_reply(self, result: Any) -> Reply:
         return (
             result.status_code,
             result.text,
             {"Content-Type": result.headers.get("Content-Type", "application/xml")},
         )
 
+    def cache_reply(
+        self, cache: ResponseCache, key: Tuple[Any, ...], result: Optional[Any]
+    ) -> None:
+        # Only non-empty TwiML replies are cached, never errors or empty
+        # replies
+        if result is not None and is_nonempty_twiml_response(result):
+            cache.put(key, self.result_reply(result))
+
+    def choose_responder(
+        self,
+        responders: List[int],
+        futures: List[concurrent.futures.Future],
+        deadline: float,
+        hedge_at: Optional[float],
+    ) -> int:
+        # Wait for the first non-empty TwiML reply from the responders, in
+        # order of preference: a fallback's reply is only used once every
+        # responder before it has replied with something else (or failed), or
+        # once we're past hedge_at. If none of them gives a good reply by the
+        # deadline, we fall back on the first responder's reply, whatever it is.
+        while True:
+            hedging = hedge_at is not None and time.monotonic() >= hedge_at
+            for i in responders:
+                if not futures[i].done():
+                    if hedging:
+                        continue
+                    break
+
+                result = futures[i].result()
+                if result is not None and is_nonempty_twiml_response(result):
+                    return i
+
+            pending = [futures[i] for i in responders if not futures[i].done()]
+            timeout = time_remaining(deadline)
+            if not pending or timeout <= 0:
+                return responders[0]
+
+            if not hedging and hedge_at is not None:
+                timeout = min(timeout, max(hedge_at - time.monotonic(), 0))
+
+            concurrent.futures.wait(
+                pending,
+                timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
 
-if "pytest" not in sys.modules:
+    def wait_for_downstreams(
+        self,
+        downstreams: List[str],
+        futures: List[concurrent.futures.Future],
+        waiting_on: List[int],
+        deadline: float,
+        on_timeout: Callable[[int, str], None],
+    ) -> Dict[int, Optional[Any]]:
+        # Wait until the deadline for the downstream requests at the given
+        # indexes. Anything still outstanding is cancelled and recorded as a
+        # timeout (a None result).
+        done, _ = concurrent.futures.wait(
+            [futures[i] for i in waiting_on], timeout=time_remaining(deadline)
+        )
+
+        results: Dict[int, Optional[Any]] = {}
+        for i in waiting_on:
+            if futures[i] in done:
+                results[i] = futures[i].result()
+                continue
+
+            # If the request is already running this can't stop it, but it
+            # will stop a queued request from ever being sent
+            futures[i].cancel()
+            on_timeout(i, downstreams[i])
+            logging.warning(f"Timed out waiting for downstream {downstreams[i]}")
+            capture_message(f"Timed out waiting for downstream {downstreams[i]}")
+            results[i] = None
+
+        return results
+
+    def track_pending(self, futures: List[concurrent.futures.Future]) -> None:
+        with self.pending_lock:
+            self.pending.update(futures)
+
+        for future in futures:
+            future.add_done_callback(self.untrack_pending)
+
+    def untrack_pending(self, future: concurrent.futures.Future) -> None:
+        with self.pending_lock:
+            self.pending.discard(future)
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        # Wait for deliveries that are still running after we replied to
+        # Twilio, then for profiles still being written. Returns whether
+        # everything finished within the timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.pending_lock:
+            pending = list(self.pending)
+
+        _, not_done = concurrent.futures.wait(pending, timeout=timeout)
+        if self.profiler is not None:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+            if not self.profiler.drain(remaining):
+                return False
+        return not not_done
+
+    def flush_histograms(self) -> None:
+        # Flush the latency histograms now, e.g. before shutting down
+        self.histograms.flush(self.metrics_sink)
+        self.metrics_sink.flush()
+
+
+def init_sentry() -> None:
+    import sentry_sdk
+
+    integrations = []
+    if "AWS_LAMBDA_FUNCTION_NAME" in os.environ:
+        from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
+
+        integrations.append(AwsLambdaIntegration())
+
+    # Sentry is optional outside Lambda (see app.server)
     sentry_sdk.init(
-        dsn=os.environ["SENTRY_DSN"],
-        environment=os.environ["SENTRY_ENVIRONMENT"],
-        integrations=[AwsLambdaIntegration()],
+        dsn=os.environ.get("SENTRY_DSN"),
+        environment=os.environ.get("SENTRY_ENVIRONMENT"),
+        integrations=integrations,
+        # Otherwise Sentry imports its integration for every installed library
+        # it knows about (aiohttp, httpx, ...), which adds a lot to cold starts
+        auto_enabling_integrations=False,
     )
 
-    muxer = TwilioMuxer(
-        twilio_auth_token=os.environ["TWILIO_AUTH_TOKEN"],
-        muxer_url=os.environ["TWILIO_CALLBACK_URL"],
-        config=parse_config(os.environ["DOWNSTREAM_CONFIG"]),
-    )
+
+def config_from_env() -> Config:
+    # DOWNSTREAM_CONFIG_FILE (a JSON file) if it's set, otherwise the
+    # base64-encoded DOWNSTREAM_CONFIG
+    if os.environ.get("DOWNSTREAM_CONFIG_FILE"):
+        return parse_config_file(os.environ["DOWNSTREAM_CONFIG_FILE"])
+
+    return parse_config(os.environ["DOWNSTREAM_CONFIG"])
+
+
+# Created by get_muxer(): during the Lambda init phase, or on the first
+# invocation if MUXER_LAZY_INIT is set
+muxer: Optional[TwilioMuxer] = None
+muxer_lock = threading.Lock()
+
+
+def get_muxer() -> TwilioMuxer:
+    global muxer
+
+    if muxer is None:
+        with muxer_lock:
+            if muxer is None:
+                init_sentry()
+                # CONFIG_SOURCE is reloaded while we run; otherwise the
+                # config is fixed
+                config_provider = None
+                if os.environ.get("CONFIG_SOURCE"):
+                    config_provider = ConfigProvider(
+                        make_source(os.environ["CONFIG_SOURCE"]),
+                        interval=float(
+                            os.environ.get("CONFIG_POLL_INTERVAL") or POLL_INTERVAL
+                        ),
+                        on_error=capture_exception,
+                    )
+
+                muxer = TwilioMuxer(
+                    twilio_auth_token=os.environ["TWILIO_AUTH_TOKEN"],
+                    muxer_url=os.environ["TWILIO_CALLBACK_URL"],
+                    config=(
+                        config_provider.config
+                        if config_provider is not None
+                        else config_from_env()
+                    ),
+                    metrics_sink=make_sink(os.environ.get("METRICS_SINK")),
+                    retry_queue=make_queue(os.environ.get("RETRY_QUEUE")),
+                    delivery_queue=make_queue(os.environ.get("DELIVERY_QUEUE")),
+                    dedupe_store=make_store(os.environ.get("DEDUPE_STORE")),
+                    histograms=LatencyHistograms(
+                        float(
+                            os.environ.get("LATENCY_FLUSH_INTERVAL") or FLUSH_INTERVAL
+                        )
+                    ),
+                    profiler=make_profiler(
+                        os.environ.get("PROFILE_SAMPLE_RATE"),
+                        os.environ.get("PROFILE_SINK"),
+                        on_error=capture_exception,
+                    ),
+                    config_provider=config_provider,
+                    tenants=(
+                        load_tenants(make_source(os.environ["TENANTS_SOURCE"]))
+                        if os.environ.get("TENANTS_SOURCE")
+                        else None
+                    ),
+                )
+
+    return muxer
+
+
+# On Lambda, build the muxer while the module is imported so that it happens
+# in the init phase rather than while Twilio is waiting on the first request.
+# Importing the module anywhere else (tests, tools) has no side effects.
+if "AWS_LAMBDA_FUNCTION_NAME" in os.environ and not os.environ.get("MUXER_LAZY_INIT"):
+    get_muxer()
 
 
 def handler(event: Any, context: Any):
     request_body = event["body"]
     request_headers = event["headers"]
 
-    status_code, body, headers = muxer.mux_request(request_body, request_headers)
+    status_code, body, headers = get_muxer().mux_request(
+        request_body,
+        request_headers,
+        deadline=fanout_deadline(context),
+        path=event.get("path"),
+    )
 
     return {
         "statusCode": status_code,
         "headers": headers,
         "body": body,
     }
+
+
+def drain_queue(
+    muxer: TwilioMuxer, queue: DeliveryQueue, context: Any
+) -> Dict[str, int]:
+    # Send queued deliveries in batches until nothing is due, stopping early
+    # enough that a batch can't outlive the invocation
+    totals = {"delivered": 0, "retried": 0, "abandoned": 0}
+
+    def invocation_remaining() -> float:
+        if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+            return float("inf")
+        return context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+
+    while invocation_remaining() >= DOWNSTREAM_TIMEOUT:
+        stats = redeliver_batch(
+            queue,
+            muxer.signer,
+            muxer.engine,
+            timeout=(DOWNSTREAM_TIMEOUT, DOWNSTREAM_TIMEOUT),
+            tenant_signers=muxer.signer_for,
+        )
+        add_stats(totals, stats)
+
+        if not sum(stats):
+            break
+
+    return totals
+
+
+def add_stats(totals: Dict[str, int], stats: RedeliveryStats) -> None:
+    for key, value in stats._asdict().items():
+        totals[key] += value
+
+
+def retry_handler(event: Any, context: Any):
+    # Run on a schedule: redeliver queued deliveries
+    muxer = get_muxer()
+    if muxer.retry_queue is None:
+        return {"delivered": 0, "retried": 0, "abandoned": 0}
+
+    totals = drain_queue(muxer, muxer.retry_queue, context)
+    muxer.metrics_sink.emit_deliveries("redelivery", totals)
+    muxer.metrics_sink.flush()
+    return totals
+
+
+def delivery_handler(event: Any, context: Any):
+    # Sends the deliveries queued in DELIVERY_QUEUE, sharing the muxer's
+    # connection pools. Triggered by the SQS queue, with a batch of its
+    # messages (failures go back on the queue with backoff); or, for other
+    # queues, run on a schedule to drain it.
+    muxer = get_muxer()
+    totals = {"delivered": 0, "retried": 0, "abandoned": 0}
+    if muxer.delivery_queue is None:
+        return totals
+
+    records = (event or {}).get("Records")
+    if records:
+        stats = deliver_jobs(
+            muxer.delivery_queue,
+            [DeliveryJob.parse_raw(record["body"]) for record in records],
+            muxer.signer,
+            muxer.engine,
+            timeout=(DOWNSTREAM_TIMEOUT, DOWNSTREAM_TIMEOUT),
+            tenant_signers=muxer.signer_for,
+        )
+        add_stats(totals, stats)
+    else:
+        totals = drain_queue(muxer, muxer.delivery_queue, context)
+
+    muxer.metrics_sink.emit_deliveries("delivery", totals)
+    muxer.metrics_sink.flush()
+    return totals
@@ -1,10 +1,21 @@
+import base64
+import os
+import threading
+import time
 import urllib.parse
 
+import pytest
 import responses  # type: ignore
 from twilio.request_validator import RequestValidator
 
+from . import muxer as muxer_module
 from .config import Config, KeywordConfig
-from .muxer import TwilioMuxer
+from .deliveries import DeliveryJob, SqliteDeliveryQueue
+from .histograms import LatencyHistograms
+from .metrics import MetricsSink
+from .muxer import DEADLINE_MARGIN, DOWNSTREAM_TIMEOUT, TwilioMuxer, fanout_deadline
+from .profiling import FileProfileSink, Profiler, make_profiler
+from .tenants import TenantsConfig
 
 MOCK_AUTH_TOKEN = "abcd"
 MOCK_MUXER_URL = "https://examplemuxer.com"
@@ -20,11 +31,15 @@ def sign_request(url, parsed_body):
 
 
 def mux_request(config, body="foobar"):
-    muxer = TwilioMuxer(
-        twilio_auth_token=MOCK_AUTH_TOKEN,
-        muxer_url=MOCK_MUXER_URL,
-        config=config,
-    )
+    # Accept either a Config or an already-constructed TwilioMuxer
+    if isinstance(config, TwilioMuxer):
+        muxer = config
+    else:
+        muxer = TwilioMuxer(
+            twilio_auth_token=MOCK_AUTH_TOKEN,
+            muxer_url=MOCK_MUXER_URL,
+            config=config,
+        )
 
     request_with_body = f"Body={urllib.parse.quote_plus(body)}&{MOCK_WEBHOOK_PAYLOAD}"
     parsed_request_with_body = {"Body": body, **PARSED_MOCK_WEBHOOK_PAYLOAD}
@@ -57,8 +72,11 @@ def mock_response(
     parsed_request_with_body = {"Body": request_body, **PARSED_MOCK_WEBHOOK_PAYLOAD}
 
     def request_callback(request):
-        # check body
-        assert request.body == request_with_body
+        # check body (forwarded as it was received, unless it was rewritten)
+        body_sent = request.body
+        if isinstance(body_sent, bytes):
+            body_sent = body_sent.decode("utf-8")
+        assert body_sent == request_with_body
 
         # check signature
         assert request.headers["X-Twilio-Signature"] == sign_request(
@@ -350,3 +368,1234 @@ def test_normalization():
     responses.assert_call_count("https://downstream1.com", 0)
     responses.assert_call_count("https://downstream2.com", 1)
     responses.assert_call_count("https://downstream3.com", 0)
+
+
+def blocking_callback(event, body="slow"):
+    def request_callback(request):
+        assert event.wait(5)
+        return (200, {"Content-Type": "application/xml"}, body)
+
+    return request_callback
+
+
+@responses.activate
+def test_respond_early():
+    mock_response("https://downstream1.com", body="d1")
+    mock_response("https://downstream2.com", body="d2")
+
+    queue = SqliteDeliveryQueue()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=["https://downstream1.com", "https://downstream2.com"],
+                responder=0,
+            ),
+            keywords={},
+            respond_early=True,
+        ),
+        delivery_queue=queue,
+    )
+
+    assert mux_request(muxer) == (200, "d1", {"Content-Type": "application/xml"})
+
+    # downstream2 was queued before we replied, so nothing is left running
+    assert muxer.drain(timeout=0)
+    responses.assert_call_count("https://downstream2.com", 0)
+    ((_, job),) = queue.get_batch(10)
+    assert job.url == "https://downstream2.com"
+
+
+@responses.activate
+def test_respond_early_no_responder():
+    # Without a delivery queue, deliveries go on the retry queue
+    queue = SqliteDeliveryQueue()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=["https://downstream1.com"],
+                responder=None,
+            ),
+            keywords={},
+            respond_early=True,
+        ),
+        retry_queue=queue,
+    )
+
+    assert mux_request(muxer) == (
+        200,
+        "<Response></Response>",
+        {"Content-Type": "application/xml"},
+    )
+    assert len(queue) == 1
+    assert muxer.drain(timeout=0)
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"respond_early": True},
+        {"default": {"cache": {"ttl": 60}}},
+        {"keywords": {"help": {"cache": {"ttl": 60}}}},
+    ],
+)
+def test_replying_early_requires_a_queue(config):
+    default = {"downstreams": ["https://downstream1.com"], "responder": 0}
+    keywords = {
+        keyword: {**default, **keyword_config}
+        for keyword, keyword_config in config.pop("keywords", {}).items()
+    }
+    config = {
+        **config,
+        "default": {**default, **config.get("default", {})},
+        "keywords": keywords,
+    }
+
+    with pytest.raises(ValueError):
+        TwilioMuxer(
+            twilio_auth_token=MOCK_AUTH_TOKEN,
+            muxer_url=MOCK_MUXER_URL,
+            config=Config(**config),
+        )
+
+
+@responses.activate
+def test_deadline():
+    release = threading.Event()
+    mock_response("https://downstream1.com", body="d1")
+    responses.add_callback(
+        responses.POST, "https://downstream2.com", callback=blocking_callback(release)
+    )
+
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=["https://downstream1.com", "https://downstream2.com"],
+                responder=1,
+            ),
+            keywords={},
+        ),
+    )
+
+    start = time.monotonic()
+    try:
+        # The responder doesn't answer before the deadline
+        assert muxer.mux_request(
+            f"Body=foobar&{MOCK_WEBHOOK_PAYLOAD}",
+            {
+                "X-Twilio-Signature": sign_request(
+                    MOCK_MUXER_URL, {"Body": "foobar", **PARSED_MOCK_WEBHOOK_PAYLOAD}
+                )
+            },
+            deadline=time.monotonic() + 0.2,
+        ) == (500, "<Response></Response>", {"Content-Type": "application/xml"})
+        assert time.monotonic() - start < 2
+    finally:
+        release.set()
+        # Wait for the abandoned request so it doesn't leak into other tests
+        muxer.engine.close()
+
+
+def test_fanout_deadline():
+    class MockContext:
+        def __init__(self, remaining_ms):
+            self.remaining_ms = remaining_ms
+
+        def get_remaining_time_in_millis(self):
+            return self.remaining_ms
+
+    now = time.monotonic()
+
+    # Capped at DOWNSTREAM_TIMEOUT
+    assert fanout_deadline(MockContext(30000)) == pytest.approx(
+        now + DOWNSTREAM_TIMEOUT, abs=0.1
+    )
+
+    # Bounded by the invocation's remaining time
+    assert fanout_deadline(MockContext(3000)) == pytest.approx(
+        now + 3 - DEADLINE_MARGIN, abs=0.1
+    )
+
+    # Never in the past
+    assert fanout_deadline(MockContext(0)) == pytest.approx(now, abs=0.1)
+
+
+@responses.activate
+def test_fuzzy_matching():
+    mock_response("https://downstream1.com", body="d1", request_body="stoqq")
+    mock_response("https://downstream2.com", body="d2", request_body="stop")
+
+    config = Config(
+        default=KeywordConfig(
+            downstreams=["https://downstream1.com"],
+            responder=0,
+        ),
+        keywords={
+            "stop": KeywordConfig(
+                downstreams=["https://downstream2.com"],
+                responder=0,
+                max_edit_distance=1,
+            ),
+        },
+    )
+
+    assert mux_request(config, body="Stoq!") == (
+        200,
+        "d2",
+        {"Content-Type": "application/xml"},
+    )
+    responses.assert_call_count("https://downstream2.com", 1)
+
+    # Two edits away: falls through to the default
+    assert mux_request(config, body="stoqq") == (
+        200,
+        "d1",
+        {"Content-Type": "application/xml"},
+    )
+    responses.assert_call_count("https://downstream1.com", 1)
+
+
+def test_invalid_signature():
+    with pytest.raises(RuntimeError):
+        TwilioMuxer(
+            twilio_auth_token=MOCK_AUTH_TOKEN,
+            muxer_url=MOCK_MUXER_URL,
+            config=Config(
+                default=KeywordConfig(
+                    downstreams=["https://downstream1.com"], responder=0
+                ),
+                keywords={},
+            ),
+        ).mux_request(
+            f"Body=foobar&{MOCK_WEBHOOK_PAYLOAD}",
+            {"X-Twilio-Signature": sign_request(MOCK_MUXER_URL, {"Body": "foobar"})},
+        )
+
+
+class ListSink(MetricsSink):
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, metrics):
+        self.emitted.append(metrics)
+
+    def emit_histograms(self, histograms):
+        self.emitted.append({"latency_histograms": histograms})
+
+    def emit_deliveries(self, kind, totals):
+        self.emitted.append({kind: totals})
+
+
+@responses.activate
+def test_metrics():
+    mock_response("https://downstream1.com", body="d1", request_body="stop")
+    mock_response("https://downstream2.com", raise_exception=True)
+
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream3.com"], responder=0),
+            keywords={
+                "stop": KeywordConfig(
+                    downstreams=["https://downstream1.com", "https://downstream2.com"],
+                    responder=0,
+                ),
+            },
+        ),
+        metrics_sink=sink,
+    )
+
+    assert mux_request(muxer, body="STOP") == (
+        200,
+        "d1",
+        {"Content-Type": "application/xml"},
+    )
+
+    (metrics,) = sink.emitted
+    assert set(metrics["phases"]) == {
+        "parse",
+        "validate",
+        "normalize",
+        "route",
+        "fanout",
+        "respond",
+    }
+    assert metrics["route"] == "stop"
+    assert metrics["match"] == "exact"
+    assert metrics["responder"] == 0
+    assert metrics["status_code"] == 200
+    assert 0 < metrics["budget_ms"] <= DOWNSTREAM_TIMEOUT * 1000
+
+    downstream1, downstream2 = metrics["downstreams"]
+    assert downstream1["url"] == "https://downstream1.com"
+    assert downstream1["status"] == 200
+    assert downstream1["total_ms"] >= 0
+    assert "ttfb_ms" in downstream1
+    assert downstream2["url"] == "https://downstream2.com"
+    assert downstream2["error"] == "Exception"
+
+    # Failures are recorded too
+    with pytest.raises(RuntimeError):
+        muxer.mux_request("Body=foobar", {"X-Twilio-Signature": "bad"})
+
+    assert sink.emitted[1]["error"] == "RuntimeError"
+    assert "fanout" not in sink.emitted[1]["phases"]
+
+
+@responses.activate
+def test_latency_histograms():
+    mock_response("https://downstream1.com", body="d1", request_body="stop")
+    mock_response("https://downstream2.com", raise_exception=True)
+
+    now = [1000.0]
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream3.com"], responder=0),
+            keywords={
+                "stop": KeywordConfig(
+                    downstreams=["https://downstream1.com", "https://downstream2.com"],
+                    responder=0,
+                ),
+            },
+        ),
+        metrics_sink=sink,
+        histograms=LatencyHistograms(flush_interval=60, clock=lambda: now[0]),
+    )
+
+    mux_request(muxer, body="STOP")
+    mux_request(muxer, body="STOP")
+    assert len(sink.emitted) == 2
+
+    # Flushed at the end of the first request after the interval. Only
+    # requests that got a response are recorded.
+    now[0] += 60
+    mux_request(muxer, body="STOP")
+    (histogram,) = sink.emitted[-1]["latency_histograms"]
+    assert histogram["route"] == "stop"
+    assert histogram["downstream"] == "https://downstream1.com"
+    assert histogram["count"] == 3
+    assert histogram["p50_ms"] <= histogram["p99_ms"] <= histogram["max_ms"]
+    assert muxer.histograms.snapshot() == []
+
+
+@responses.activate
+def test_profiling(tmp_path):
+    def slow_callback(request):
+        time.sleep(0.05)
+        return (200, {"Content-Type": "application/xml"}, "d1")
+
+    responses.add_callback(responses.POST, "https://downstream1.com", slow_callback)
+
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream1.com"], responder=0),
+            keywords={},
+        ),
+        metrics_sink=sink,
+        profiler=Profiler(
+            1, FileProfileSink(str(tmp_path)), interval=0.001, random=lambda: 0
+        ),
+    )
+
+    assert mux_request(muxer)[1] == "d1"
+    (metrics,) = sink.emitted
+    assert metrics["profile"]["samples"] > 0
+    assert os.path.dirname(metrics["profile"]["output"]) == str(tmp_path)
+
+    # Off unless PROFILE_SAMPLE_RATE is set
+    assert make_profiler(None, None) is None
+
+
+@responses.activate
+def test_lazy_handler(monkeypatch):
+    mock_response("https://downstream1.com", body="d1")
+
+    monkeypatch.setenv("SENTRY_DSN", "")
+    monkeypatch.setenv("SENTRY_ENVIRONMENT", "test")
+    monkeypatch.setenv("TWILIO_AUTH_TOKEN", MOCK_AUTH_TOKEN)
+    monkeypatch.setenv("TWILIO_CALLBACK_URL", MOCK_MUXER_URL)
+    monkeypatch.setenv(
+        "DOWNSTREAM_CONFIG",
+        base64.b64encode(
+            Config(
+                default=KeywordConfig(
+                    downstreams=["https://downstream1.com"], responder=0
+                ),
+                keywords={},
+            )
+            .json()
+            .encode()
+        ).decode(),
+    )
+
+    # Importing the module doesn't build the muxer
+    monkeypatch.setattr(muxer_module, "muxer", None)
+
+    assert muxer_module.handler(
+        {
+            "body": f"Body=foobar&{MOCK_WEBHOOK_PAYLOAD}",
+            "headers": {
+                "X-Twilio-Signature": sign_request(
+                    MOCK_MUXER_URL, {"Body": "foobar", **PARSED_MOCK_WEBHOOK_PAYLOAD}
+                ),
+                "Content-Type": MOCK_WEBHOOK_CONTENT_TYPE,
+                "I-Twilio-Idempotency-Token": MOCK_WEBHOOK_IDEMPOTENCY_TOKEN,
+                "User-Agent": MOCK_WEBHOOK_USER_AGENT,
+            },
+        },
+        None,
+    ) == {
+        "statusCode": 200,
+        "headers": {"Content-Type": "application/xml"},
+        "body": "d1",
+    }
+
+    # ...and it's kept for later invocations
+    assert muxer_module.get_muxer() is muxer_module.muxer
+    muxer_module.muxer.engine.close()
+
+
+@responses.activate
+def test_retry_queue():
+    mock_response("https://downstream1.com", body="d1")
+    mock_response("https://downstream2.com", raise_exception=True)
+    mock_response("https://downstream3.com", status=503)
+    mock_response("https://downstream4.com", status=404)
+
+    queue = SqliteDeliveryQueue()
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=[
+                    "https://downstream1.com",
+                    "https://downstream2.com",
+                    "https://downstream3.com",
+                    "https://downstream4.com",
+                ],
+                responder=0,
+            ),
+            keywords={},
+        ),
+        metrics_sink=sink,
+        retry_queue=queue,
+    )
+
+    assert mux_request(muxer) == (200, "d1", {"Content-Type": "application/xml"})
+
+    # The connection error and the 503 are queued; the 404 won't get better
+    jobs = sorted((job for _, job in queue.get_batch(10)), key=lambda job: job.url)
+    assert [job.url for job in jobs] == [
+        "https://downstream2.com",
+        "https://downstream3.com",
+    ]
+    for job in jobs:
+        assert job.params == {"Body": "foobar", **PARSED_MOCK_WEBHOOK_PAYLOAD}
+        assert job.headers["I-Twilio-Idempotency-Token"] == (
+            MOCK_WEBHOOK_IDEMPOTENCY_TOKEN
+        )
+        assert "X-Twilio-Signature" not in job.headers
+
+    downstreams = sink.emitted[0]["downstreams"]
+    assert [d.get("queued_for_retry", False) for d in downstreams] == [
+        False,
+        True,
+        True,
+        False,
+    ]
+
+
+@responses.activate
+def test_circuit_breaker():
+    mock_response("https://downstream1.com", body="d1")
+    mock_response("https://downstream2.com", status=503)
+
+    queue = SqliteDeliveryQueue()
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=["https://downstream1.com", "https://downstream2.com"],
+                responder=0,
+            ),
+            keywords={},
+            circuit_breaker={"min_requests": 2, "open_duration": 60},
+        ),
+        metrics_sink=sink,
+        retry_queue=queue,
+    )
+
+    for _ in range(3):
+        assert mux_request(muxer) == (200, "d1", {"Content-Type": "application/xml"})
+
+    # downstream2 is skipped (and queued) once its breaker opens
+    responses.assert_call_count("https://downstream1.com", 3)
+    responses.assert_call_count("https://downstream2.com", 2)
+    assert len(queue) == 3
+
+    assert sink.emitted[1]["downstreams"][1]["breaker"] == "open"
+    assert sink.emitted[2]["downstreams"][1]["error"] == "breaker_open"
+    assert muxer.state.breakers.states() == {
+        "https://downstream1.com": "closed",
+        "https://downstream2.com": "open",
+    }
+
+
+@responses.activate
+def test_fallback_responders():
+    mock_response("https://downstream1.com", raise_exception=True)
+    mock_response("https://downstream2.com", body="<Response></Response>")
+    mock_response("https://downstream3.com", body="d3")
+
+    config = Config(
+        default=KeywordConfig(
+            downstreams=[
+                "https://downstream1.com",
+                "https://downstream2.com",
+                "https://downstream3.com",
+            ],
+            responder=0,
+            fallback_responders=[1, 2],
+        ),
+        keywords={},
+    )
+
+    # The responder failed and the first fallback replied with nothing
+    assert mux_request(config) == (200, "d3", {"Content-Type": "application/xml"})
+
+
+@responses.activate
+def test_fallback_responders_none_good():
+    mock_response("https://downstream1.com", status=500, body="d1")
+    mock_response("https://downstream2.com", raise_exception=True)
+
+    config = Config(
+        default=KeywordConfig(
+            downstreams=["https://downstream1.com", "https://downstream2.com"],
+            responder=0,
+            fallback_responders=[1],
+        ),
+        keywords={},
+    )
+
+    assert mux_request(config) == (500, "d1", {"Content-Type": "application/xml"})
+
+
+@responses.activate
+def test_fallback_responders_retry():
+    mock_response("https://downstream1.com", status=503, body="d1")
+    mock_response("https://downstream2.com", body="d2")
+
+    queue = SqliteDeliveryQueue()
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=["https://downstream1.com", "https://downstream2.com"],
+                responder=0,
+                fallback_responders=[1],
+            ),
+            keywords={},
+        ),
+        metrics_sink=sink,
+        retry_queue=queue,
+    )
+
+    # Twilio gets the fallback's reply, so the responder that failed is
+    # retried like any other downstream
+    assert mux_request(muxer) == (200, "d2", {"Content-Type": "application/xml"})
+    ((_, job),) = queue.get_batch(10)
+    assert job.url == "https://downstream1.com"
+    assert sink.emitted[0]["downstreams"][0]["queued_for_retry"]
+
+    # But not when its reply is the one Twilio gets
+    responses.replace(responses.POST, "https://downstream2.com", status=503)
+    assert mux_request(muxer)[:2] == (503, "d1")
+    ((_, job),) = queue.get_batch(10)
+    assert job.url == "https://downstream2.com"
+
+
+@responses.activate
+def test_hedging():
+    release = threading.Event()
+    responses.add_callback(
+        responses.POST, "https://downstream1.com", callback=blocking_callback(release)
+    )
+    mock_response("https://downstream2.com", body="d2")
+
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=["https://downstream1.com", "https://downstream2.com"],
+                responder=0,
+                fallback_responders=[1],
+                hedge_percentile=95,
+            ),
+            keywords={},
+            respond_early=True,
+        ),
+        metrics_sink=sink,
+        delivery_queue=SqliteDeliveryQueue(),
+    )
+
+    # The responder usually answers within 50ms
+    for _ in range(muxer.latencies.min_samples):
+        muxer.latencies.record("https://downstream1.com", 0.05)
+
+    start = time.monotonic()
+    try:
+        assert mux_request(muxer) == (200, "d2", {"Content-Type": "application/xml"})
+        assert time.monotonic() - start < 2
+        assert sink.emitted[0]["responder"] == 1
+    finally:
+        release.set()
+        assert muxer.drain(timeout=5)
+
+
+@responses.activate
+def test_response_cache():
+    mock_response("https://downstream1.com", body="d1", request_body="help")
+    mock_response("https://downstream2.com", body="d2", request_body="help")
+
+    queue = SqliteDeliveryQueue()
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream3.com"], responder=0),
+            keywords={
+                "help": KeywordConfig(
+                    downstreams=["https://downstream1.com", "https://downstream2.com"],
+                    responder=1,
+                    cache={"ttl": 60, "key_fields": ["foo"]},
+                ),
+            },
+        ),
+        metrics_sink=sink,
+        delivery_queue=queue,
+    )
+
+    assert mux_request(muxer, body="help") == (
+        200,
+        "d2",
+        {"Content-Type": "application/xml"},
+    )
+
+    # Served from the cache, but the downstreams still get the message: the
+    # responder's request goes out, and its new reply replaces the cached one,
+    # and the other downstream's delivery is queued
+    responses.replace(
+        responses.POST,
+        "https://downstream2.com",
+        body="<new/>",
+        content_type="application/xml",
+    )
+    assert mux_request(muxer, body="help") == (
+        200,
+        "d2",
+        {"Content-Type": "application/xml"},
+    )
+    assert muxer.drain(timeout=5)
+    responses.assert_call_count("https://downstream1.com", 1)
+    responses.assert_call_count("https://downstream2.com", 2)
+    ((_, job),) = queue.get_batch(10)
+    assert job.url == "https://downstream1.com"
+    assert [metrics["cache"] for metrics in sink.emitted] == ["miss", "hit"]
+
+    assert muxer.state.response_caches["help"].get(("bar",))[0][1] == "<new/>"
+
+
+@responses.activate
+def test_response_cache_responder_failure():
+    mock_response("https://downstream1.com", body="d1", request_body="help")
+
+    queue = SqliteDeliveryQueue()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream3.com"], responder=0),
+            keywords={
+                "help": KeywordConfig(
+                    downstreams=["https://downstream1.com"],
+                    responder=0,
+                    cache={"ttl": 60},
+                ),
+            },
+        ),
+        retry_queue=queue,
+    )
+    assert mux_request(muxer, body="help")[1] == "d1"
+
+    # Twilio gets the cached reply, so the responder's failed request is
+    # retried, and the cached reply kept
+    responses.replace(responses.POST, "https://downstream1.com", status=503)
+    assert mux_request(muxer, body="help")[1] == "d1"
+    assert muxer.drain(timeout=5)
+    ((_, job),) = queue.get_batch(10)
+    assert job.url == "https://downstream1.com"
+    assert muxer.state.response_caches["help"].get(())[0][1] == "d1"
+
+
+@responses.activate
+def test_response_cache_rules():
+    mock_response("https://downstream1.com", body="d1", request_body="help")
+
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream3.com"], responder=0),
+            keywords={
+                "help": KeywordConfig(
+                    downstreams=["https://downstream1.com"],
+                    responder=0,
+                    cache={"ttl": 60},
+                ),
+            },
+            rules=[{"name": "please", "keyword": "help", "prefix": "please"}],
+        ),
+        metrics_sink=sink,
+        retry_queue=SqliteDeliveryQueue(),
+    )
+    assert mux_request(muxer, body="help")[1] == "d1"
+
+    # A rule using the keyword's route has its own cache, since its messages
+    # aren't rewritten to the keyword
+    mock_response("https://downstream1.com", body="r1", request_body="please help")
+    assert mux_request(muxer, body="please help")[1] == "r1"
+    assert mux_request(muxer, body="please help")[1] == "r1"
+    assert mux_request(muxer, body="help")[1] == "d1"
+    assert muxer.drain(timeout=5)
+    assert [metrics["cache"] for metrics in sink.emitted] == [
+        "miss",
+        "miss",
+        "hit",
+        "hit",
+    ]
+
+
+@responses.activate
+def test_response_cache_errors():
+    mock_response("https://downstream1.com", status=500, body="d1")
+
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=["https://downstream1.com"],
+                responder=0,
+                cache={"ttl": 60},
+            ),
+            keywords={},
+        ),
+        retry_queue=SqliteDeliveryQueue(),
+    )
+
+    # Errors and empty replies aren't cached
+    assert mux_request(muxer)[0] == 500
+    responses.replace(
+        responses.POST,
+        "https://downstream1.com",
+        body="<Response></Response>",
+        content_type="application/xml",
+    )
+    assert mux_request(muxer)[1] == "<Response></Response>"
+    assert len(muxer.state.response_caches[None]) == 0
+
+
+@responses.activate
+def test_downstream_limits():
+    mock_response("https://downstream1.com", body="d1")
+    mock_response("https://downstream1.com/other", body="d2")
+    mock_response("https://downstream2.com", body="d3")
+
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=[
+                    "https://downstream1.com",
+                    "https://downstream1.com/other",
+                    "https://downstream2.com",
+                ],
+                responder=1,
+            ),
+            keywords={},
+            downstream_limits={"https://downstream1.com": {"max_in_flight": 1}},
+        ),
+        metrics_sink=sink,
+        retry_queue=SqliteDeliveryQueue(),
+    )
+
+    # Requests to the limited host wait their turn, but they're all sent
+    assert mux_request(muxer)[1] == "d2"
+    responses.assert_call_count("https://downstream1.com", 1)
+    responses.assert_call_count("https://downstream1.com/other", 1)
+    responses.assert_call_count("https://downstream2.com", 1)
+
+    downstream1, downstream2, downstream3 = sink.emitted[0]["downstreams"]
+    assert downstream1["status"] == 200 and "queued_ms" in downstream1
+    assert downstream2["status"] == 200 and "queued_ms" in downstream2
+    assert "queued_ms" not in downstream3
+    assert muxer.state.limiters.for_url("https://downstream1.com").in_flight == 0
+
+
+@responses.activate
+def test_downstream_limits_deadline():
+    release = threading.Event()
+    responses.add_callback(
+        responses.POST, "https://downstream1.com", callback=blocking_callback(release)
+    )
+
+    queue = SqliteDeliveryQueue()
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=["https://downstream1.com", "https://downstream1.com"],
+                responder=None,
+            ),
+            keywords={},
+            downstream_limits={"*": {"max_in_flight": 1}},
+        ),
+        metrics_sink=sink,
+        retry_queue=queue,
+    )
+
+    try:
+        muxer.mux_request(
+            f"Body=foobar&{MOCK_WEBHOOK_PAYLOAD}",
+            {
+                "X-Twilio-Signature": sign_request(
+                    MOCK_MUXER_URL, {"Body": "foobar", **PARSED_MOCK_WEBHOOK_PAYLOAD}
+                )
+            },
+            deadline=time.monotonic() + 0.2,
+        )
+    finally:
+        release.set()
+        muxer.engine.close()
+
+    # The request still waiting on the limit at the deadline is never sent,
+    # and is queued for retry like the one that timed out
+    downstream1, downstream2 = sink.emitted[0]["downstreams"]
+    assert downstream1["error"] == "timeout" and "queued_ms" in downstream1
+    assert downstream2["error"] == "timeout" and "queued_ms" not in downstream2
+    responses.assert_call_count("https://downstream1.com", 1)
+    assert len(queue) == 2
+
+
+def test_downstream_limits_require_a_retry_queue():
+    with pytest.raises(ValueError):
+        TwilioMuxer(
+            twilio_auth_token=MOCK_AUTH_TOKEN,
+            muxer_url=MOCK_MUXER_URL,
+            config=Config(
+                default=KeywordConfig(
+                    downstreams=["https://downstream1.com"], responder=0
+                ),
+                keywords={},
+                downstream_limits={"*": {"max_in_flight": 1}},
+            ),
+            delivery_queue=SqliteDeliveryQueue(),
+        )
+
+
+@responses.activate
+def test_dedupe():
+    mock_response("https://downstream1.com", body="d1")
+    mock_response("https://downstream2.com", body="d2")
+
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(
+                downstreams=["https://downstream1.com", "https://downstream2.com"],
+                responder=1,
+            ),
+            keywords={},
+            dedupe={},
+        ),
+        metrics_sink=sink,
+    )
+
+    # A retry (same idempotency token) gets the same reply without another
+    # fan-out
+    assert mux_request(muxer)[1] == "d2"
+    assert mux_request(muxer)[1] == "d2"
+    responses.assert_call_count("https://downstream1.com", 1)
+    responses.assert_call_count("https://downstream2.com", 1)
+    assert "deduped" not in sink.emitted[0]
+    assert sink.emitted[1]["deduped"] == "replayed"
+    assert sink.emitted[1]["downstreams"] == []
+
+    # Unsigned requests never see a deduped reply
+    with pytest.raises(RuntimeError):
+        muxer.mux_request(
+            "Body=foobar",
+            {
+                "X-Twilio-Signature": "bad",
+                "I-Twilio-Idempotency-Token": MOCK_WEBHOOK_IDEMPOTENCY_TOKEN,
+            },
+        )
+
+
+@responses.activate
+def test_rules():
+    mock_response("https://downstream1.com", body="d1", request_body="join today")
+    mock_response("https://downstream2.com", body="d2", request_body="stop")
+
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream3.com"], responder=0),
+            keywords={
+                "stop": KeywordConfig(
+                    downstreams=["https://downstream2.com"], responder=0
+                ),
+            },
+            rules=[
+                {
+                    "name": "campaign",
+                    "prefix": "join",
+                    "fields": {"foo": ["bar"]},
+                    "route": {
+                        "downstreams": ["https://downstream1.com"],
+                        "responder": 0,
+                    },
+                },
+                {"name": "stop words", "regex": "^stop", "keyword": "stop"},
+            ],
+        ),
+        metrics_sink=sink,
+    )
+
+    # The message is passed on as it is
+    assert mux_request(muxer, body="join today")[1] == "d1"
+    assert sink.emitted[0]["match"] == "rule"
+    assert sink.emitted[0]["rule"] == "campaign"
+    assert sink.emitted[0]["route"] == "campaign"
+
+    # Keywords are matched before rules
+    assert mux_request(muxer, body="stop")[1] == "d2"
+    assert sink.emitted[1]["match"] == "exact"
+    assert "rule" not in sink.emitted[1]
+
+
+@responses.activate
+def test_delivery_queue(monkeypatch):
+    mock_response("https://downstream1.com", request_body="stop")
+    mock_response("https://downstream2.com", request_body="stop", status=503)
+
+    queue = SqliteDeliveryQueue()
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream3.com"], responder=0),
+            keywords={
+                "stop": KeywordConfig(
+                    downstreams=["https://downstream1.com", "https://downstream2.com"],
+                    responder=None,
+                ),
+            },
+        ),
+        metrics_sink=sink,
+        delivery_queue=queue,
+    )
+
+    # We reply without sending anything downstream
+    assert mux_request(muxer, body="STOP") == (
+        200,
+        "<Response></Response>",
+        {"Content-Type": "application/xml"},
+    )
+    assert len(responses.calls) == 0
+    assert len(queue) == 2
+    assert [d["delivery_queued"] for d in sink.emitted[0]["downstreams"]] == [
+        True,
+        True,
+    ]
+
+    # Routes with a responder aren't queued
+    mock_response("https://downstream3.com", body="d3")
+    assert mux_request(muxer)[1] == "d3"
+    assert len(queue) == 2
+
+    # The delivery handler sends them, re-signed, and retries failures later
+    monkeypatch.setattr(muxer_module, "muxer", muxer)
+    assert muxer_module.delivery_handler({}, None) == {
+        "delivered": 1,
+        "retried": 1,
+        "abandoned": 0,
+    }
+    assert sink.emitted[-1] == {
+        "delivery": {"delivered": 1, "retried": 1, "abandoned": 0}
+    }
+    responses.assert_call_count("https://downstream1.com", 1)
+    responses.assert_call_count("https://downstream2.com", 1)
+    assert len(queue) == 1
+
+
+@responses.activate
+def test_delivery_handler_sqs_records(monkeypatch):
+    mock_response("https://downstream1.com", status=503)
+
+    queue = SqliteDeliveryQueue()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream1.com"], responder=0),
+            keywords={},
+        ),
+        delivery_queue=queue,
+    )
+    monkeypatch.setattr(muxer_module, "muxer", muxer)
+
+    job = DeliveryJob(
+        url="https://downstream1.com",
+        params={"Body": "foobar", **PARSED_MOCK_WEBHOOK_PAYLOAD},
+        headers={
+            "Content-Type": MOCK_WEBHOOK_CONTENT_TYPE,
+            "I-Twilio-Idempotency-Token": MOCK_WEBHOOK_IDEMPOTENCY_TOKEN,
+            "User-Agent": MOCK_WEBHOOK_USER_AGENT,
+        },
+    )
+    assert muxer_module.delivery_handler(
+        {"Records": [{"body": job.json()}]}, None
+    ) == {"delivered": 0, "retried": 1, "abandoned": 0}
+
+    # Put back on the queue for later, with the attempt counted
+    assert len(queue) == 1
+    with queue.lock:
+        (row,) = queue.db.execute("SELECT job FROM jobs").fetchall()
+    assert DeliveryJob.parse_raw(row[0]).attempts == 1
+
+
+TENANT_AUTH_TOKEN = "efgh"
+TENANTS = TenantsConfig.parse_obj(
+    {
+        "tenants": {
+            "program": {
+                "path": "/muxer/program",
+                "auth_token": TENANT_AUTH_TOKEN,
+                "callback_url": "https://examplemuxer.com/muxer/program",
+                "config": {
+                    "default": {
+                        "downstreams": ["https://tenant.com/a"],
+                        "responder": 0,
+                    },
+                    "keywords": {
+                        "stop": {
+                            "downstreams": ["https://tenant.com/b"],
+                            "responder": None,
+                        }
+                    },
+                },
+            },
+            "other": {
+                "account_sid": "AC2",
+                "auth_token": TENANT_AUTH_TOKEN,
+                "callback_url": MOCK_MUXER_URL,
+                "config": {
+                    "default": {
+                        "downstreams": ["https://tenant.com/a"],
+                        "responder": 0,
+                    },
+                    "keywords": {},
+                },
+            },
+        },
+        "cache_size": 1,
+    }
+)
+
+
+def tenant_request(muxer, callback_url, params, path=None):
+    validator = RequestValidator(TENANT_AUTH_TOKEN)
+    return muxer.mux_request(
+        urllib.parse.urlencode(params),
+        {
+            "X-Twilio-Signature": validator.compute_signature(callback_url, params),
+            "Content-Type": MOCK_WEBHOOK_CONTENT_TYPE,
+        },
+        path=path,
+    )
+
+
+def tenant_callback(request):
+    # Signed with the tenant's auth token
+    body = request.body
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    params = dict(urllib.parse.parse_qsl(body))
+    assert request.headers["X-Twilio-Signature"] == RequestValidator(
+        TENANT_AUTH_TOKEN
+    ).compute_signature(request.url, params)
+    return (200, {"Content-Type": "application/xml"}, f"tenant {params['Body']}")
+
+
+@responses.activate
+def test_tenants():
+    responses.add_callback(responses.POST, "https://tenant.com/a", tenant_callback)
+    mock_response("https://downstream1.com", body="d1")
+
+    sink = ListSink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream1.com"], responder=0),
+            keywords={},
+        ),
+        metrics_sink=sink,
+        tenants=TENANTS,
+    )
+
+    # By path
+    assert tenant_request(
+        muxer,
+        "https://examplemuxer.com/muxer/program",
+        {"Body": "hi", "AccountSid": "AC1"},
+        path="/muxer/program/",
+    )[:2] == (200, "tenant hi")
+    assert sink.emitted[-1]["tenant"] == "program"
+
+    # By AccountSid
+    assert tenant_request(
+        muxer, MOCK_MUXER_URL, {"Body": "hello", "AccountSid": "AC2"}, path="/muxer"
+    )[:2] == (200, "tenant hello")
+    assert sink.emitted[-1]["tenant"] == "other"
+
+    # Only one tenant is kept built, sharing our engine
+    assert list(muxer.tenants.built) == ["other"]
+    assert muxer.tenants.get("other").engine is muxer.engine
+
+    # Everything else is ours
+    assert mux_request(muxer)[1] == "d1"
+    assert "tenant" not in sink.emitted[-1]
+
+    # Signed with the wrong auth token
+    with pytest.raises(RuntimeError):
+        muxer.mux_request(
+            f"Body=foobar&{MOCK_WEBHOOK_PAYLOAD}",
+            {
+                "X-Twilio-Signature": sign_request(
+                    "https://examplemuxer.com/muxer/program",
+                    {"Body": "foobar", **PARSED_MOCK_WEBHOOK_PAYLOAD},
+                )
+            },
+            path="/muxer/program",
+        )
+
+
+@responses.activate
+def test_tenant_deliveries(monkeypatch):
+    responses.add_callback(responses.POST, "https://tenant.com/b", tenant_callback)
+
+    queue = SqliteDeliveryQueue()
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream1.com"], responder=0),
+            keywords={},
+        ),
+        delivery_queue=queue,
+        tenants=TENANTS,
+    )
+    monkeypatch.setattr(muxer_module, "muxer", muxer)
+
+    tenant_request(
+        muxer,
+        "https://examplemuxer.com/muxer/program",
+        {"Body": "stop"},
+        path="/muxer/program",
+    )
+    assert len(queue) == 1
+
+    # Re-signed with the tenant's auth token, even once it's been evicted,
+    # without building its muxer again
+    muxer.tenants.built.clear()
+    assert muxer_module.delivery_handler({}, None)["delivered"] == 1
+    responses.assert_call_count("https://tenant.com/b", 1)
+    assert not muxer.tenants.built
+
+
+def test_tenant_eviction(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(
+        '{"default": {"downstreams": ["https://tenant.com/a"], "responder": 0}, '
+        '"keywords": {}}'
+    )
+    tenants = TenantsConfig.parse_obj(
+        {
+            "tenants": {
+                name: {
+                    "path": f"/muxer/{name}",
+                    "auth_token": TENANT_AUTH_TOKEN,
+                    "callback_url": MOCK_MUXER_URL,
+                    "config_source": str(path),
+                }
+                for name in ("a", "b")
+            },
+            "cache_size": 1,
+        }
+    )
+    muxer = TwilioMuxer(
+        twilio_auth_token=MOCK_AUTH_TOKEN,
+        muxer_url=MOCK_MUXER_URL,
+        config=Config(
+            default=KeywordConfig(downstreams=["https://downstream1.com"], responder=0),
+            keywords={},
+        ),
+        tenants=tenants,
+    )
+
+    provider = muxer.tenants.get("a").config_provider
+    assert provider.on_change is not None
+    muxer.tenants.get("b")
+    assert list(muxer.tenants.built) == ["b"]
+
+    # An evicted tenant's config provider goes with it, and no longer keeps
+    # its muxer alive; it's rebuilt with a new one
+    assert provider.on_change is None
+    rebuilt = muxer.tenants.get("a")
+    assert rebuilt.config_provider is not provider
+    assert rebuilt.config_provider.on_change == rebuilt.set_config
@@ -0,0 +1,90 @@
+from typing import Any, Dict, NamedTuple
+from urllib.parse import urlsplit
+
+from .config import Config, KeywordConfig
+
+
+class PoolStats(NamedTuple):
+    # Requests that reused an already-open keep-alive connection
+    hits: int
+    # Requests that had to open a new connection (TCP + TLS handshake)
+    misses: int
+
+
+def host_key(url: str) -> str:
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    return f"{parts.scheme}://{parts.hostname}:{port}".lower()
+
+
+def keyword_configs(config: Config) -> Dict[str, KeywordConfig]:
+    # Every route's config, including rules with their own routes
+    return {
+        "<default>": config.default,
+        **config.keywords,
+        **{rule.name: rule.route for rule in config.rules if rule.route is not None},
+    }
+
+
+def downstream_hosts(config: Config) -> Dict[str, int]:
+    # Map from host -> the most requests a single inbound webhook can make to
+    # that host concurrently. This is how big the per-host pool needs to be
+    # to avoid opening throwaway connections during a fan-out.
+    hosts: Dict[str, int] = {}
+    for keyword_config in keyword_configs(config).values():
+        per_route: Dict[str, int] = {}
+        for url in keyword_config.downstreams:
+            key = host_key(url)
+            per_route[key] = per_route.get(key, 0) + 1
+
+        for key, count in per_route.items():
+            hosts[key] = max(hosts.get(key, 0), count)
+
+    return hosts
+
+
+# Keep-alive HTTP connection pools to the downstreams, one per host. This is
+# meant to live as long as the container so that warm invocations reuse the
+# TCP/TLS connections opened by earlier invocations.
+class DownstreamPool:
+    def __init__(self, config: Config):
+        # Only needed by the threaded engine
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        hosts = downstream_hosts(config)
+
+        # pool_connections is the number of per-host pools urllib3 will keep
+        # around before evicting the least recently used one, so we size it
+        # to hold every configured host.
+        self.adapter = HTTPAdapter(
+            pool_connections=max(len(hosts), 1),
+            pool_maxsize=max(hosts.values(), default=1),
+        )
+
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def post(self, url: str, **kwargs: Any) -> Any:
+        return self.session.post(url, **kwargs)
+
+    def stats(self) -> Dict[str, PoolStats]:
+        pools = self.adapter.poolmanager.pools
+        stats: Dict[str, PoolStats] = {}
+
+        with pools.lock:
+            connection_pools = list(pools._container.values())
+
+        for pool in connection_pools:
+            key = f"{pool.scheme}://{pool.host}:{pool.port}".lower()
+            hits, misses = stats.get(key, PoolStats(0, 0))
+            stats[key] = PoolStats(
+                hits=hits + pool.num_requests - pool.num_connections,
+                misses=misses + pool.num_connections,
+            )
+
+        return stats
+
+    def close(self) -> None:
+        self.session.close()
@@ -0,0 +1,73 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from .config import Config, KeywordConfig
+from .pool import DownstreamPool, PoolStats, downstream_hosts, host_key
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b"<Response></Response>"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_host_key():
+    assert host_key("https://A.example.com/foo?bar") == "https://a.example.com:443"
+    assert host_key("http://a.example.com/foo") == "http://a.example.com:80"
+    assert host_key("http://a.example.com:8080/") == "http://a.example.com:8080"
+
+
+def test_downstream_hosts():
+    assert downstream_hosts(
+        Config(
+            default=KeywordConfig(
+                downstreams=["https://a.com/1", "https://b.com"], responder=0
+            ),
+            keywords={
+                "stop": KeywordConfig(
+                    downstreams=["https://a.com/2", "https://a.com/3"],
+                    responder=None,
+                ),
+            },
+        )
+    ) == {"https://a.com:443": 2, "https://b.com:443": 1}
+
+
+def test_connection_reuse(local_server):
+    pool = DownstreamPool(
+        Config(
+            default=KeywordConfig(downstreams=[local_server], responder=0),
+            keywords={},
+        )
+    )
+
+    for _ in range(3):
+        assert pool.post(local_server + "/foo", data={"a": "b"}).status_code == 200
+
+    assert pool.stats() == {
+        host_key(local_server): PoolStats(hits=2, misses=1),
+    }
+
+    pool.close()
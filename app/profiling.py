@@ -0,0 +1,294 @@
+import abc
+import collections
+import concurrent.futures
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Counter, Dict, Iterator, List, Optional, Set, Tuple
+
+from .metrics import RequestMetrics
+
+# How often the sampler looks at what every thread is doing (in seconds)
+SAMPLE_INTERVAL = 0.005
+
+# How many of the hottest functions to put in the request's metrics
+TOP_FUNCTIONS = 5
+
+# Where profiles go by default: /tmp is the only writable directory on Lambda
+DEFAULT_PROFILE_DIR = os.path.join(tempfile.gettempdir(), "profiles")
+
+# Threads whose names start with this belong to the engines (see engines.py):
+# they send every request's downstream requests, so they're profiled along
+# with the thread handling the webhook
+ENGINE_THREAD_PREFIX = "muxer-"
+
+# Leaf frames of threads that are parked waiting for work: idle engine worker
+# threads and the asyncio engine's event loop. They're left out of profiles.
+IDLE_FRAMES = {
+    ("/concurrent/futures/thread.py", "_worker"),
+    ("/selectors.py", "select"),
+}
+
+
+def frame_name(code: Any) -> str:
+    # "function (package/module.py)": short enough to read in a flamegraph,
+    # and the same wherever the package is installed
+    path = code.co_filename.replace(os.sep, "/").rsplit("/", 2)
+    return f"{code.co_name} ({'/'.join(path[-2:])})"
+
+
+def thread_stack(frame: Any) -> Tuple[str, ...]:
+    # Outermost frame first, as collapsed stacks are written
+    stack = []
+    while frame is not None:
+        stack.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def is_idle(frame: Any) -> bool:
+    path = frame.f_code.co_filename.replace(os.sep, "/")
+    return any(
+        path.endswith(suffix) and frame.f_code.co_name == name
+        for suffix, name in IDLE_FRAMES
+    )
+
+
+# A statistical profiler: a background thread that records the Python stack of
+# every other (non-idle) thread every interval, or only those include(thread
+# ID, thread name) accepts. It costs nothing between samples, unlike
+# sys.setprofile().
+class StackSampler:
+    def __init__(
+        self,
+        interval: float = SAMPLE_INTERVAL,
+        include: Optional[Callable[[int, str], bool]] = None,
+    ):
+        self.interval = interval
+        self.include = include
+        self.stacks: Counter[Tuple[str, ...]] = collections.Counter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> Counter[Tuple[str, ...]]:
+        self.stopping.set()
+        self.thread.join()
+        return self.stacks
+
+    def run(self) -> None:
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        while not self.stopping.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or is_idle(frame):
+                    continue
+
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                name = names.get(thread_id, str(thread_id))
+                if self.include is not None and not self.include(thread_id, name):
+                    continue
+                self.stacks[(f"thread {name}",) + thread_stack(frame)] += 1
+
+
+def collapsed_stacks(stacks: Counter[Tuple[str, ...]]) -> str:
+    # One "frame;frame;frame count" line per stack, as read by flamegraph.pl,
+    # speedscope and friends
+    return "".join(
+        f"{';'.join(stack)} {count}\n" for stack, count in sorted(stacks.items())
+    )
+
+
+def top_functions(
+    stacks: Counter[Tuple[str, ...]], limit: int = TOP_FUNCTIONS
+) -> List[Tuple[str, int]]:
+    # The functions we most often caught running (their own code, not their
+    # callees'), with how many samples each
+    self_samples: Counter[str] = collections.Counter()
+    for stack, count in stacks.items():
+        if len(stack) > 1:
+            self_samples[stack[-1]] += count
+    return self_samples.most_common(limit)
+
+
+# Where profiles are written. location() says where write() will put a
+# profile, for the metrics, which are logged before it's written.
+class ProfileSink(abc.ABC):
+    @abc.abstractmethod
+    def location(self, name: str) -> str:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def write(self, name: str, profile: str) -> None:
+        raise NotImplementedError()
+
+
+class FileProfileSink(ProfileSink):
+    def __init__(self, directory: str = DEFAULT_PROFILE_DIR):
+        self.directory = directory
+
+    def location(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def write(self, name: str, profile: str) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.location(name), "w") as f:
+            f.write(profile)
+
+
+class S3ProfileSink(ProfileSink):
+    def __init__(self, bucket: str, prefix: str = "", client: Any = None):
+        if client is None:
+            # boto3 is available on Lambda; it's only needed for this backend
+            import boto3  # type: ignore
+
+            client = boto3.client("s3")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client
+
+    def location(self, name: str) -> str:
+        return f"s3://{self.bucket}/{self.prefix}{name}"
+
+    def write(self, name: str, profile: str) -> None:
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{name}",
+            Body=profile.encode("utf-8"),
+            ContentType="text/plain",
+        )
+
+
+def make_profile_sink(sink: Optional[str]) -> ProfileSink:
+    # "s3://bucket/prefix/", or a directory (DEFAULT_PROFILE_DIR if unset)
+    if not sink:
+        return FileProfileSink()
+
+    if sink.startswith("s3://"):
+        bucket, _, prefix = sink[len("s3://") :].partition("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        return S3ProfileSink(bucket, prefix)
+
+    if sink.startswith("file://"):
+        return FileProfileSink(sink[len("file://") :])
+    if "://" not in sink:
+        return FileProfileSink(sink)
+
+    raise ValueError(f"Unknown profile sink: {sink}")
+
+
+# Profiles a random sample_rate of requests (see TwilioMuxer.mux_request()),
+# writing each one's collapsed stacks to the sink and its hottest functions to
+# the request's metrics. Only the thread handling the request and the
+# engine's threads are sampled, so under a threaded server other webhooks'
+# handlers stay out of it (though the engine's threads are shared, so their
+# downstream requests can show up). Profiles are written on a background
+# thread, so a slow sink never holds up the reply; drain() waits for them.
+# The muxer only has a Profiler when sample_rate > 0, so with profiling off
+# there's nothing to pay for.
+class Profiler:
+    def __init__(
+        self,
+        sample_rate: float,
+        sink: ProfileSink,
+        interval: float = SAMPLE_INTERVAL,
+        on_error: Optional[Callable[[Exception], Any]] = None,
+        random: Callable[[], float] = random.random,
+    ):
+        self.sample_rate = sample_rate
+        self.sink = sink
+        self.interval = interval
+        self.on_error = on_error
+        self.random = random
+        self.writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="profile-writer"
+        )
+        self.writing: Set[concurrent.futures.Future] = set()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, metrics: RequestMetrics) -> Iterator[None]:
+        if self.random() >= self.sample_rate:
+            yield
+            return
+
+        request_thread = threading.get_ident()
+
+        def include(thread_id: int, name: str) -> bool:
+            return thread_id == request_thread or name.startswith(ENGINE_THREAD_PREFIX)
+
+        sampler = StackSampler(self.interval, include)
+        sampler.start()
+        try:
+            yield
+        finally:
+            stacks = sampler.stop()
+            self.record(stacks, sampler.samples, metrics)
+
+    def record(
+        self, stacks: Counter[Tuple[str, ...]], samples: int, metrics: RequestMetrics
+    ) -> None:
+        profile: Dict[str, Any] = {
+            "samples": samples,
+            "top": [[name, count] for name, count in top_functions(stacks)],
+        }
+
+        if stacks:
+            name = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.folded"
+            profile["output"] = self.sink.location(name)
+            writing = self.writer.submit(self.write, name, collapsed_stacks(stacks))
+            with self.lock:
+                self.writing.add(writing)
+            writing.add_done_callback(self.written)
+
+        metrics.set(profile=profile)
+
+    def write(self, name: str, profile: str) -> None:
+        try:
+            self.sink.write(name, profile)
+        except Exception as e:
+            # Never fail the webhook over a profile
+            logging.exception("Failed to write profile")
+            if self.on_error is not None:
+                self.on_error(e)
+
+    def written(self, future: concurrent.futures.Future) -> None:
+        with self.lock:
+            self.writing.discard(future)
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        # Wait for profiles still being written. Returns whether they all
+        # were within the timeout.
+        with self.lock:
+            writing = list(self.writing)
+
+        _, not_done = concurrent.futures.wait(writing, timeout=timeout)
+        return not not_done
+
+
+def make_profiler(
+    sample_rate: Optional[str],
+    sink: Optional[str],
+    on_error: Optional[Callable[[Exception], Any]] = None,
+) -> Optional[Profiler]:
+    # From PROFILE_SAMPLE_RATE and PROFILE_SINK; None unless we're sampling
+    rate = float(sample_rate or 0)
+    if rate <= 0:
+        return None
+
+    return Profiler(min(rate, 1.0), make_profile_sink(sink), on_error=on_error)
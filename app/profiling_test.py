@@ -0,0 +1,184 @@
+import collections
+import os
+import threading
+import time
+
+import pytest
+
+from .metrics import RequestMetrics
+from .profiling import (
+    FileProfileSink,
+    Profiler,
+    ProfileSink,
+    S3ProfileSink,
+    StackSampler,
+    collapsed_stacks,
+    make_profile_sink,
+    make_profiler,
+    top_functions,
+)
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_sampler():
+    sampler = StackSampler(interval=0.001)
+    sampler.start()
+    spin(0.1)
+    stacks = sampler.stop()
+
+    assert sampler.samples > 0
+    (thread,) = {stack[0] for stack in stacks}
+    assert thread == f"thread {threading.current_thread().name}"
+    assert any(
+        "spin (app/profiling_test.py)" in stack
+        and "test_sampler (app/profiling_test.py)" in stack
+        for stack in stacks
+    )
+
+
+def test_collapsed_stacks():
+    stacks = collections.Counter(
+        {
+            ("thread main", "handler (app/muxer.py)", "post (requests/api.py)"): 3,
+            ("thread main", "handler (app/muxer.py)"): 1,
+            ("thread worker", "post (requests/api.py)"): 2,
+        }
+    )
+
+    assert collapsed_stacks(stacks) == (
+        "thread main;handler (app/muxer.py) 1\n"
+        "thread main;handler (app/muxer.py);post (requests/api.py) 3\n"
+        "thread worker;post (requests/api.py) 2\n"
+    )
+    assert top_functions(stacks, limit=1) == [("post (requests/api.py)", 5)]
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler(
+        0.5, FileProfileSink(str(tmp_path)), interval=0.001, random=lambda: 0.2
+    )
+    metrics = RequestMetrics()
+    with profiler.profile(metrics):
+        spin(0.05)
+    assert profiler.drain(timeout=5)
+
+    profile = metrics.fields["profile"]
+    assert profile["samples"] > 0
+    assert profile["top"][0][0] == "spin (app/profiling_test.py)"
+    assert os.path.dirname(profile["output"]) == str(tmp_path)
+    with open(profile["output"]) as f:
+        assert "spin (app/profiling_test.py)" in f.read()
+
+    # Not sampled
+    profiler.random = lambda: 0.5
+    metrics = RequestMetrics()
+    with profiler.profile(metrics):
+        pass
+    assert "profile" not in metrics.fields
+
+
+def test_profiler_threads(tmp_path):
+    profiler = Profiler(1, FileProfileSink(str(tmp_path)), interval=0.001)
+    stop = threading.Event()
+
+    def other_request():
+        while not stop.is_set():
+            spin(0.001)
+
+    threads = [
+        threading.Thread(target=other_request, name="gthread-1"),
+        threading.Thread(target=other_request, name="muxer-engine_0"),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        metrics = RequestMetrics()
+        with profiler.profile(metrics):
+            spin(0.05)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    assert profiler.drain(timeout=5)
+
+    with open(metrics.fields["profile"]["output"]) as f:
+        threads_sampled = {line.split(";")[0] for line in f}
+    assert threads_sampled == {
+        f"thread {threading.current_thread().name}",
+        "thread muxer-engine_0",
+    }
+
+
+def test_profiler_writes_in_background(tmp_path):
+    class SlowSink(FileProfileSink):
+        def write(self, name, profile):
+            written.wait(5)
+            super().write(name, profile)
+
+    written = threading.Event()
+    profiler = Profiler(1, SlowSink(str(tmp_path)), interval=0.001)
+    metrics = RequestMetrics()
+    with profiler.profile(metrics):
+        spin(0.05)
+
+    # The metrics say where the profile is going before it gets there
+    output = metrics.fields["profile"]["output"]
+    assert not os.path.exists(output)
+    assert not profiler.drain(timeout=0.01)
+
+    written.set()
+    assert profiler.drain(timeout=5)
+    assert os.path.exists(output)
+
+
+def test_profiler_sink_errors():
+    class BrokenSink(ProfileSink):
+        def location(self, name):
+            return name
+
+        def write(self, name, profile):
+            raise IOError("unavailable")
+
+    errors = []
+    profiler = Profiler(
+        1, BrokenSink(), interval=0.001, on_error=errors.append, random=lambda: 0
+    )
+    metrics = RequestMetrics()
+    with profiler.profile(metrics):
+        spin(0.05)
+    assert profiler.drain(timeout=5)
+
+    assert len(errors) == 1
+
+
+def test_s3_sink():
+    class FakeS3:
+        def __init__(self):
+            self.objects = {}
+
+        def put_object(self, Bucket, Key, Body, ContentType):
+            self.objects[(Bucket, Key)] = Body
+
+    s3 = FakeS3()
+    sink = S3ProfileSink("bucket", "profiles/", client=s3)
+    assert sink.location("a.folded") == "s3://bucket/profiles/a.folded"
+    sink.write("a.folded", "main 1\n")
+    assert s3.objects == {("bucket", "profiles/a.folded"): b"main 1\n"}
+
+
+def test_make_profiler(tmp_path):
+    assert make_profiler(None, None) is None
+    assert make_profiler("0", "s3://bucket") is None
+
+    profiler = make_profiler("2", str(tmp_path))
+    assert profiler.sample_rate == 1.0
+    assert profiler.sink.directory == str(tmp_path)
+
+    assert make_profile_sink(f"file://{tmp_path}").directory == str(tmp_path)
+    with pytest.raises(ValueError):
+        make_profile_sink("gs://bucket")
@@ -0,0 +1,203 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import IO, Any, Dict, Iterator, List, Optional
+from urllib.parse import parse_qsl, urlencode
+
+from .bench import percentile
+from .config import parse_config_file
+from .deliveries import make_queue
+from .metrics import MetricsSink
+from .muxer import TwilioMuxer, config_from_env
+from .signing import canonicalize_params
+
+# We sign replayed events ourselves, so the muxer's URL only has to match
+# between signing and validation
+DEFAULT_MUXER_URL = "https://replay.invalid/muxer"
+
+
+def read_events(f: IO[str]) -> Iterator[Dict[str, Any]]:
+    # One recorded inbound webhook per line, either as the Lambda event
+    # ({"body": "<form-encoded>", "headers": {...}}) or as {"params": {...}}.
+    # Lines are read as they're needed, so files of any size can be replayed.
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+
+        try:
+            event = json.loads(line)
+            if "params" in event:
+                params = {str(k): str(v) for k, v in event["params"].items()}
+            else:
+                params = dict(parse_qsl(event["body"], keep_blank_values=True))
+            headers = dict(event.get("headers") or {})
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logging.warning(f"Skipping line {line_number}: not a recorded event")
+            continue
+
+        yield {"params": params, "headers": headers}
+
+
+def signed_event(muxer: TwilioMuxer, event: Dict[str, Any]) -> Dict[str, Any]:
+    # Replace whatever signature was recorded with one for our muxer URL. The
+    # other headers (notably the idempotency token) are kept as recorded.
+    params = event["params"]
+    headers = {
+        k: v for k, v in event["headers"].items() if k.lower() != "x-twilio-signature"
+    }
+    headers["X-Twilio-Signature"] = muxer.signer.sign(
+        muxer.muxer_url, canonicalize_params(params)
+    )
+    headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+
+    return {"body": urlencode(params), "headers": headers}
+
+
+# Collects per-route outcomes and latencies from the muxer's per-request
+# metrics
+class SummarySink(MetricsSink):
+    def __init__(self) -> None:
+        self.routes: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def emit(self, metrics: Dict[str, Any]) -> None:
+        route = metrics.get("route") or "<default>"
+        with self.lock:
+            stats = self.routes.setdefault(
+                route, {"status_codes": {}, "errors": {}, "latencies": []}
+            )
+            stats["latencies"].append(metrics["total_ms"])
+            if "error" in metrics:
+                error = metrics["error"]
+                stats["errors"][error] = stats["errors"].get(error, 0) + 1
+            else:
+                status_code = str(metrics.get("status_code"))
+                stats["status_codes"][status_code] = (
+                    stats["status_codes"].get(status_code, 0) + 1
+                )
+
+            for downstream in metrics["downstreams"]:
+                if "error" in downstream:
+                    key = f"downstream_{downstream['error']}"
+                    stats["errors"][key] = stats["errors"].get(key, 0) + 1
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        summary = {}
+        with self.lock:
+            for route, stats in sorted(self.routes.items()):
+                latencies = sorted(stats["latencies"])
+                summary[route] = {
+                    "requests": len(latencies),
+                    "status_codes": dict(stats["status_codes"]),
+                    "errors": dict(stats["errors"]),
+                    "p50_ms": percentile(latencies, 50),
+                    "p95_ms": percentile(latencies, 95),
+                    "p99_ms": percentile(latencies, 99),
+                    "max_ms": latencies[-1] if latencies else 0.0,
+                }
+
+        return summary
+
+
+def replay(
+    muxer: TwilioMuxer,
+    events: Iterator[Dict[str, Any]],
+    workers: int,
+    rate: Optional[float] = None,
+) -> int:
+    # Send the events through the muxer from a pool of workers, at most rate
+    # per second (or as fast as the workers go). Only a couple of events per
+    # worker are read ahead of the ones in flight. Returns how many we sent.
+    in_flight = threading.BoundedSemaphore(workers * 2)
+
+    def send(event: Dict[str, Any]) -> None:
+        try:
+            muxer.mux_request(event["body"], event["headers"])
+        except Exception:
+            # Recorded in the metrics
+            logging.exception("Failed to replay event")
+        finally:
+            in_flight.release()
+
+    start = time.monotonic()
+    sent = 0
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for event in events:
+            if rate:
+                delay = start + sent / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            in_flight.acquire()
+            pool.submit(send, signed_event(muxer, event))
+            sent += 1
+
+    return sent
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(
+        description="Replay recorded inbound webhooks (JSONL) through the muxer"
+    )
+    parser.add_argument("events", help="JSONL file of recorded events, or -")
+    parser.add_argument(
+        "--config",
+        help="JSON config file (default: DOWNSTREAM_CONFIG_FILE/DOWNSTREAM_CONFIG)",
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--rate", type=float, help="events per second (default: as fast as possible)"
+    )
+    parser.add_argument("--output", help="write the summary to this JSON file")
+    args = parser.parse_args(argv)
+
+    auth_token = os.environ.get("TWILIO_AUTH_TOKEN")
+    if not auth_token:
+        parser.error("TWILIO_AUTH_TOKEN must be set to sign downstream requests")
+
+    sink = SummarySink()
+    muxer = TwilioMuxer(
+        twilio_auth_token=auth_token,
+        muxer_url=os.environ.get("TWILIO_CALLBACK_URL") or DEFAULT_MUXER_URL,
+        config=parse_config_file(args.config) if args.config else config_from_env(),
+        metrics_sink=sink,
+        retry_queue=make_queue(os.environ.get("RETRY_QUEUE")),
+        delivery_queue=make_queue(os.environ.get("DELIVERY_QUEUE")),
+    )
+
+    start = time.monotonic()
+    try:
+        if args.events == "-":
+            sent = replay(muxer, read_events(sys.stdin), args.workers, args.rate)
+        else:
+            with open(args.events) as f:
+                sent = replay(muxer, read_events(f), args.workers, args.rate)
+
+        # Deliveries that finish in the background (respond_early, caching)
+        muxer.drain()
+    finally:
+        muxer.engine.close()
+    elapsed = time.monotonic() - start
+
+    results = {
+        "events": sent,
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(sent / elapsed, 3) if elapsed else 0.0,
+        "routes": sink.summary(),
+    }
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import io
+import json
+import time
+import urllib.parse
+
+import responses  # type: ignore
+
+from .config import Config
+from .muxer_test import MOCK_AUTH_TOKEN, MOCK_MUXER_URL, sign_request
+from .replay import main, read_events
+
+CONFIG = Config.parse_obj(
+    {
+        "default": {"downstreams": ["https://downstream1.com"], "responder": 0},
+        "keywords": {
+            "stop": {"downstreams": ["https://downstream2.com"], "responder": None}
+        },
+    }
+)
+
+EVENTS = [
+    {
+        "body": "Body=hi&From=%2B15555550100",
+        "headers": {"X-Twilio-Signature": "stale", "I-Twilio-Idempotency-Token": "t1"},
+    },
+    {"params": {"Body": "STOP", "From": "+15555550100"}},
+    {"params": {"Body": "hello", "From": "+15555550101"}},
+]
+
+
+def test_read_events():
+    f = io.StringIO(
+        "\n".join([json.dumps(EVENTS[0]), "", "not json", "[]", json.dumps(EVENTS[1])])
+    )
+
+    assert list(read_events(f)) == [
+        {
+            "params": {"Body": "hi", "From": "+15555550100"},
+            "headers": EVENTS[0]["headers"],
+        },
+        {"params": {"Body": "STOP", "From": "+15555550100"}, "headers": {}},
+    ]
+
+
+@responses.activate
+def test_replay(tmp_path, monkeypatch):
+    def callback(request):
+        # Re-signed by the muxer, with recorded headers passed through
+        params = dict(urllib.parse.parse_qsl(request.body.decode()))
+        url = request.url.rstrip("/")
+        assert request.headers["X-Twilio-Signature"] == sign_request(url, params)
+        if params["From"] == "+15555550100" and params["Body"] == "hi":
+            assert request.headers["I-Twilio-Idempotency-Token"] == "t1"
+
+        return (200, {"Content-Type": "application/xml"}, "<Response>ok</Response>")
+
+    responses.add_callback(responses.POST, "https://downstream1.com", callback)
+    responses.add_callback(responses.POST, "https://downstream2.com", callback)
+
+    events = tmp_path / "events.jsonl"
+    events.write_text("".join(json.dumps(event) + "\n" for event in EVENTS * 3))
+    config = tmp_path / "config.json"
+    config.write_text(CONFIG.json())
+    output = tmp_path / "summary.json"
+
+    monkeypatch.setenv("TWILIO_AUTH_TOKEN", MOCK_AUTH_TOKEN)
+    monkeypatch.setenv("TWILIO_CALLBACK_URL", MOCK_MUXER_URL)
+
+    start = time.monotonic()
+    results = main(
+        [
+            str(events),
+            "--config",
+            str(config),
+            "--workers",
+            "2",
+            "--rate",
+            "100",
+            "--output",
+            str(output),
+        ]
+    )
+
+    # 9 events at 100/second
+    assert time.monotonic() - start >= 0.08
+    assert json.loads(output.read_text()) == results
+    assert results["events"] == 9
+
+    default, stop = results["routes"]["<default>"], results["routes"]["stop"]
+    assert default["requests"] == 6
+    assert default["status_codes"] == {"200": 6}
+    assert stop["requests"] == 3
+    assert stop["errors"] == {}
+    assert 0 < stop["p50_ms"] <= stop["p99_ms"] <= stop["max_ms"]
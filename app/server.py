@@ -0,0 +1,215 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import threading
+from http import HTTPStatus
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from . import muxer as muxer_module
+from .muxer import TwilioMuxer, capture_exception
+
+# How long to wait, on shutdown, for downstream requests still running in the
+# background (see Config.respond_early) before giving up on them
+DRAIN_TIMEOUT = 20
+
+# The largest webhook body we'll read; Twilio's are a few KB
+MAX_BODY_SIZE = 1024 * 1024
+
+
+def request_headers(environ: Dict[str, Any]) -> Dict[str, str]:
+    # Turn the WSGI environ back into HTTP headers, like API Gateway passes
+    # them to the Lambda handler (e.g. HTTP_X_TWILIO_SIGNATURE becomes
+    # X-Twilio-Signature)
+    headers = {}
+    for key, value in environ.items():
+        if key.startswith("HTTP_"):
+            name = key[len("HTTP_") :]
+        elif key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = key
+        else:
+            continue
+
+        headers["-".join(part.capitalize() for part in name.split("_"))] = value
+
+    return headers
+
+
+def redact_url(url: str) -> str:
+    # Downstream URLs can carry credentials, in the query string or userinfo.
+    # /latencyz only shows their scheme, host and path.
+    parts = urlsplit(url)
+    if not parts.netloc:
+        return url
+
+    host = parts.hostname or ""
+    if parts.port is not None:
+        host += f":{parts.port}"
+    return f"{parts.scheme}://{host}{parts.path}"
+
+
+# Serves the muxer over WSGI, as a long-running alternative to the Lambda
+# handler: POST webhooks to any path other than the health checks. Run it
+# under gunicorn (see gunicorn.conf.py) for multiple worker processes, each
+# with its own muxer, shared by all of the worker's threads.
+#
+#   GET /healthz:   the process is up
+#   GET /readyz:    the muxer is configured and we're not shutting down
+#   GET /latencyz:  p50/p90/p99 latency per route and downstream (without
+#                   the URLs' query strings), since the histograms were last
+#                   flushed (this process only)
+class MuxerApp:
+    def __init__(
+        self,
+        get_muxer: Callable[[], TwilioMuxer] = muxer_module.get_muxer,
+        drain_timeout: float = DRAIN_TIMEOUT,
+    ):
+        self.get_muxer = get_muxer
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self.muxer: Optional[TwilioMuxer] = None
+
+    def __call__(
+        self, environ: Dict[str, Any], start_response: Callable[..., Any]
+    ) -> Iterable[bytes]:
+        path = environ.get("PATH_INFO", "")
+        method = environ.get("REQUEST_METHOD", "GET")
+
+        if path == "/healthz":
+            return self.reply(start_response, 200, "ok")
+
+        if path == "/readyz":
+            if self.ready():
+                return self.reply(start_response, 200, "ok")
+            return self.reply(start_response, 503, "not ready")
+
+        if path == "/latencyz" and method == "GET":
+            latencies = self.muxer.histograms.snapshot() if self.muxer else []
+            for series in latencies:
+                series["downstream"] = redact_url(series["downstream"])
+            return self.reply(
+                start_response,
+                200,
+                json.dumps(latencies, indent=2),
+                {"Content-Type": "application/json"},
+            )
+
+        if method != "POST":
+            return self.reply(start_response, 405, "")
+
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return self.reply(start_response, 400, "")
+        if length > MAX_BODY_SIZE:
+            return self.reply(start_response, 413, "")
+
+        body = environ["wsgi.input"].read(length)
+
+        try:
+            status_code, reply, headers = self.load_muxer().mux_request(
+                body, request_headers(environ), path=path
+            )
+        except Exception as e:
+            # On Lambda, API Gateway turns this into a 502
+            logging.exception("Failed to mux request")
+            capture_exception(e)
+            return self.reply(start_response, 502, "")
+
+        return self.reply(start_response, status_code, reply, headers)
+
+    def reply(
+        self,
+        start_response: Callable[..., Any],
+        status_code: int,
+        body: str,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> List[bytes]:
+        encoded = body.encode("utf-8")
+        response_headers: List[Tuple[str, str]] = list(
+            (headers or {"Content-Type": "text/plain"}).items()
+        )
+        response_headers.append(("Content-Length", str(len(encoded))))
+
+        try:
+            status = f"{status_code} {HTTPStatus(status_code).phrase}"
+        except ValueError:
+            status = str(status_code)
+
+        start_response(status, response_headers)
+        return [encoded]
+
+    def ready(self) -> bool:
+        if self.draining:
+            return False
+
+        try:
+            self.load_muxer()
+        except Exception:
+            logging.exception("Muxer is not configured")
+            return False
+
+        return True
+
+    def load_muxer(self) -> TwilioMuxer:
+        self.muxer = self.get_muxer()
+        return self.muxer
+
+    def shutdown(self) -> None:
+        # Stop reporting ready, then wait for background deliveries. Call
+        # this once the server has stopped accepting requests.
+        self.draining = True
+
+        if self.muxer is None:
+            return
+
+        if not self.muxer.drain(timeout=self.drain_timeout):
+            logging.warning("Shut down with downstream deliveries still running")
+
+        self.muxer.flush_histograms()
+        self.muxer.engine.close()
+
+
+application = MuxerApp()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    # A single-process threaded server, for running locally; use gunicorn in
+    # production
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import WSGIServer, make_server
+
+    parser = argparse.ArgumentParser(description="Run the muxer as a web server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    args = parser.parse_args(argv)
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        # server_close() waits for in-flight requests
+        daemon_threads = False
+        block_on_close = True
+
+    logging.basicConfig(level=logging.INFO)
+    server = make_server(
+        args.host, args.port, application, server_class=ThreadingWSGIServer
+    )
+
+    def stop(signum: int, frame: Any) -> None:
+        application.draining = True
+        # shutdown() blocks until serve_forever() returns, so it can't be
+        # called from the thread running serve_forever()
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logging.info(f"Listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+    server.server_close()
+    application.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import base64
+import hmac
+from hashlib import sha1
+from typing import Mapping, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+
+def canonicalize_params(params: Mapping[str, str]) -> bytes:
+    # The POST params as they're fed into a Twilio signature: each name
+    # followed by its value, sorted by name. This only depends on the body,
+    # so it's computed once per message and shared by every signature.
+    return "".join(name + params[name] for name in sorted(params)).encode("utf-8")
+
+
+def with_port(url: str) -> str:
+    parts = urlsplit(url)
+    if parts.port:
+        return url
+
+    port = 443 if parts.scheme == "https" else 80
+    return urlunsplit(parts._replace(netloc=f"{parts.netloc}:{port}"))
+
+
+def without_port(url: str) -> str:
+    parts = urlsplit(url)
+    if not parts.port:
+        return url
+
+    return urlunsplit(parts._replace(netloc=parts.netloc.rsplit(":", 1)[0]))
+
+
+# Computes and validates Twilio request signatures (HMAC-SHA1 of the URL
+# followed by the canonicalized params, keyed by the auth token). Compatible
+# with twilio.request_validator.RequestValidator for form-encoded requests.
+class Signer:
+    def __init__(self, auth_token: str):
+        # Keyed once; every signature starts from a copy of this
+        self.mac = hmac.new(auth_token.encode("utf-8"), digestmod=sha1)
+
+    def sign(self, url: str, canonical_params: bytes) -> str:
+        mac = self.mac.copy()
+        mac.update(url.encode("utf-8"))
+        mac.update(canonical_params)
+        return base64.b64encode(mac.digest()).decode("utf-8")
+
+    def validate(
+        self, url: str, canonical_params: bytes, signature: Optional[str]
+    ) -> bool:
+        if not signature:
+            return False
+
+        # Twilio isn't consistent about whether the port is included in the
+        # signed URL, so accept either
+        expected = signature.encode("utf-8")
+        return any(
+            hmac.compare_digest(
+                self.sign(candidate, canonical_params).encode("utf-8"), expected
+            )
+            for candidate in (without_port(url), with_port(url))
+        )
@@ -0,0 +1,68 @@
+from twilio.request_validator import RequestValidator
+
+from .signing import Signer, canonicalize_params, with_port, without_port
+
+AUTH_TOKEN = "abcd"
+
+PARAMS = [
+    {},
+    {"Body": "stop", "From": "+15555555555"},
+    {"Body": "ñ 🛑 &=+", "b": "", "a": "2", "MediaUrl0": "https://x.com/?a=b"},
+]
+
+URLS = [
+    "https://examplemuxer.com",
+    "https://examplemuxer.com/muxer?a=b",
+    "https://examplemuxer.com:443/muxer",
+    "http://localhost:8000/muxer",
+]
+
+
+def test_ports():
+    assert with_port("https://a.com/b?c") == "https://a.com:443/b?c"
+    assert with_port("http://a.com/b") == "http://a.com:80/b"
+    assert with_port("http://a.com:8080/b") == "http://a.com:8080/b"
+    assert without_port("https://a.com:443/b?c") == "https://a.com/b?c"
+    assert without_port("https://a.com/b") == "https://a.com/b"
+
+
+def test_matches_twilio():
+    signer = Signer(AUTH_TOKEN)
+    validator = RequestValidator(AUTH_TOKEN)
+
+    for params in PARAMS:
+        canonical = canonicalize_params(params)
+        for url in URLS:
+            signature = validator.compute_signature(url, params)
+            assert signer.sign(url, canonical) == signature
+            assert signer.validate(url, canonical, signature)
+
+            # Signing is repeatable off the same keyed HMAC
+            assert signer.sign(url, canonical) == signature
+
+
+def test_validate():
+    signer = Signer(AUTH_TOKEN)
+    params = {"Body": "stop"}
+    canonical = canonicalize_params(params)
+    signature = RequestValidator(AUTH_TOKEN).compute_signature(
+        "https://examplemuxer.com/muxer", params
+    )
+
+    assert signer.validate("https://examplemuxer.com/muxer", canonical, signature)
+
+    # With or without the port
+    assert signer.validate("https://examplemuxer.com:443/muxer", canonical, signature)
+
+    assert not signer.validate("https://examplemuxer.com/other", canonical, signature)
+    assert not signer.validate(
+        "https://examplemuxer.com/muxer",
+        canonicalize_params({"Body": "start"}),
+        signature,
+    )
+    assert not signer.validate("https://examplemuxer.com/muxer", canonical, None)
+    assert not signer.validate("https://examplemuxer.com/muxer", canonical, "")
+    assert not signer.validate("https://examplemuxer.com/muxer", canonical, "ñ")
+    assert not Signer("other").validate(
+        "https://examplemuxer.com/muxer", canonical, signature
+    )
@@ -0,0 +1,181 @@
+import base64
+import collections
+import concurrent.futures
+import json
+import threading
+from typing import Any, Callable, Dict, Generic, Optional, TypeVar
+
+from pydantic import BaseModel, validator
+
+from .config_provider import ConfigSource
+
+# How many tenants' muxers (signature validator, config and its indexes) a
+# container keeps built at once, by default
+CACHE_SIZE = 32
+
+T = TypeVar("T")
+
+
+def normalize_path(path: str) -> str:
+    return "/" + path.strip("/")
+
+
+class TenantConfig(BaseModel):
+    # Webhooks for this tenant are recognized by the request path they're
+    # posted to, or by their AccountSid (for when several accounts share a
+    # path). At least one is required; the path wins if both match.
+    path: Optional[str]
+    account_sid: Optional[str]
+
+    # The tenant's Twilio auth token, and the URL Twilio posts its webhooks to
+    # (which the signature is computed over)
+    auth_token: str
+    callback_url: str
+
+    # The tenant's downstream config (see Config), either inline or from a
+    # source like CONFIG_SOURCE ("s3://bucket/key", "ssm:/name" or a file)
+    # that's reloaded while we run. It's only validated, and its indexes only
+    # built, once the tenant gets a webhook.
+    config: Optional[Dict[str, Any]]
+    config_source: Optional[str]
+
+    @validator("path")
+    def path_must_be_normalized(cls, v):
+        return normalize_path(v) if v is not None else None
+
+    @validator("account_sid", always=True)
+    def tenant_must_be_recognizable(cls, v, values, **kwargs):
+        if v is None and values.get("path") is None:
+            raise ValueError("a tenant needs a path or an account_sid")
+        return v
+
+    @validator("config_source", always=True)
+    def needs_exactly_one_config(cls, v, values, **kwargs):
+        if (v is None) == (values.get("config") is None):
+            raise ValueError("a tenant needs one of config or config_source")
+        return v
+
+
+class TenantsConfig(BaseModel):
+    tenants: Dict[str, TenantConfig]
+    cache_size: int = CACHE_SIZE
+
+    @validator("tenants")
+    def paths_and_account_sids_must_be_unique(cls, v):
+        for field in ("path", "account_sid"):
+            seen: Dict[str, str] = {}
+            for name, tenant in v.items():
+                value = getattr(tenant, field)
+                if value is None:
+                    continue
+                if value in seen:
+                    raise ValueError(
+                        f"tenants {seen[value]} and {name} have the same {field}"
+                    )
+                seen[value] = name
+        return v
+
+    @validator("cache_size")
+    def cache_size_must_be_positive(cls, v):
+        if v < 1:
+            raise ValueError("cache_size must be >= 1")
+        return v
+
+
+def parse_tenants_bytes(raw: bytes) -> TenantsConfig:
+    # Plain JSON, or base64-encoded JSON like DOWNSTREAM_CONFIG
+    raw = raw.strip()
+    if not raw.startswith(b"{"):
+        raw = base64.b64decode(raw)
+
+    return TenantsConfig(**json.loads(raw))
+
+
+def load_tenants(source: ConfigSource) -> TenantsConfig:
+    # TENANTS_SOURCE is read once, when the container starts
+    fetched = source.fetch(None)
+    if fetched is None:
+        raise ValueError("Tenants source returned nothing")
+
+    return parse_tenants_bytes(fetched[1])
+
+
+# Finds the tenant a webhook is for, and builds its muxer (with build(name,
+# tenant)) the first time it's needed. At most cache_size are kept built; the
+# least recently used is dropped to make room (and handed to on_evict), and
+# rebuilt if its tenant comes back. Concurrent webhooks for a tenant that's
+# being built wait for that build rather than starting their own, and builds
+# happen outside the lock, so a slow one (e.g. fetching the tenant's config)
+# doesn't hold up webhooks for other tenants.
+class TenantRegistry(Generic[T]):
+    def __init__(
+        self,
+        config: TenantsConfig,
+        build: Callable[[str, TenantConfig], T],
+        on_evict: Optional[Callable[[str, T], Any]] = None,
+    ):
+        self.config = config
+        self.build = build
+        self.on_evict = on_evict
+        self.by_path = {
+            tenant.path: name
+            for name, tenant in config.tenants.items()
+            if tenant.path is not None
+        }
+        self.by_account_sid = {
+            tenant.account_sid: name
+            for name, tenant in config.tenants.items()
+            if tenant.account_sid is not None
+        }
+        self.built: "collections.OrderedDict[str, T]" = collections.OrderedDict()
+        self.building: Dict[str, concurrent.futures.Future] = {}
+        self.lock = threading.Lock()
+
+    def find(self, path: Optional[str], account_sid: Optional[str]) -> Optional[str]:
+        # The name of the tenant for a webhook, if it's one of ours
+        if path is not None:
+            name = self.by_path.get(normalize_path(path))
+            if name is not None:
+                return name
+
+        if account_sid is not None:
+            return self.by_account_sid.get(account_sid)
+
+        return None
+
+    def get(self, name: str) -> T:
+        # The tenant's muxer, built if needed. Raises KeyError for unknown
+        # tenants.
+        with self.lock:
+            built = self.built.get(name)
+            if built is not None:
+                self.built.move_to_end(name)
+                return built
+
+            building = self.building.get(name)
+            waiting = building is not None
+            if building is None:
+                building = self.building[name] = concurrent.futures.Future()
+
+        if waiting:
+            return building.result()
+
+        try:
+            built = self.build(name, self.config.tenants[name])
+        except BaseException as e:
+            with self.lock:
+                del self.building[name]
+            building.set_exception(e)
+            raise
+
+        evicted = None
+        with self.lock:
+            del self.building[name]
+            self.built[name] = built
+            if len(self.built) > self.config.cache_size:
+                evicted = self.built.popitem(last=False)
+
+        building.set_result(built)
+        if evicted is not None and self.on_evict is not None:
+            self.on_evict(*evicted)
+        return built
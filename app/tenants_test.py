@@ -0,0 +1,155 @@
+import base64
+import json
+import threading
+
+import pytest
+from pydantic import ValidationError
+
+from .config_provider import FileSource
+from .tenants import (
+    TenantConfig,
+    TenantRegistry,
+    TenantsConfig,
+    load_tenants,
+    parse_tenants_bytes,
+)
+
+CONFIG = {
+    "default": {"downstreams": ["https://downstream1.com"], "responder": 0},
+    "keywords": {},
+}
+
+
+def tenant(**kwargs):
+    return {
+        "auth_token": "token",
+        "callback_url": "https://muxer.com/muxer",
+        "config": CONFIG,
+        **kwargs,
+    }
+
+
+TENANTS = {
+    "tenants": {
+        "a": tenant(path="muxer/a/"),
+        "b": tenant(path="/muxer/b", account_sid="AC2"),
+        "c": tenant(account_sid="AC3", config=None, config_source="s3://bucket/c"),
+    },
+    "cache_size": 2,
+}
+
+
+def test_tenants_config():
+    config = TenantsConfig(**TENANTS)
+    assert config.tenants["a"].path == "/muxer/a"
+
+    with pytest.raises(ValidationError):
+        TenantConfig(**tenant())
+    with pytest.raises(ValidationError):
+        TenantConfig(**tenant(path="/a", config_source="s3://bucket/a"))
+    with pytest.raises(ValidationError):
+        TenantConfig(**tenant(path="/a", config=None))
+    with pytest.raises(ValidationError):
+        TenantsConfig(tenants={"a": tenant(path="/a"), "b": tenant(path="a/")})
+    with pytest.raises(ValidationError):
+        TenantsConfig(tenants={"a": tenant(path="/a")}, cache_size=0)
+
+
+def test_parse_tenants(tmp_path):
+    raw = json.dumps(TENANTS).encode()
+    assert parse_tenants_bytes(raw) == TenantsConfig(**TENANTS)
+    assert parse_tenants_bytes(base64.b64encode(raw)) == TenantsConfig(**TENANTS)
+
+    path = tmp_path / "tenants.json"
+    path.write_bytes(raw)
+    assert load_tenants(FileSource(str(path))) == TenantsConfig(**TENANTS)
+
+
+def test_find():
+    registry = TenantRegistry(TenantsConfig(**TENANTS), build=lambda name, t: name)
+
+    assert registry.find("/muxer/a", None) == "a"
+    assert registry.find("/muxer/a/", "AC3") == "a"
+    assert registry.find("/muxer", "AC3") == "c"
+    assert registry.find(None, "AC2") == "b"
+    assert registry.find("/muxer", "AC1") is None
+    assert registry.find(None, None) is None
+
+
+def test_get():
+    builds = []
+
+    def build(name, tenant_config):
+        builds.append(name)
+        return object()
+
+    evicted = []
+    registry = TenantRegistry(
+        TenantsConfig(**TENANTS),
+        build=build,
+        on_evict=lambda name, built: evicted.append(name),
+    )
+
+    a = registry.get("a")
+    assert registry.get("a") is a
+    registry.get("b")
+    registry.get("a")
+    assert builds == ["a", "b"]
+
+    # b is the least recently used
+    registry.get("c")
+    assert list(registry.built) == ["a", "c"]
+    assert evicted == ["b"]
+    registry.get("b")
+    assert builds == ["a", "b", "c", "b"]
+    assert evicted == ["b", "a"]
+
+    with pytest.raises(KeyError):
+        registry.get("d")
+
+
+def test_get_concurrently():
+    started = threading.Event()
+    release = threading.Event()
+    builds = []
+
+    def build(name, tenant_config):
+        builds.append(name)
+        if name == "a":
+            started.set()
+            release.wait(5)
+        return object()
+
+    registry = TenantRegistry(TenantsConfig(**TENANTS), build=build)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(registry.get("a")))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    assert started.wait(5)
+
+    # Other tenants are built while a is, and a is only built once
+    registry.get("b")
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(builds) == ["a", "b"]
+    assert results == [registry.get("a")] * 3
+
+
+def test_get_build_error():
+    failures = [ValueError("unavailable")]
+
+    def build(name, tenant_config):
+        if failures:
+            raise failures.pop()
+        return name
+
+    registry = TenantRegistry(TenantsConfig(**TENANTS), build=build)
+    with pytest.raises(ValueError):
+        registry.get("a")
+
+    # Tried again next time
+    assert registry.get("a") == "a"
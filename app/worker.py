@@ -0,0 +1,67 @@
+import argparse
+import logging
+import signal
+import threading
+from typing import Any, Dict, List, Optional
+
+from . import muxer as muxer_module
+
+# How long to wait before checking the queues again once they're empty (in
+# seconds)
+IDLE_INTERVAL = 1.0
+
+
+# Sends queued deliveries (DELIVERY_QUEUE, then RETRY_QUEUE) outside Lambda,
+# e.g. alongside the server (see app/server.py). Uses the same muxer, and so
+# the same connection pools, as the Lambda handlers.
+def run_once() -> Dict[str, Dict[str, int]]:
+    muxer = muxer_module.get_muxer()
+    results = {}
+    for name, queue in (
+        ("delivery", muxer.delivery_queue),
+        ("redelivery", muxer.retry_queue),
+    ):
+        if queue is not None:
+            results[name] = muxer_module.drain_queue(muxer, queue, None)
+
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Send deliveries queued in DELIVERY_QUEUE and RETRY_QUEUE"
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="drain the queues once and exit"
+    )
+    parser.add_argument("--interval", type=float, default=IDLE_INTERVAL)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    stopping = threading.Event()
+
+    def stop(signum: int, frame: Any) -> None:
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping.is_set():
+        results = run_once()
+        sent = sum(sum(totals.values()) for totals in results.values())
+        if sent:
+            sink = muxer_module.get_muxer().metrics_sink
+            for name, totals in results.items():
+                sink.emit_deliveries(name, totals)
+            sink.flush()
+
+        if args.once:
+            break
+        if not sent:
+            stopping.wait(args.interval)
+
+    muxer_module.get_muxer().engine.close()
+
+
+if __name__ == "__main__":
+    main()
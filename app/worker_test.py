@@ -0,0 +1,44 @@
+import responses  # type: ignore
+
+from . import muxer as muxer_module
+from . import worker
+from .config import Config, KeywordConfig
+from .deliveries import DeliveryJob, SqliteDeliveryQueue
+from .muxer import TwilioMuxer
+from .muxer_test import MOCK_AUTH_TOKEN, MOCK_MUXER_URL
+
+
+@responses.activate
+def test_run_once(monkeypatch):
+    responses.add(responses.POST, "https://downstream1.com", body="ok")
+
+    delivery_queue = SqliteDeliveryQueue()
+    retry_queue = SqliteDeliveryQueue()
+    monkeypatch.setattr(
+        muxer_module,
+        "muxer",
+        TwilioMuxer(
+            twilio_auth_token=MOCK_AUTH_TOKEN,
+            muxer_url=MOCK_MUXER_URL,
+            config=Config(
+                default=KeywordConfig(
+                    downstreams=["https://downstream1.com"], responder=None
+                ),
+                keywords={},
+            ),
+            retry_queue=retry_queue,
+            delivery_queue=delivery_queue,
+        ),
+    )
+
+    job = DeliveryJob(url="https://downstream1.com", params={"Body": "hi"}, headers={})
+    delivery_queue.put(job)
+    delivery_queue.put(job)
+    retry_queue.put(job)
+
+    assert worker.run_once() == {
+        "delivery": {"delivered": 2, "retried": 0, "abandoned": 0},
+        "redelivery": {"delivered": 1, "retried": 0, "abandoned": 0},
+    }
+    assert len(delivery_queue) == 0
+    assert len(retry_queue) == 0
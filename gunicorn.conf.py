@@ -0,0 +1,32 @@
+# gunicorn settings for running the muxer as a server (see app/server.py and
+# the README). Each worker process builds its own muxer, whose connection
+# pools and engine are shared by all of that worker's threads.
+import multiprocessing
+import os
+
+wsgi_app = "app.server:application"
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("THREADS", "16"))
+
+# Each request can take up to DOWNSTREAM_TIMEOUT (10 seconds); give in-flight
+# requests and background deliveries time to finish on SIGTERM
+timeout = 30
+graceful_timeout = 30
+
+accesslog = "-"
+
+
+def post_worker_init(worker):
+    # Build the muxer before taking requests, rather than on the first one
+    from app.server import application
+
+    application.load_muxer()
+
+
+def worker_exit(server, worker):
+    from app.server import application
+
+    application.shutdown()